@@ -0,0 +1,65 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Token size and sign/verify benchmark for the "standard" and "compact" claims profiles of encryption_and_decryption
+# Signs access and refresh tokens of an authenticated user with each profile and signing algorithm, and reports the token sizes, the bytes
+# saved per request in the Authorization header (the access token, sent with every backend request), and the sign and verify times
+# Usage: python benchmark_claims_profile.py [iterations]
+
+import json
+import os
+import sys
+import time
+import uuid
+
+from jwcrypto import jwk
+
+# A CloudFront issuer URL of the same length as the deployed ones
+issuer_url = "https://d1a2b3c4d5e6f7.cloudfront.net"
+os.environ.setdefault("ISSUER_URL", issuer_url)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import encryption_and_decryption
+
+key_generation_parameters = {
+    "RS256": {"kty": "RSA", "size": 2048},
+    "ES256": {"kty": "EC", "crv": "P-256"},
+    "EdDSA": {"kty": "OKP", "crv": "Ed25519"}
+}
+
+# Average time per call in microseconds
+def measure(iterations, function):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1000000
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    # Verify every token fully, not from the verified token cache
+    encryption_and_decryption.verified_token_cache_size = 0
+
+    print(f"{'algorithm':<10} {'profile':<9} {'access bytes':>13} {'refresh bytes':>14} {'saved/request':>14} {'sign us':>9} {'verify us':>10}")
+    for algorithm, parameters in key_generation_parameters.items():
+        key = jwk.JWK.generate(alg=algorithm, use='sig', kid=str(uuid.uuid4()), **parameters)
+        private_key = key.export_private()
+        encryption_and_decryption.get_jwks_key_set(issuer_url).load_key_set({"keys": [json.loads(key.export_public())]})
+        user_id = str(uuid.uuid4())
+
+        standard_header_bytes = None
+        for profile in ["standard", "compact"]:
+            encryption_and_decryption.claims_profile = profile
+            access_token, refresh_token, _, _ = encryption_and_decryption.encrypt_with_private_key({"sub": user_id}, private_key, "authenticated")
+            if encryption_and_decryption.decrypt(access_token) == None or encryption_and_decryption.decrypt_refresh_token(refresh_token) == None:
+                raise Exception(algorithm + " " + profile + " tokens failed to verify")
+
+            header_bytes = len("Authorization: Bearer " + access_token)
+            if standard_header_bytes == None:
+                standard_header_bytes = header_bytes
+            sign_time = measure(iterations, lambda: encryption_and_decryption.encrypt_access_token({"sub": user_id}, private_key, "authenticated"))
+            verify_time = measure(iterations, lambda: encryption_and_decryption.decrypt(access_token))
+            print(f"{algorithm:<10} {profile:<9} {len(access_token):>13} {len(refresh_token):>14} {standard_header_bytes - header_bytes:>14} "
+                  f"{sign_time:>9.0f} {verify_time:>10.0f}")
+
+if __name__ == "__main__":
+    main()
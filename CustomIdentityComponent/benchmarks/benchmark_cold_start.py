@@ -0,0 +1,89 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Import time benchmark for the Lambda handlers in CustomIdentityComponent/lambda
+# Imports each handler in a fresh Python process with -X importtime (like a Lambda cold start init) and reports
+# the total init time, the peak memory of the process, and the most expensive modules imported by the handler
+# Usage: python benchmark_cold_start.py [handler_module ...]
+
+import os
+import subprocess
+import sys
+
+lambda_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+
+handlers = [
+    "login_as_guest",
+    "refresh_access_token",
+    "revoke_refresh_token",
+    "introspect_tokens",
+    "login_with_steam",
+    "login_with_apple_id",
+    "login_with_google_play",
+    "login_with_facebook",
+    "login_with_cognito",
+    "generate_keys"
+]
+
+# Placeholder values for the environment variables the handlers read when they are imported
+handler_environment = {
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_LAMBDA_FUNCTION_NAME": "benchmark",
+    "ISSUER_URL": "https://issuer.example.com",
+    "SECRET_KEY_ID": "benchmark",
+    "USER_TABLE": "benchmark",
+    "GOOGLE_PLAY_APP_ID": "1234567890",
+    "GOOGLE_PLAY_CLIENT_SECRET_ARN": "benchmark",
+    "STEAM_WEB_API_KEY_SECRET_ARN": "benchmark",
+    "COGNITO_USER_POOL_ID": "us-east-1_benchmark",
+    "COGNITO_APP_CLIENT_ID": "benchmark"
+}
+
+# Amount of most expensive imports listed per handler
+top_imports = 8
+
+# Imports the module in a new process, returns the import times as (cumulative_us, module) tuples and the peak memory in KB
+def profile_import(module):
+    code = "import resource, time; start = time.perf_counter(); import " + module + "; " \
+           "print((time.perf_counter() - start) * 1000); print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+    environment = dict(os.environ)
+    environment.update(handler_environment)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=lambda_folder, env=environment, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception("Importing " + module + " failed: " + result.stderr.strip().splitlines()[-1])
+
+    # Lines are in the format "import time: self [us] | cumulative | imported package", nested imports indented by two spaces per level
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Drop the single space following the separator, keeping the indentation
+        imports.append((int(self_us), int(cumulative_us), name[1:].rstrip()))
+
+    init_ms, max_rss_kb = result.stdout.split()
+    return float(init_ms), int(max_rss_kb), imports
+
+def main():
+    modules = sys.argv[1:] if len(sys.argv) > 1 else handlers
+    for module in modules:
+        init_ms, max_rss_kb, imports = profile_import(module)
+        print(f"{module}: init {init_ms:.1f} ms, peak memory {max_rss_kb / 1024:.1f} MB")
+
+        # The imports made directly by the handler are one level below it, nested imports are included in their cumulative time
+        handler_self_us = 0
+        direct_imports = []
+        for self_us, cumulative_us, name in imports:
+            if name.strip() == module and not name.startswith(" "):
+                handler_self_us = self_us
+            elif name.startswith("  ") and not name.startswith("   "):
+                direct_imports.append((cumulative_us, name.strip()))
+
+        for cumulative_us, name in sorted(direct_imports, reverse=True)[:top_imports]:
+            print(f"    {cumulative_us / 1000:>8.1f} ms  {name}")
+        # Module level code of the handler, such as creating boto3 clients and Powertools utilities
+        print(f"    {handler_self_us / 1000:>8.1f} ms  ({module} module level code)")
+
+if __name__ == "__main__":
+    main()
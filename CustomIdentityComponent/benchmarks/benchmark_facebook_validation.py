@@ -0,0 +1,100 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Latency benchmark for the Facebook token validation of login_with_facebook
+# Runs a local stub of the Graph API that answers the user and app requests after a fixed delay (standing in for the internet round trip),
+# and compares the previous sequential requests with the concurrent requests of validate_facebook_token, with and without a cached app validation
+# Usage: python benchmark_facebook_validation.py [iterations] [graph_delay_ms]
+
+import http.server
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+facebook_app_id = "1234567890"
+os.environ.setdefault("FACEBOOK_APP_ID", facebook_app_id)
+os.environ.setdefault("FACEBOOK_USER_TABLE", "benchmark")
+os.environ.setdefault("ISSUER_URL", "https://issuer.example.com")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("POWERTOOLS_TRACE_DISABLED", "1")
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import login_with_facebook
+import partner_http
+
+# Partner metrics are written to stdout as CloudWatch embedded metrics, skip them so they don't mix with the results
+partner_http.record_partner_metric = lambda *args: None
+
+# Delay of each Graph API response in seconds, set from the command line
+graph_delay = 0.05
+
+# Answers /app with our app ID and any other path with a user of that ID
+class GraphStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(graph_delay)
+        path = self.path.split("?")[0].strip("/")
+        body = json.dumps({"id": facebook_app_id, "name": "benchmark"} if path == "app" else {"id": path, "name": "player"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_graph_stub():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), GraphStubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:" + str(server.server_port) + "/"
+
+# The previous implementation: the user request and then the app request
+def validate_sequentially(facebook_user_id, facebook_auth_token):
+    return login_with_facebook.get_facebook_user(facebook_user_id, facebook_auth_token), login_with_facebook.get_facebook_app(facebook_auth_token)
+
+def validate_without_cache(facebook_user_id, facebook_auth_token):
+    login_with_facebook.facebook_app_validation_cache.clear()
+    return login_with_facebook.validate_facebook_token(facebook_user_id, facebook_auth_token)
+
+def run(validate, iterations):
+    latencies = []
+    facebook_auth_token = str(uuid.uuid4())
+    for _ in range(iterations):
+        facebook_user_id = str(uuid.uuid4().int)[:15]
+        start = time.perf_counter()
+        user_validation, app_validation = validate(facebook_user_id, facebook_auth_token)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if user_validation["id"] != facebook_user_id or app_validation["id"] != facebook_app_id:
+            raise Exception("Unexpected validation response")
+    latencies.sort()
+    return statistics.mean(latencies), latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99) - 1]
+
+def main():
+    global graph_delay
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    graph_delay = (int(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+    login_with_facebook.facebook_validation_endpoint = start_graph_stub()
+
+    # Open the pooled connections first so every variant runs on warm connections
+    validate_without_cache("1", "warmup")
+
+    print(f"Graph API delay {graph_delay * 1000:.0f} ms, {iterations} validations")
+    print(f"{'variant':<24} {'mean ms':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, validate in [("sequential", validate_sequentially),
+                           ("concurrent", validate_without_cache),
+                           ("concurrent, cached app", login_with_facebook.validate_facebook_token)]:
+        mean, p50, p99 = run(validate, iterations)
+        print(f"{name:<24} {mean:>9.1f} {p50:>9.1f} {p99:>9.1f}")
+    print("Graph requests:", {api: sum(histogram) for api, histogram in partner_http.get_partner_stats()["Facebook"]["latency_histograms"].items()})
+
+if __name__ == "__main__":
+    main()
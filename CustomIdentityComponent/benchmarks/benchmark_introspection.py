@@ -0,0 +1,112 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Throughput benchmark for the introspect_tokens Lambda handler
+# Runs a local stand-in of the issuer endpoint serving jwks.json, and sends batches of access tokens signed by encryption_and_decryption
+# to the handler. Reports verifications per second and key set requests for unique tokens without the verified token cache, and for
+# tokens introspected again with the cache (like a backend service checking the token of each request of a session)
+# Usage: python benchmark_introspection.py [tokens] [batch_size]
+
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+import warnings
+
+from jwcrypto import jwk
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("POWERTOOLS_TRACE_DISABLED", "1")
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "benchmark")
+os.environ.setdefault("POWERTOOLS_METRICS_DISABLED", "1")
+os.environ.setdefault("POWERTOOLS_LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+jwks_body = b""
+jwks_requests = 0
+
+# Serves jwks.json like the issuer bucket behind CloudFront
+class JwksStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        global jwks_requests
+        jwks_requests += 1
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Cache-Control", "public, max-age=300")
+        self.send_header("Content-Length", str(len(jwks_body)))
+        self.end_headers()
+        self.wfile.write(jwks_body)
+
+    def log_message(self, format, *args):
+        pass
+
+server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), JwksStubHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+issuer_url = "http://127.0.0.1:" + str(server.server_address[1])
+os.environ["ISSUER_URL"] = issuer_url
+
+import encryption_and_decryption
+import introspect_tokens
+import partner_http
+import provider_key_cache
+
+# Metrics are written to stdout as CloudWatch embedded metrics, skip them so they don't mix with the results
+partner_http.record_partner_metric = lambda *args: None
+introspect_tokens.metrics.add_metric = lambda **kwargs: None
+warnings.filterwarnings("ignore", message="No application metrics to publish")
+
+def introspect(tokens, batch_size):
+    active_tokens = 0
+    for index in range(0, len(tokens), batch_size):
+        event = {"body": json.dumps({"tokens": tokens[index:index + batch_size]})}
+        response = introspect_tokens.lambda_handler(event, None)
+        active_tokens += sum(1 for result in json.loads(response["body"])["results"] if result["active"])
+    return active_tokens
+
+def measure(name, tokens, batch_size):
+    global jwks_requests
+    jwks_requests = 0
+    start = time.perf_counter()
+    active_tokens = introspect(tokens, batch_size)
+    elapsed = time.perf_counter() - start
+    if active_tokens != len(tokens):
+        raise Exception(name + ": " + str(len(tokens) - active_tokens) + " tokens failed to verify")
+    print(f"{name:<36} {len(tokens) / elapsed:>16.0f} {jwks_requests:>14}")
+
+# A new Lambda environment: no parsed keys and an empty verified token cache
+def reset_caches(verified_token_cache_size):
+    provider_key_cache.key_sets.clear()
+    encryption_and_decryption.verified_token_cache.clear()
+    encryption_and_decryption.verified_token_cache_size = verified_token_cache_size
+
+def main():
+    global jwks_body
+    token_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    introspect_tokens.introspection_max_tokens = max(introspect_tokens.introspection_max_tokens, batch_size)
+
+    key = jwk.JWK.generate(kty='RSA', size=2048, alg='RS256', use='sig', kid=str(uuid.uuid4()))
+    jwks_body = json.dumps({"keys": [json.loads(key.export_public())]}).encode()
+    private_key = key.export_private()
+    tokens = [encryption_and_decryption.encrypt_payload({"sub": str(uuid.uuid4())}, private_key, "authenticated", "gamebackend", 900, "authenticated")[0]
+              for _ in range(token_count)]
+
+    print(f"{token_count} tokens in batches of {batch_size}")
+    print(f"{'':<36} {'verifications/sec':>16} {'jwks requests':>14}")
+    reset_caches(0)
+    measure("no token cache, cold keys", tokens, batch_size)
+    measure("no token cache, warm keys", tokens, batch_size)
+    reset_caches(len(tokens))
+    measure("token cache, first introspection", tokens, batch_size)
+    measure("token cache, repeat introspection", tokens, batch_size)
+    measure("token cache, one token at a time", tokens, 1)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Benchmark of the offline token verifier (token_verifier/custom_identity_verifier) for a game server verifying the access tokens of all
+# the players of a match
+# Runs a local stand-in of the issuer endpoint serving jwks.json after a fixed delay (standing in for the internet round trip) and compares
+# fetching the keys for every token, verifying the tokens one by one with a shared JwksCache, and verify_batch. Also verifies the match
+# from many threads at once on a cold cache to check they share one key set request
+# Usage: python benchmark_match_verification.py [players] [jwks_delay_ms]
+
+import hashlib
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+import jwt
+from jwcrypto import jwk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "token_verifier"))
+
+from custom_identity_verifier import JwksCache, TokenVerifier
+
+# Delay of each jwks.json response in seconds, set from the command line
+jwks_delay = 0.05
+
+jwks_body = b""
+jwks_requests = 0
+
+# Serves jwks.json with an ETag and Cache-Control like the issuer bucket behind CloudFront
+class JwksStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        global jwks_requests
+        jwks_requests += 1
+        time.sleep(jwks_delay)
+        etag = '"' + hashlib.md5(jwks_body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Cache-Control", "public, max-age=300")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(jwks_body)))
+        self.end_headers()
+        self.wfile.write(jwks_body)
+
+    def log_message(self, format, *args):
+        pass
+
+def create_tokens(issuer_url, players):
+    global jwks_body
+    key = jwk.JWK.generate(kty="RSA", size=2048, alg="RS256", use="sig", kid=str(uuid.uuid4()))
+    jwks_body = json.dumps({"keys": [json.loads(key.export_public())]}).encode()
+    private_key = key.export_to_pem(private_key=True, password=None)
+    current_time = int(time.time())
+    tokens = []
+    for _ in range(players):
+        payload = {"sub": str(uuid.uuid4()), "iss": issuer_url, "aud": "gamebackend", "scope": "authenticated",
+                   "iat": current_time, "nbf": current_time, "exp": current_time + 900}
+        tokens.append(jwt.encode(payload, private_key, algorithm="RS256", headers={"kid": key.get("kid")}))
+    return tokens
+
+def measure(name, verify_match):
+    global jwks_requests
+    jwks_requests = 0
+    start = time.perf_counter()
+    valid_count = verify_match()
+    duration = (time.perf_counter() - start) * 1000
+    print(f"{name:<34} {duration:>10.1f} {jwks_requests:>14} {valid_count:>6}")
+
+def main():
+    global jwks_delay
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    jwks_delay = (int(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), JwksStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    issuer_url = "http://127.0.0.1:" + str(server.server_address[1])
+    tokens = create_tokens(issuer_url, players)
+
+    # Fetching the keys for every token, like a verifier without a key cache
+    def verify_uncached():
+        valid_count = 0
+        for token in tokens:
+            jwks_cache = JwksCache(issuer_url)
+            TokenVerifier(issuer_url, jwks_cache=jwks_cache).verify(token)
+            valid_count += 1
+        return valid_count
+
+    def verify_one_by_one():
+        verifier = TokenVerifier(issuer_url)
+        for token in tokens:
+            verifier.verify(token)
+        return len(tokens)
+
+    def verify_batch():
+        return sum(1 for result in TokenVerifier(issuer_url).verify_batch(tokens) if result.valid)
+
+    # Every player's connection verified on its own thread against one cold cache
+    def verify_threads():
+        verifier = TokenVerifier(issuer_url)
+        results = [None] * len(tokens)
+        def verify(index):
+            results[index] = verifier.verify(tokens[index])
+        threads = [threading.Thread(target=verify, args=(index,)) for index in range(len(tokens))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(1 for claims in results if claims != None)
+
+    warm_verifier = TokenVerifier(issuer_url)
+    warm_verifier.jwks_cache.prefetch()
+    def verify_batch_warm():
+        return sum(1 for result in warm_verifier.verify_batch(tokens) if result.valid)
+
+    print(f"{players} players, jwks.json delay {jwks_delay * 1000:.0f} ms")
+    print(f"{'':<34} {'total ms':>10} {'jwks requests':>14} {'valid':>6}")
+    measure("key set fetched per token", verify_uncached)
+    measure("shared cache, one by one", verify_one_by_one)
+    measure("verify_batch, cold cache", verify_batch)
+    measure("thread per player, cold cache", verify_threads)
+    measure("verify_batch, warm cache", verify_batch_warm)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
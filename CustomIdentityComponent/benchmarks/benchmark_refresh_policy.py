@@ -0,0 +1,103 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Throughput benchmark for the refresh token reissue policies of refresh_access_token
+# Runs the refresh_access_token handler with the "always" and "sliding" policies against a local key (no Secrets Manager or network calls)
+# and reports the refreshes per second and the tokens signed per refresh. The sliding policy is also checked to reissue the refresh token
+# after a key rotation and close to its expiration
+# Usage: python benchmark_refresh_policy.py [iterations]
+
+import json
+import os
+import sys
+import time
+import uuid
+
+from jwcrypto import jwk
+
+issuer_url = "https://issuer.example.com"
+os.environ.setdefault("ISSUER_URL", issuer_url)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("POWERTOOLS_TRACE_DISABLED", "1")
+os.environ.setdefault("POWERTOOLS_LOG_LEVEL", "WARNING")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import encryption_and_decryption
+import refresh_access_token
+
+# Serves the private key from memory in place of the Secrets Manager secret
+class LocalPrivateKey:
+
+    def __init__(self, key):
+        self.set_key(key)
+
+    def set_key(self, key):
+        self.value = key.export_private()
+        self.version_id = key.get('kid')
+
+    def get(self):
+        return self.value, self.version_id
+
+def generate_key():
+    return jwk.JWK.generate(kty='RSA', size=2048, alg='RS256', use='sig', kid=str(uuid.uuid4()))
+
+def publish_keys(keys):
+    encryption_and_decryption.get_jwks_key_set(issuer_url).load_key_set({"keys": [json.loads(key.export_public()) for key in keys]})
+
+def refresh(refresh_token):
+    response = refresh_access_token.lambda_handler({"queryStringParameters": {"refresh_token": refresh_token}}, None)
+    if response['statusCode'] != 200:
+        raise Exception("Refresh failed: " + response['body'])
+    return json.loads(response['body'])
+
+# Counts the signed tokens, every token is signed by encrypt_payload
+signed_tokens = 0
+encrypt_payload = encryption_and_decryption.encrypt_payload
+
+def counting_encrypt_payload(*args):
+    global signed_tokens
+    signed_tokens += 1
+    return encrypt_payload(*args)
+
+encryption_and_decryption.encrypt_payload = counting_encrypt_payload
+
+def run_policy(policy, refresh_token, iterations):
+    refresh_access_token.refresh_token_reissue_policy = policy
+    signed_tokens_before = signed_tokens
+    start = time.perf_counter()
+    for _ in range(iterations):
+        refresh_token = refresh(refresh_token)['refresh_token']
+    elapsed = time.perf_counter() - start
+    return iterations / elapsed, (signed_tokens - signed_tokens_before) / iterations
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    key = generate_key()
+    private_key = LocalPrivateKey(key)
+    encryption_and_decryption.private_key_secret = private_key
+    publish_keys([key])
+    _, refresh_token, _, _ = encryption_and_decryption.encrypt({"sub": str(uuid.uuid4())}, "authenticated")
+
+    print(f"{'policy':<10} {'refreshes/sec':>14} {'tokens signed/refresh':>22}")
+    for policy in ["always", "sliding"]:
+        refreshes_per_second, tokens_signed = run_policy(policy, refresh_token, iterations)
+        print(f"{policy:<10} {refreshes_per_second:>14.0f} {tokens_signed:>22.2f}")
+
+    # A refresh token signed with a previous key is reissued with the current key, keeping its expiration
+    previous_key_token = refresh_token
+    previous_exp = encryption_and_decryption.decrypt_refresh_token(previous_key_token)['exp']
+    new_key = generate_key()
+    private_key.set_key(new_key)
+    publish_keys([key, new_key])
+    reissued_token = refresh(previous_key_token)['refresh_token']
+    reissued = encryption_and_decryption.decrypt_refresh_token(reissued_token)
+    print("Reissued after key rotation:", encryption_and_decryption.get_token_kid(reissued_token) == new_key.get('kid') and reissued['exp'] == previous_exp)
+
+    # A refresh token within the reissue window gets a new full expiration
+    refresh_access_token.refresh_token_reissue_window = encryption_and_decryption.refresh_token_expiration_days * 24 * 60 * 60
+    reissued_exp = encryption_and_decryption.decrypt_refresh_token(refresh(previous_key_token)['refresh_token'])['exp']
+    print("Reissued with a new expiration close to expiry:", reissued_exp > previous_exp)
+
+if __name__ == "__main__":
+    main()
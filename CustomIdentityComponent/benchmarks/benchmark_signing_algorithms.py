@@ -0,0 +1,50 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Benchmark for sign and verify throughput of the signing algorithms supported by generate_keys
+# Signs with encryption_and_decryption.encrypt_payload and verifies with decrypt_payload using a local key set (no network calls)
+# Usage: python benchmark_signing_algorithms.py [iterations]
+
+import json
+import os
+import sys
+import time
+import uuid
+
+from jwcrypto import jwk
+
+issuer_url = "https://issuer.example.com"
+os.environ.setdefault("ISSUER_URL", issuer_url)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import encryption_and_decryption
+from generate_keys import key_generation_parameters
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    # Generate one key per algorithm and publish all of them in the same key set
+    keys = {}
+    for algorithm, parameters in key_generation_parameters.items():
+        keys[algorithm] = jwk.JWK.generate(alg=algorithm, use='sig', kid=str(uuid.uuid4()), **parameters)
+    encryption_and_decryption.get_jwks_key_set(issuer_url).load_key_set({"keys": [json.loads(key.export_public()) for key in keys.values()]})
+
+    print(f"{'algorithm':<10} {'signs/sec':>12} {'verifies/sec':>14} {'token bytes':>12}")
+    for algorithm, key in keys.items():
+        private_key = key.export_private()
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            token, _ = encryption_and_decryption.encrypt_payload({"sub": str(uuid.uuid4())}, private_key, "authenticated", "gamebackend", 900, "authenticated")
+        signs_per_second = iterations / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            if encryption_and_decryption.decrypt_payload(token, issuer_url, "gamebackend") == None:
+                raise Exception(algorithm + " token failed to verify")
+        verifies_per_second = iterations / (time.perf_counter() - start)
+
+        print(f"{algorithm:<10} {signs_per_second:>12.0f} {verifies_per_second:>14.0f} {len(token):>12}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Micro-benchmark for token verification throughput in encryption_and_decryption.decrypt_payload
+# Compares the previous double jwt.decode path with the current single-parse path using a local key set (no network calls)
+# Usage: python benchmark_token_verification.py [iterations]
+
+import json
+import os
+import sys
+import time
+import uuid
+
+import jwt
+from jwcrypto import jwk
+
+issuer_url = "https://issuer.example.com"
+os.environ.setdefault("ISSUER_URL", issuer_url)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import encryption_and_decryption
+
+# The verification path before the single-parse change: a full unverified decode, issuer check and kid lookup, then a verified decode
+def legacy_decrypt_payload(encoded_payload, issuer_url, audience, jwks_key_set):
+    decoded_non_verified = jwt.decode(encoded_payload, options={"verify_signature": False}, audience=audience, algorithms=["RS256"])
+    if decoded_non_verified["iss"] != issuer_url:
+        return None
+    decryption_jwks_key = None
+    for key in jwks_key_set["keys"]:
+        if key["kid"] == decoded_non_verified["kid"]:
+            decryption_jwks_key = key
+    if decryption_jwks_key == None:
+        return None
+    decryption_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(decryption_jwks_key))
+    return jwt.decode(encoded_payload, decryption_key, audience=audience, algorithms=["RS256"])
+
+def measure(name, iterations, verify):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        if verify() == None:
+            raise Exception(name + " failed to verify the token")
+    elapsed = time.perf_counter() - start
+    print(f"{name:<30} {iterations / elapsed:>10.0f} verifies/sec")
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    # Generate a key pair the same way generate_keys does, and publish a key set with a previous key too
+    key = jwk.JWK.generate(kty='RSA', size=2048, alg='RS256', use='sig', kid=str(uuid.uuid4()))
+    previous_key = jwk.JWK.generate(kty='RSA', size=2048, alg='RS256', use='sig', kid=str(uuid.uuid4()))
+    jwks_key_set = {"keys": [json.loads(key.export_public()), json.loads(previous_key.export_public())]}
+    encryption_and_decryption.get_jwks_key_set(issuer_url).load_key_set(jwks_key_set)
+
+    token, _ = encryption_and_decryption.encrypt_payload({"sub": str(uuid.uuid4())}, key.export_private(), "authenticated", "gamebackend", 900, "authenticated")
+
+    measure("double decode (before)", iterations, lambda: legacy_decrypt_payload(token, issuer_url, "gamebackend", jwks_key_set))
+    measure("single parse (after)", iterations, lambda: encryption_and_decryption.decrypt_payload(token, issuer_url, "gamebackend"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Simulation of the verifier key caches across a key rotation, for the "immediate" and "staged" rotation modes of generate_keys
+# Runs generate_keys against in-memory stand-ins of the issuer bucket and the private key secret, and a set of verifiers using the
+# JwksKeySet cache of provider_key_cache against the published jwks.json, on a simulated clock. Every verifier verifies tokens signed
+# with the current signing key each second, and the simulation counts the tokens with a kid missing from the verifier's cached keys
+# (cache misses, each forcing a key set download), the downloads and 304 revalidations, and the tokens that failed verification
+# Usage: python simulate_key_rotation.py [verifiers] [rotation_time_seconds]
+
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import uuid
+from urllib.parse import urlparse
+
+issuer_endpoint = "https://issuer.example.com"
+os.environ.setdefault("ISSUER_BUCKET", "issuer-bucket")
+os.environ.setdefault("ISSUER_ENDPOINT", issuer_endpoint)
+os.environ.setdefault("SECRET_KEY_ID", "private-key")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import generate_keys
+import partner_http
+import provider_key_cache
+
+# Simulated time in seconds, used in place of the time module by generate_keys and provider_key_cache
+class SimulatedClock:
+
+    def __init__(self):
+        self.current_time = 1700000000
+
+    def time(self):
+        return self.current_time
+
+clock = SimulatedClock()
+generate_keys.time = clock
+provider_key_cache.time = clock
+
+# Issuer bucket with the ETag from the content, like S3
+class LocalBucket:
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Body, Bucket, Key, ContentType, CacheControl=None, Metadata=None):
+        self.objects[Key] = (Body, hashlib.md5(Body.encode()).hexdigest(), CacheControl)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise Exception("NoSuchKey: " + Key)
+        return {'Body': io.BytesIO(self.objects[Key][0].encode())}
+
+# Private key secret with staging labels, like Secrets Manager
+class LocalSecret:
+
+    def __init__(self):
+        self.versions = {}
+
+    def move_stage(self, stage, version_id):
+        for stages in self.versions.values():
+            stages[1].discard(stage)
+        if version_id != None:
+            self.versions[version_id][1].add(stage)
+
+    def put_secret_value(self, SecretId, SecretString, VersionStages=["AWSCURRENT"]):
+        version_id = str(uuid.uuid4())
+        self.versions[version_id] = (SecretString, set())
+        for stage in VersionStages:
+            self.update_secret_version_stage(SecretId, stage, MoveToVersionId=version_id)
+
+    def describe_secret(self, SecretId):
+        return {'VersionIdsToStages': {version_id: list(stages) for version_id, (_, stages) in self.versions.items() if stages}}
+
+    def get_secret_value(self, SecretId, VersionId=None):
+        if VersionId == None:
+            VersionId = next(version_id for version_id, (_, stages) in self.versions.items() if "AWSCURRENT" in stages)
+        return {'SecretString': self.versions[VersionId][0]}
+
+    def update_secret_version_stage(self, SecretId, VersionStage, MoveToVersionId=None, RemoveFromVersionId=None):
+        if VersionStage == "AWSCURRENT" and MoveToVersionId != None:
+            previous_version_id = next((version_id for version_id, (_, stages) in self.versions.items() if "AWSCURRENT" in stages), None)
+            self.move_stage("AWSPREVIOUS", previous_version_id)
+        if RemoveFromVersionId != None:
+            self.versions[RemoveFromVersionId][1].discard(VersionStage)
+        if MoveToVersionId != None:
+            self.move_stage(VersionStage, MoveToVersionId)
+
+    # kid of the key the login functions sign with
+    def get_signing_kid(self):
+        return json.loads(self.get_secret_value("private-key")['SecretString'])['kid']
+
+class LocalResponse:
+
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception("HTTP " + str(self.status_code))
+
+bucket = None
+
+# Serves the issuer bucket to the verifiers, with 304 responses for a matching If-None-Match
+def get_from_bucket(partner, api, url, headers={}, **kwargs):
+    body, etag, cache_control = bucket.objects[urlparse(url).path.lstrip("/")]
+    response_headers = {"ETag": etag, "Cache-Control": cache_control}
+    if headers.get("If-None-Match") == etag:
+        return LocalResponse(304, None, response_headers)
+    return LocalResponse(200, body, response_headers)
+
+partner_http.get = get_from_bucket
+
+def rotate(secret):
+    generate_keys.rotate_and_publish_keys(bucket, secret)
+
+def simulate(mode, verifier_count, rotation_time, duration):
+    global bucket
+    generate_keys.key_rotation_mode = mode
+    bucket = LocalBucket()
+    secret = LocalSecret()
+    start_time = clock.current_time
+
+    # First deployment, then all verifiers load the keys and revalidate them at a random point of the cache lifetime
+    rotate(secret)
+    verifiers = []
+    for _ in range(verifier_count):
+        key_set = provider_key_cache.JwksKeySet(issuer_endpoint + "/.well-known/jwks.json")
+        key_set.refresh()
+        key_set.expires_at = clock.current_time + random.uniform(0, generate_keys.jwks_max_age)
+        key_set.last_refresh = clock.current_time - provider_key_cache.jwks_min_refresh_interval
+        verifiers.append(key_set)
+
+    misses = 0
+    failures = 0
+    verifications = 0
+    for second in range(duration):
+        clock.current_time = start_time + second
+        if second == rotation_time:
+            rotate(secret)
+        signing_kid = secret.get_signing_kid()
+        for key_set in verifiers:
+            verifications += 1
+            if signing_kid not in key_set.keys:
+                misses += 1
+            if key_set.get_key(signing_kid) == None:
+                failures += 1
+
+    clock.current_time = start_time + duration
+    downloads = sum(key_set.fetch_count - key_set.not_modified_count for key_set in verifiers) - verifier_count
+    revalidations = sum(key_set.not_modified_count for key_set in verifiers)
+    published_keys = len(json.loads(bucket.objects['.well-known/jwks.json'][0])['keys'])
+    return verifications, misses, downloads, revalidations, failures, published_keys
+
+def main():
+    verifier_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rotation_time = int(sys.argv[2]) if len(sys.argv) > 2 else 900
+    duration = rotation_time + generate_keys.jwks_max_age * 4
+    random.seed(1)
+
+    print(f"{verifier_count} verifiers, one token per verifier per second, rotation at {rotation_time} s, {duration} s simulated")
+    print(f"{'mode':<10} {'verifications':>14} {'cache misses':>13} {'downloads':>10} {'304s':>7} {'failures':>9} {'published keys':>15}")
+    for mode in ["immediate", "staged"]:
+        verifications, misses, downloads, revalidations, failures, published_keys = simulate(mode, verifier_count, rotation_time, duration)
+        print(f"{mode:<10} {verifications:>14} {misses:>13} {downloads:>10} {revalidations:>7} {failures:>9} {published_keys:>15}")
+
+if __name__ == "__main__":
+    main()
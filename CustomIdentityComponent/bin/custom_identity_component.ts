@@ -35,6 +35,27 @@ const googlePlayClientSecretArn = ""
 const facebookAppId = ""
 // Set this vale to true if you want to provision Amazon Cognito as your identity provider
 const cognito = ""
+// Algorithm used for signing the tokens: "RS256" (default), "ES256" or "EdDSA". A new algorithm is taken into use on the next key rotation,
+// and the previous RS256 key stays published until the rotation after that. NOTE: API Gateway JWT authorizers only support RSA keys
+const signingAlgorithm = "RS256"
+// Secret for new guest users: "random" (default, validated against the user table) or "hmac" (derived from the user ID with a server key and validated
+// without reading the user table). In "hmac" mode returning guests with random secrets are migrated to derived secrets when they log in
+const guestSecretMode = "random"
+// The GuestSecretKey secret is only created in "hmac" mode. When switching from "hmac" back to "random", set this to true to keep the key, so guests
+// with derived secrets can still log in
+const keepGuestSecretKey = false
+// When the refresh-access-token endpoint signs a new refresh token: "always" (default, on every refresh) or "sliding" (the received refresh token
+// is returned with a new access token, and a new one is signed only when it was signed with a previous key or expires within a day, up to 30 days from the login)
+const refreshTokenReissuePolicy = "always"
+// Where the login endpoints count requests per client IP to shed a client's requests over the rate limit with a 429 before doing any work:
+// "local" (default, a token bucket in each Lambda environment), "dynamodb" (a counter table shared by all environments) or "none"
+const admissionControlStore = "local"
+// How the signing keys are rotated: "immediate" (default, the new key is published and used for signing right away) or "staged" (the new key is
+// published one rotation ahead and used for signing from the next rotation, so verifiers already have it cached when the first token is signed with it)
+const keyRotationMode = "immediate"
+// Claims of the signed tokens: "standard" (default) or "compact" (short scope codes "g" and "a", no kid in the payload, no nbf, and refresh tokens
+// without the refresh scope). Backends verifying the scopes have to accept the scope codes, for example authorizationScopes: ["guest", "authenticated", "g", "a"]
+const claimsProfile = "standard"
 
 const app = new cdk.App();
 var identityComponentStack = new CustomIdentityComponentStack(app, 'CustomIdentityComponentStack', {
@@ -47,7 +68,14 @@ var identityComponentStack = new CustomIdentityComponentStack(app, 'CustomIdenti
     googlePlayAppId: googlePlayAppid,
     googlePlayClientSecretArn: googlePlayClientSecretArn,
     facebookAppId: facebookAppId,
-    cognito: cognito
+    cognito: cognito,
+    signingAlgorithm: signingAlgorithm,
+    guestSecretMode: guestSecretMode,
+    keepGuestSecretKey: keepGuestSecretKey,
+    refreshTokenReissuePolicy: refreshTokenReissuePolicy,
+    admissionControlStore: admissionControlStore,
+    keyRotationMode: keyRotationMode,
+    claimsProfile: claimsProfile
   });
   
   // Apply all the tags in the tags object to the stack
@@ -0,0 +1,126 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Admission control for the login endpoints. Requests are counted per endpoint and client IP address, and the ones over the limit are
+# shed with a 429 response before any token signing, partner API calls or DynamoDB writes, so a client stuck in a retry loop
+# can't make every retry run the full login
+# The counters are kept in one of two stores, set with ADMISSION_CONTROL_STORE:
+# * "local": a token bucket per client in the Lambda environment. No extra calls, but each environment has its own buckets, so a client
+#   spread over several environments gets the limit per environment
+# * "dynamodb": a fixed window counter per client in the ADMISSION_CONTROL_TABLE table, shared by all environments, for one UpdateItem per request
+
+import boto3
+from botocore.config import Config
+import math
+import os
+import time
+from collections import OrderedDict
+from aws_lambda_powertools import single_metric
+from aws_lambda_powertools.metrics import MetricUnit
+
+# Counter store: "local" (default, as in the CDK app), "dynamodb", or "none" to admit all requests
+admission_control_store = os.environ.get('ADMISSION_CONTROL_STORE', 'local')
+
+# Sustained requests per second and burst size admitted per client, set with ADMISSION_CONTROL_RATE and ADMISSION_CONTROL_BURST
+admission_control_rate = float(os.environ.get('ADMISSION_CONTROL_RATE', '5'))
+admission_control_burst = int(os.environ.get('ADMISSION_CONTROL_BURST', '20'))
+
+# Maximum amount of clients with a local token bucket, the least recently seen clients are dropped first
+local_bucket_max_size = 10000
+
+# (tokens, updated_at) by client key, in least recently used order
+local_buckets = OrderedDict()
+
+# DynamoDB table of request counters, created on first use
+admission_control_table = None
+
+# Returns the client IP address of an API Gateway proxy event, or None
+def get_client_ip(event):
+    request_context = event.get('requestContext') or {}
+    if 'identity' in request_context and request_context['identity'] != None:
+        return request_context['identity'].get('sourceIp')
+    if 'http' in request_context and request_context['http'] != None:
+        return request_context['http'].get('sourceIp')
+    return None
+
+# Takes a token from the client's bucket, returns the seconds until a token is available or 0 if the request is admitted
+def admit_local(client_key):
+    current_time = time.time()
+    tokens, updated_at = local_buckets.get(client_key, (admission_control_burst, current_time))
+    tokens = min(admission_control_burst, tokens + (current_time - updated_at) * admission_control_rate)
+
+    retry_after = 0
+    if tokens >= 1:
+        tokens -= 1
+    else:
+        retry_after = (1 - tokens) / admission_control_rate
+    local_buckets[client_key] = (tokens, current_time)
+    local_buckets.move_to_end(client_key)
+    while len(local_buckets) > local_bucket_max_size:
+        local_buckets.popitem(last=False)
+    return retry_after
+
+def get_admission_control_table():
+    global admission_control_table
+    if admission_control_table == None:
+        dynamodb = boto3.resource('dynamodb', config=Config(connect_timeout=1, read_timeout=1))
+        admission_control_table = dynamodb.Table(os.environ['ADMISSION_CONTROL_TABLE'])
+    return admission_control_table
+
+# Counts the request in the client's current window, which admits the burst size of requests per the time it takes to earn them at the rate.
+# Returns the seconds until the next window if the window is full, or 0 if the request is admitted
+def admit_dynamodb(client_key):
+    window_length = max(admission_control_burst / admission_control_rate, 1)
+    current_time = time.time()
+    window = int(current_time // window_length)
+    window_end = (window + 1) * window_length
+    response = get_admission_control_table().update_item(
+        Key={'ClientKey': client_key + "#" + str(window)},
+        UpdateExpression="ADD RequestCount :one SET ExpiresAt = if_not_exists(ExpiresAt, :expires_at)",
+        ExpressionAttributeValues={':one': 1, ':expires_at': int(window_end) + 60},
+        ReturnValues="UPDATED_NEW"
+    )
+    if response['Attributes']['RequestCount'] > admission_control_burst:
+        return window_end - current_time
+    return 0
+
+# Returns None if the request is admitted, or a 429 response to return right away. Errors from the store admit the request,
+# so an unavailable counter store doesn't take down the logins
+def check_admission(event, endpoint):
+    if admission_control_store == "none":
+        return None
+    client_ip = get_client_ip(event)
+    if client_ip == None:
+        return None
+
+    client_key = endpoint + "#" + client_ip
+    try:
+        if admission_control_store == "dynamodb":
+            retry_after = admit_dynamodb(client_key)
+        else:
+            retry_after = admit_local(client_key)
+    except Exception as e:
+        print("Error checking admission, admitting the request: ", e)
+        return None
+
+    if retry_after <= 0:
+        return None
+
+    record_shed_metric(endpoint)
+    return {
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Credentials': True,
+            'Retry-After': str(max(math.ceil(retry_after), 1))
+        },
+        'statusCode': 429,
+        'body': 'Error: Too many requests'
+    }
+
+def record_shed_metric(endpoint):
+    try:
+        with single_metric(name="admission_shed", unit=MetricUnit.Count, value=1) as metric:
+            metric.add_dimension(name="endpoint", value=endpoint)
+            metric.add_dimension(name="store", value=admission_control_store)
+    except Exception as e:
+        print("Error recording admission control metrics: ", e)
@@ -2,72 +2,210 @@
 # SPDX-License-Identifier: MIT-0
 
 import json
+import hashlib
 import jwt
-import requests
 import time
 import os
+import uuid
+from itertools import repeat
+from collections import OrderedDict
+
+import provider_key_cache
+import token_revocation
+from secret_provider import BackgroundRefreshingSecret
+from token_lifetimes import access_token_expiration, refresh_token_expiration_days, private_key_refresh_rate
+
+# Private key secret, refreshed in the background ahead of the refresh rate. Created on first use
+private_key_secret = None
+
+# Batches of at least this many payloads are signed in a process pool by encrypt_batch (outside of AWS Lambda only)
+batch_process_pool_threshold = 500
+
+# Private key for encrypt_batch process pool workers, set by the pool initializer
+batch_private_key = None
+
+# Maximum amount of verified tokens cached by decrypt_payload until their expiration, set with VERIFIED_TOKEN_CACHE_SIZE (0 disables the cache)
+verified_token_cache_size = int(os.environ.get('VERIFIED_TOKEN_CACHE_SIZE', '0'))
+
+# Verified token claims by token digest, in least recently used order
+verified_token_cache = OrderedDict()
+
+# Verified token cache counters
+verified_token_cache_hits = 0
+verified_token_cache_misses = 0
+
+# Claims of the signed tokens, set with CLAIMS_PROFILE:
+# * "standard": the kid in the payload as well as the header, nbf, the scope names, and the refresh tokens have the scope "refresh"
+#   and the access token scope in access_token_scope
+# * "compact": the kid only in the header, no nbf (the same as iat), short scope codes, and the refresh tokens only have the access token
+#   scope code in ats. iss and aud are kept as they are, API Gateway JWT authorizers need them
+claims_profile = os.environ.get('CLAIMS_PROFILE', 'standard')
+
+# Scope codes of the compact claims profile, scopes without a code are used as they are
+compact_scope_codes = {"guest": "g", "authenticated": "a"}
+compact_scope_names = {code: scope for scope, code in compact_scope_codes.items()}
+
+# Signing algorithms accepted when verifying tokens, each key is only used with the algorithm of its key type
+supported_signing_algorithms = ["RS256", "ES256", "EdDSA"]
+
+# Returns the cached key set of the issuer. generate_keys publishes jwks.json with a max-age, after which the keys are revalidated
+# with If-None-Match, so refreshes of an unchanged key set are 304 responses without a body to parse
+def get_jwks_key_set(issuer_url):
+    return provider_key_cache.get_key_set(issuer_url + "/.well-known/jwks.json")
+
+def get_token_digest(encoded_payload):
+    return hashlib.sha256(encoded_payload.encode()).hexdigest()
+
+# Returns a copy of the cached claims if the token was already verified for this issuer and audience and hasn't expired
+def get_verified_token(token_digest, issuer_url, audience):
+    global verified_token_cache_hits, verified_token_cache_misses
+
+    cached_entry = verified_token_cache.get(token_digest)
+    if cached_entry != None and cached_entry[0] == issuer_url and cached_entry[1] == audience:
+        if cached_entry[2]["exp"] > time.time():
+            verified_token_cache.move_to_end(token_digest)
+            verified_token_cache_hits += 1
+            return dict(cached_entry[2])
+        # Expired, drop the entry
+        verified_token_cache.pop(token_digest, None)
+
+    verified_token_cache_misses += 1
+    return None
 
-from aws_lambda_powertools.utilities import parameters
+def add_verified_token(token_digest, issuer_url, audience, decoded_token):
+    verified_token_cache[token_digest] = (issuer_url, audience, dict(decoded_token))
+    verified_token_cache.move_to_end(token_digest)
+    while len(verified_token_cache) > verified_token_cache_size:
+        verified_token_cache.popitem(last=False)
 
-# Access token expiration in seconds
-access_token_expiration = 900
+# Removes a token from the verified token cache, so that the next use of the token is fully verified again
+def invalidate_verified_token(encoded_payload):
+    verified_token_cache.pop(get_token_digest(encoded_payload), None)
 
-# Refresh token expiration in days
-# (NOTE: make sure if you increase this that you also increase the rotation of the keys in the CDK app to avoid having a refresh token without a matching public key)
-refresh_token_expiration_days = 6
+def get_verified_token_cache_stats():
+    lookups = verified_token_cache_hits + verified_token_cache_misses
+    return {
+        "hits": verified_token_cache_hits,
+        "misses": verified_token_cache_misses,
+        "hit_rate": verified_token_cache_hits / lookups if lookups > 0 else 0.0,
+        "size": len(verified_token_cache)
+    }
 
-# Private key refresh rate (should be relatively often to pick up new keys after rotation)
-private_key_refresh_rate = 900
+# Signing key parsed from the private key secret, stored as a single (secret_version, private_key, kid, signing_key, algorithm) tuple
+# so that a rotation by generate_keys swaps the whole entry at once
+signing_key_cache = None
 
-# Current key set from Issuer endpoint
-jwks_key_set = None
+# Signing key cache counters
+signing_key_cache_hits = 0
+signing_key_cache_misses = 0
 
-def is_kid_in_jwks_key_set(kid):
-    global jwks_key_set
+# Returns the private key secret value and its Secrets Manager version ID
+def get_private_key():
+    global private_key_secret
+    if private_key_secret == None:
+        private_key_secret = BackgroundRefreshingSecret(os.environ['SECRET_KEY_ID'], "private_key", private_key_refresh_rate)
+    return private_key_secret.get()
 
-    # If we don't have keys at all, just return False
-    if jwks_key_set == None:
-        return False
-    
-    # Check if the key is in the set already
-    for key in jwks_key_set["keys"]:
-        if key["kid"] == kid:
-            return True
-    return False
-
-def refresh_jwks_key_set(issuer_url):
-    global jwks_key_set
-    # get jwks key set from Issuer endpoint
-    response = requests.get(issuer_url + "/.well-known/jwks.json")
-    jwks_key_set = response.json()
-
-def get_jwks_key_with_kid(kid):
-    global jwks_key_set
-
-    # If we don't have keys at all, just return None
-    if jwks_key_set == None:
-        return None
+# Returns the kid, the PyJWT signing key and the signing algorithm for the private key secret, parsing the key only when the secret changes
+# The entry is matched with the Secrets Manager version when it's known, and otherwise with the secret value (a rotation always writes a new key with a new kid)
+def get_signing_key(private_key, secret_version=None):
+    global signing_key_cache, signing_key_cache_hits, signing_key_cache_misses
 
-    # Check if the key is in the set already
-    for key in jwks_key_set["keys"]:
-        if key["kid"] == kid:
-            return key
-    return None
+    cached_entry = signing_key_cache
+    if cached_entry != None and ((secret_version != None and cached_entry[0] == secret_version) or cached_entry[1] == private_key):
+        signing_key_cache_hits += 1
+        return cached_entry[2], cached_entry[3], cached_entry[4]
 
-def encrypt(payload, scope, custom_refresh_token_exp_value=None):
+    signing_key_cache_misses += 1
+    # The algorithm comes from the key ("alg" set by generate_keys, RS256 for RSA keys without one)
+    signing_jwk = jwt.PyJWK(json.loads(private_key))
+    signing_key_cache = (secret_version, private_key, signing_jwk.key_id, signing_jwk.key, signing_jwk.algorithm_name)
+    print("Loaded signing key with kid: ", signing_jwk.key_id, " algorithm: ", signing_jwk.algorithm_name, " version: ", secret_version)
 
-    private_key = parameters.get_secret(os.environ['SECRET_KEY_ID'], max_age=private_key_refresh_rate)
+    return signing_jwk.key_id, signing_jwk.key, signing_jwk.algorithm_name
 
-    # Create both an auth token and a refresh token for returning
-    auth_token, auth_token_expires_in = encrypt_payload(payload, private_key, scope, "gamebackend", access_token_expiration, scope)
+def get_signing_key_cache_stats():
+    return {"hits": signing_key_cache_hits, "misses": signing_key_cache_misses}
 
-    # If we didn't receive a custom exp value, generate one based on our days config, otherwise use the custom one (that is based on previously created refresh token)
-    refresh_token, refresh_token_expires_in = encrypt_payload(payload, private_key, "refresh", "refresh", refresh_token_expiration_days * 24 * 60 * 60, scope, custom_refresh_token_exp_value)
+# session_claims are the claims of the refresh token session (jti and auth_time) carried over from the received refresh token when it's reissued
+def encrypt(payload, scope, custom_refresh_token_exp_value=None, session_claims=None):
+
+    private_key, secret_version = get_private_key()
+    get_signing_key(private_key, secret_version)
+
+    return encrypt_with_private_key(payload, private_key, scope, custom_refresh_token_exp_value, session_claims)
+
+def encrypt_with_private_key(payload, private_key, scope, custom_refresh_token_exp_value=None, session_claims=None):
+
+    # Create both an auth token and a refresh token for returning
+    auth_token, auth_token_expires_in = encrypt_access_token(payload, private_key, scope)
+    refresh_token, refresh_token_expires_in = encrypt_refresh_token(payload, private_key, scope, custom_refresh_token_exp_value, session_claims)
     
     # Return the tokens and their expiration in seconds
     return auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in
 
-def encrypt_payload(payload, private_key, scope, audience, expiration_in_seconds, access_token_scope, custom_refresh_token_exp_value=None):
+# Access and refresh tokens separately, so they can also be signed concurrently (see login_pipeline). Both add the token claims to the payload
+def encrypt_access_token(payload, private_key, scope):
+    return encrypt_payload(payload, private_key, scope, "gamebackend", access_token_expiration, scope)
+
+def encrypt_refresh_token(payload, private_key, scope, custom_refresh_token_exp_value=None, session_claims=None):
+    # If we didn't receive a custom exp value, generate one based on our days config, otherwise use the custom one (that is based on previously created refresh token)
+    return encrypt_payload(payload, private_key, "refresh", "refresh", refresh_token_expiration_days * 24 * 60 * 60, scope, custom_refresh_token_exp_value, session_claims)
+
+# Returns the kid of the current signing key, tokens with another kid were signed with a previous key
+def get_signing_kid():
+    private_key, secret_version = get_private_key()
+    kid, _, _ = get_signing_key(private_key, secret_version)
+    return kid
+
+# Creates only an access token, for refreshes that keep using the refresh token they received
+def encrypt_access(payload, scope):
+    private_key, secret_version = get_private_key()
+    get_signing_key(private_key, secret_version)
+    return encrypt_access_token(payload, private_key, scope)
+
+# Creates tokens for many payloads (for example bots, load tests or backend service accounts) reading the secret and parsing the key only once
+# Returns a list in the order of the payloads, with either the tokens or an error for each payload
+def encrypt_batch(payloads, scope, max_workers=None):
+
+    private_key, secret_version = get_private_key()
+
+    # Parse the key before signing anything so an invalid secret fails the whole batch right away
+    get_signing_key(private_key, secret_version)
+
+    # Spread large batches over a process pool. Lambda doesn't support the shared memory required by the pool, so sign in process there
+    if len(payloads) >= batch_process_pool_threshold and 'AWS_LAMBDA_FUNCTION_NAME' not in os.environ:
+        # Imported here as the process pool (and multiprocessing) is never used by the Lambda functions
+        from concurrent.futures import ProcessPoolExecutor
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=init_batch_worker, initargs=(private_key,)) as executor:
+                return list(executor.map(encrypt_batch_item, payloads, repeat(scope), chunksize=100))
+        except Exception as e:
+            print("Process pool not available, signing the batch in process: ", e)
+
+    return [encrypt_batch_item(payload, scope, private_key) for payload in payloads]
+
+def init_batch_worker(private_key):
+    global batch_private_key
+    batch_private_key = private_key
+
+def encrypt_batch_item(payload, scope, private_key=None):
+    if private_key == None:
+        private_key = batch_private_key
+    try:
+        # Copy the payload as encrypt_payload adds the token claims to it
+        auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = encrypt_with_private_key(dict(payload), private_key, scope)
+    except Exception as e:
+        return {"error": "Failed to encode token: " + str(e)}
+
+    return {
+        "auth_token": auth_token,
+        "refresh_token": refresh_token,
+        "auth_token_expires_in": auth_token_expires_in,
+        "refresh_token_expires_in": refresh_token_expires_in
+    }
+
+def encrypt_payload(payload, private_key, scope, audience, expiration_in_seconds, access_token_scope, custom_refresh_token_exp_value=None, session_claims=None):
 
     # add exp to payload with current time + expiration time in seconds, EXCEPT if we have an existing exp time for a refresh token
     if custom_refresh_token_exp_value == None:
@@ -78,30 +216,41 @@ def encrypt_payload(payload, private_key, scope, audience, expiration_in_seconds
     # add iss to payload from environment variable ISSUER_URL
     payload["iss"] = os.environ['ISSUER_URL']
 
-    # add the kid for validation
-    key_dict = json.loads(private_key)
-    payload["kid"] = key_dict["kid"]
+    # add the kid for validation, the compact profile only has it in the header where verifiers read it
+    kid, signing_key, algorithm = get_signing_key(private_key)
+    compact = claims_profile == "compact"
+    if not compact:
+        payload["kid"] = kid
 
     # We don't have defined what audience will receive the token, so we'll just set it to "gamebackend"
     payload["aud"] = audience
 
     # Not before field and issued field, we just use current time as the token is immediately usable
-    payload["nbf"] = int(time.time())
+    if not compact:
+        payload["nbf"] = int(time.time())
     payload["iat"] = int(time.time())
 
-    # Scope for the request
-    payload["scope"] = scope
-
-    # For refresh tokens, add the access token scope
-    if audience == "refresh":
-        payload["access_token_scope"] = access_token_scope
+    if compact:
+        # Refresh tokens are identified by their audience, and only carry the scope code for the access tokens they create
+        if audience == "refresh":
+            payload.pop("scope", None)
+            payload["ats"] = compact_scope_codes.get(access_token_scope, access_token_scope)
+            payload.update(get_session_claims(session_claims, payload["iat"]))
+        else:
+            payload["scope"] = compact_scope_codes.get(scope, scope)
+    else:
+        # Scope for the request
+        payload["scope"] = scope
 
-    # Get the RSA key that works with the PyJWT library
-    signing_key = jwt.algorithms.RSAAlgorithm.from_jwk(private_key)
+        # For refresh tokens, add the access token scope, and the session claims
+        if audience == "refresh":
+            payload["access_token_scope"] = access_token_scope
+            payload.update(get_session_claims(session_claims, payload["iat"]))
 
-    # Encode the payload with RS256
+    # Encode the payload with the algorithm of the key (RS256 by default), the compact profile leaves out the optional typ header
+    headers = {"kid": kid, "typ": None} if compact else {"kid": kid}
     try:
-        encoded_token = jwt.encode(payload, signing_key, algorithm="RS256", headers={"kid": key_dict["kid"]})
+        encoded_token = jwt.encode(payload, signing_key, algorithm=algorithm, headers=headers)
     except Exception as e:
         # Encoding failed, return None
         print("Error",e)
@@ -113,57 +262,117 @@ def encrypt_payload(payload, private_key, scope, audience, expiration_in_seconds
     # Return the encoded token
     return encoded_token, seconds_to_expiration
 
+# Returns the session claims of a refresh token: the ones of the received refresh token when it's reissued, and new ones for a new session
+# All the refresh tokens of a session share the session ID (jti), so revoking any of them revokes the whole session, and the time of
+# the login (auth_time) that caps how long the session can be extended
+def get_session_claims(session_claims, issued_at):
+    if session_claims == None:
+        session_claims = {}
+    return {
+        "jti": session_claims.get("jti") or str(uuid.uuid4()),
+        "auth_time": session_claims.get("auth_time") or issued_at
+    }
+
+# Returns the access token scope of a verified refresh token of either claims profile
+def get_access_token_scope(decoded_refresh_token):
+    if "ats" in decoded_refresh_token:
+        return compact_scope_names.get(decoded_refresh_token["ats"], decoded_refresh_token["ats"])
+    return decoded_refresh_token["access_token_scope"]
+
+# Returns the kid of a verified token from its header, the compact claims profile doesn't have it in the payload
+def get_token_kid(encoded_payload):
+    return jwt.get_unverified_header(encoded_payload).get("kid")
+
 def decrypt(encoded_payload):
     return decrypt_payload(encoded_payload, os.environ['ISSUER_URL'], "gamebackend")
 
 def decrypt_refresh_token(encoded_payload):
-    return decrypt_payload(encoded_payload, os.environ['ISSUER_URL'], "refresh")
+    decoded_token = decrypt_payload(encoded_payload, os.environ['ISSUER_URL'], "refresh")
+
+    # Reject revoked refresh tokens (tokens created before revocation support don't have a jti and can't be revoked)
+    if decoded_token != None and "jti" in decoded_token and token_revocation.is_revocation_enabled():
+        try:
+            if token_revocation.is_revoked(decoded_token["jti"]):
+                print("Refresh token is revoked: ", decoded_token["jti"])
+                return None
+        except Exception as e:
+            # Don't accept tokens that couldn't be checked
+            print("Error checking refresh token revocation: ", e)
+            return None
+
+    return decoded_token
+
+# Revokes the session of a verified refresh token until all its refresh tokens have expired
+# A token reissued from this one can expire later, but any refresh token of the session issued so far expires within a full refresh token lifetime
+def revoke_refresh_token(encoded_payload, decoded_token):
+    session_expires_at = max(decoded_token["exp"], int(time.time()) + refresh_token_expiration_days * 24 * 60 * 60)
+    token_revocation.revoke(decoded_token["jti"], session_expires_at)
+    invalidate_verified_token(encoded_payload)
+
+# Failure reasons of verify_payload by PyJWT exception, the first matching class is used
+token_failure_reasons = [
+    (jwt.ExpiredSignatureError, "expired"),
+    (jwt.ImmatureSignatureError, "not_yet_valid"),
+    (jwt.InvalidAudienceError, "invalid_audience"),
+    (jwt.InvalidIssuerError, "invalid_issuer"),
+    (jwt.MissingRequiredClaimError, "missing_claim"),
+    (jwt.InvalidSignatureError, "invalid_signature"),
+    (jwt.InvalidAlgorithmError, "unsupported_algorithm"),
+    (jwt.DecodeError, "malformed")
+]
+
+def get_token_failure_reason(error):
+    for error_class, reason in token_failure_reasons:
+        if isinstance(error, error_class):
+            return reason
+    return "invalid"
 
 # NOTE: This would actually be client side code, we won't have this in the auth module
 def decrypt_payload(encoded_payload, issuer_url, audience):
+    decoded_token, failure_reason = verify_payload(encoded_payload, issuer_url, audience)
+    return decoded_token
+
+# Verifies the token like decrypt_payload, returns (decoded_token, None) for a valid token and (None, failure_reason) otherwise
+def verify_payload(encoded_payload, issuer_url, audience):
 
-    #print("Encoded payload: " + encoded_payload)
-    decoded_non_verified = None
+    # Tokens already verified in this environment are returned from the cache until they expire
+    if verified_token_cache_size > 0:
+        token_digest = get_token_digest(encoded_payload)
+        cached_token = get_verified_token(token_digest, issuer_url, audience)
+        if cached_token != None:
+            return cached_token, None
+
+    # Read only the header to get the kid, the claims are decoded once when verifying the signature below
     try:
-        # Decode without verification to get the jwk_uri first (not the final validation!)
-        decoded_non_verified = jwt.decode(encoded_payload, options={"verify_signature": False}, audience=audience, algorithms=["RS256"])
+        kid = jwt.get_unverified_header(encoded_payload)["kid"]
     except Exception as e:
         # Decoding failed, return None
         print("Error decoding: ",e)
-        return None
+        return None, "malformed"
 
-    # make sure issuers match
-    iss = decoded_non_verified["iss"]
-    print("iss: ", iss)
-    if iss != issuer_url:
-        print("Issuers don't match!")
-        return None
-
-    # If the kid is not in the jwks_key_set, we need to get it from the issuer
-    if not is_kid_in_jwks_key_set(decoded_non_verified["kid"]):
-        print("kid not in jwks_key_set, refresh the keys")
-        refresh_jwks_key_set(issuer_url)
-
-    # If we're still missing the key, just return None
-    decryption_jwks_key = get_jwks_key_with_kid(decoded_non_verified["kid"])
+    # Get the parsed public key for the kid, the key set is refreshed from the issuer if the kid is new
+    decryption_key = get_jwks_key_set(issuer_url).get_key(kid)
 
     # If we still didn't get a key, return None
-    if decryption_jwks_key == None:
+    if decryption_key == None:
         print("Error getting key")
-        return None
+        return None, "unknown_kid"
 
-    # Get the RSA key that works with the PyJWT library using the first key in the list
-    decryption_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(decryption_jwks_key))
+    # Only accept the algorithm of the published key, so a token can't pick a different algorithm for the key
+    if decryption_key.algorithm_name not in supported_signing_algorithms:
+        print("Unsupported algorithm: ", decryption_key.algorithm_name)
+        return None, "unsupported_algorithm"
 
-    # Decode the payload with RS256
+    # Decode the payload, validating signature, expiration, audience and that the issuers match
     try:
-        decoded_token = jwt.decode(encoded_payload, decryption_key, audience=audience, algorithms=["RS256"])
+        decoded_token = jwt.decode(encoded_payload, decryption_key.key, audience=audience, issuer=issuer_url, algorithms=[decryption_key.algorithm_name])
     except Exception as e:
         # Decoding failed, return None
         print("Error decoding",e)
-        return None
+        return None, get_token_failure_reason(e)
+
+    if verified_token_cache_size > 0:
+        add_verified_token(token_digest, issuer_url, audience, decoded_token)
     
     # Return the encoded token
-    return decoded_token
-
-
+    return decoded_token, None
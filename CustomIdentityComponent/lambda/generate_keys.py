@@ -1,67 +1,244 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import hashlib
 import json
+import time
 import uuid
-import jwt
 from jwcrypto import jwk
 import boto3
 import os
+from token_lifetimes import access_token_expiration, refresh_token_expiration_days, private_key_refresh_rate
 
-# This lambda function is used to rotate the public and private key whenever it is called
-# Make sure to only call this on an automated interval (e.g. once a week/month)
-def lambda_handler(event, context):
+# Key generation parameters for the supported signing algorithms, selected with the SIGNING_ALGORITHM environment variable
+key_generation_parameters = {
+    "RS256": {"kty": "RSA", "size": 2048},
+    "ES256": {"kty": "EC", "crv": "P-256"},
+    "EdDSA": {"kty": "OKP", "crv": "Ed25519"}
+}
 
-    # Generate a new RS256 key pair and random UUID for key ID
-    kid_value = str(uuid.uuid4())
-    key = jwk.JWK.generate(kty='RSA', size=2048, alg='RS256', use='sig', kid=kid_value)
-    public_key = key.export_public()
-    private_key = key.export_private()
-
-    s3 = boto3.client('s3')
-    
-    # try to get the S3 object '.well-known/jwks.json' in os.environ['ISSUER_BUCKET']
-    old_key = None
+# Cache lifetime in seconds of jwks.json, the JWKS version pointer and openid-configuration. Verifiers revalidate them after this with
+# If-None-Match (S3 sets the ETag from the content), so an unchanged key set is a 304 without a body
+jwks_max_age = 300
+
+# Versioned key sets are named by their content hash and never change, so they can be cached for as long as they are used
+versioned_jwks_cache_control = "public, max-age=31536000, immutable"
+
+# How the keys are rotated, set with KEY_ROTATION_MODE:
+# * "immediate": the new key is published and used for signing right away. Verifiers with cached keys miss the new kid and refetch
+# * "staged": the new key is published as the next key and only used for signing on the next rotation, so verifiers have picked it up
+#   by revalidating their cached keys before any token is signed with it
+key_rotation_mode = os.environ.get('KEY_ROTATION_MODE', 'immediate')
+
+# How long a key stays published after it was last used for signing in seconds: until the last refresh token signed with it has expired,
+# plus the time the login functions can keep signing with a cached private key after a rotation
+key_retention = refresh_token_expiration_days * 24 * 60 * 60 + access_token_expiration + private_key_refresh_rate * 2
+
+# Minimum time in seconds the next key is published before it's used for signing, verifiers revalidate their keys within the cache lifetime
+next_key_min_publish_time = jwks_max_age * 2
+
+# Secrets Manager staging label of the next private key, the login functions only read the AWSCURRENT version
+next_key_version_stage = "AWSPENDING"
+
+# Returns the content hash of a key set, the same keys always give the same version
+def get_jwks_version(public_keys_dict):
+    canonical_jwks = json.dumps(public_keys_dict, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical_jwks.encode()).hexdigest()[:32]
+
+# Publishes the key set as an immutable versioned object (.well-known/jwks/<version>.json), as .well-known/jwks.json (the jwks_uri of
+# openid-configuration, used by API Gateway JWT authorizers and existing verifiers), and a small pointer document to the current version
+# (.well-known/jwks-version.json) that verifiers can poll and only download the key set when the version changes. The pointer also
+# holds the rotation state of each key (next, active or retired, and since when) used by the next rotation
+def publish_jwks(s3, issuer_bucket, issuer_endpoint, public_keys_dict, key_states=None):
+    if key_states == None:
+        key_states = {}
+    jwks_version = get_jwks_version(public_keys_dict)
+    jwks_body = json.dumps(public_keys_dict)
+    versioned_jwks_key = '.well-known/jwks/' + jwks_version + '.json'
+    cache_control = "public, max-age=" + str(jwks_max_age)
+
+    # The versioned object is written first, so the pointer never refers to a key set that doesn't exist yet
+    s3.put_object(Body=jwks_body, Bucket=issuer_bucket, Key=versioned_jwks_key, ContentType='application/json',
+                  CacheControl=versioned_jwks_cache_control)
+    s3.put_object(Body=jwks_body, Bucket=issuer_bucket, Key='.well-known/jwks.json', ContentType='application/json',
+                  CacheControl=cache_control, Metadata={'jwks-version': jwks_version})
+
+    jwks_pointer = {
+        "version": jwks_version,
+        "jwks_uri": issuer_endpoint + "/" + versioned_jwks_key,
+        "kids": [published_key["kid"] for published_key in public_keys_dict["keys"]],
+        "key_states": key_states
+    }
+    s3.put_object(Body=json.dumps(jwks_pointer), Bucket=issuer_bucket, Key='.well-known/jwks-version.json', ContentType='application/json',
+                  CacheControl=cache_control)
+    print("Published key set version", jwks_version)
+    return jwks_version
+
+# Returns the JSON document from the issuer bucket, or None if it doesn't exist yet
+def get_issuer_document(s3, key):
     try:
-        old_key = s3.get_object(Bucket=os.environ['ISSUER_BUCKET'], Key='.well-known/jwks.json')
+        response = s3.get_object(Bucket=os.environ['ISSUER_BUCKET'], Key=key)
+        return json.loads(response['Body'].read())
     except Exception as e:
         print(e)
-        print("No .well-known/jwks.json object exists in the S3 bucket yet")
-
-    old_key_dict = None
-    if old_key != None:
-        # Convert old_key from JSON to dictionary
-        old_key_dict = json.loads(old_key['Body'].read())
-        print("Old key found:")
-        print(old_key_dict)
-
-    # Get the first key only from old keys
-    previous_key = None
-    if old_key_dict != None and 'keys' in old_key_dict:
-        previous_key = old_key_dict['keys'][0]
-
-    # prepare the key(s) as a list for publi key endpoint
-    public_keys_dict = None
-    if previous_key != None:
-        public_keys_dict = {"keys": [json.loads(public_key), previous_key]}
+        print("No " + key + " object exists in the S3 bucket yet")
+        return None
+
+# Returns the published public keys by kid and their rotation states. Key sets published before the rotation states were added
+# have the active key first, the other keys are kept as retired from now
+def get_published_keys(s3, current_time):
+    old_key_dict = get_issuer_document(s3, '.well-known/jwks.json')
+    if old_key_dict == None or 'keys' not in old_key_dict:
+        return {}, {}
+    print("Old keys found:")
+    print(old_key_dict)
+    published_keys = {published_key['kid']: published_key for published_key in old_key_dict['keys']}
+
+    jwks_pointer = get_issuer_document(s3, '.well-known/jwks-version.json')
+    key_states = jwks_pointer.get('key_states', {}) if jwks_pointer != None else {}
+    for index, kid in enumerate(published_keys):
+        if kid not in key_states:
+            key_states[kid] = {"state": "active" if index == 0 else "retired", "since": current_time}
+    return published_keys, key_states
+
+def generate_key():
+    # Generate a new key pair for the configured algorithm (RS256 by default) and random UUID for key ID
+    signing_algorithm = os.environ.get('SIGNING_ALGORITHM', 'RS256')
+    if signing_algorithm not in key_generation_parameters:
+        raise Exception("Unsupported SIGNING_ALGORITHM: " + signing_algorithm)
+    kid_value = str(uuid.uuid4())
+    return jwk.JWK.generate(alg=signing_algorithm, use='sig', kid=kid_value, **key_generation_parameters[signing_algorithm])
+
+def get_kids_in_state(key_states, state):
+    return [kid for kid, key_state in key_states.items() if key_state["state"] == state]
+
+# Makes the next key (the AWSPENDING version of the private key secret) the signing key (AWSCURRENT)
+def activate_next_key(secrets_manager, next_kid):
+    version_stages = secrets_manager.describe_secret(SecretId=os.environ['SECRET_KEY_ID'])['VersionIdsToStages']
+    current_version_id = None
+    next_version_id = None
+    for version_id, stages in version_stages.items():
+        if "AWSCURRENT" in stages:
+            current_version_id = version_id
+        if next_key_version_stage in stages:
+            next_version_id = version_id
+    if next_version_id == None:
+        raise Exception("No " + next_key_version_stage + " version of the private key secret for the next key " + next_kid)
+
+    next_private_key = secrets_manager.get_secret_value(SecretId=os.environ['SECRET_KEY_ID'], VersionId=next_version_id)['SecretString']
+    if json.loads(next_private_key)['kid'] != next_kid:
+        raise Exception("The " + next_key_version_stage + " private key doesn't match the published next key " + next_kid)
+
+    stage_arguments = {'MoveToVersionId': next_version_id}
+    if current_version_id != None:
+        stage_arguments['RemoveFromVersionId'] = current_version_id
+    secrets_manager.update_secret_version_stage(SecretId=os.environ['SECRET_KEY_ID'], VersionStage="AWSCURRENT", **stage_arguments)
+    secrets_manager.update_secret_version_stage(SecretId=os.environ['SECRET_KEY_ID'], VersionStage=next_key_version_stage,
+                                                RemoveFromVersionId=next_version_id)
+
+# Moves the active key to retired and the new key to active
+def set_active_key(key_states, kid, current_time):
+    for active_kid in get_kids_in_state(key_states, "active"):
+        key_states[active_kid] = {"state": "retired", "since": current_time}
+    key_states[kid] = {"state": "active", "since": current_time}
+
+# Rotates the keys in published_keys and key_states, without writing anything. Returns the private key secret updates to make once the
+# new public keys are published, as (operation, value) tuples, or None if the staged rotation was skipped because the next key was
+# published too recently
+def rotate_keys(published_keys, key_states, current_time):
+    active_kids = get_kids_in_state(key_states, "active")
+    next_kids = get_kids_in_state(key_states, "next")
+    secret_updates = []
+
+    if key_rotation_mode == "staged":
+        if len(next_kids) > 0:
+            if current_time - key_states[next_kids[0]]["since"] < next_key_min_publish_time:
+                print("Next key published less than", next_key_min_publish_time, "seconds ago, not rotating")
+                return None
+            # Sign with the next key, verifiers have had it since it was published
+            secret_updates.append(("activate", next_kids[0]))
+            set_active_key(key_states, next_kids[0], current_time)
+        elif len(active_kids) == 0:
+            # No tokens have been signed yet, so the first key is used for signing right away
+            key = generate_key()
+            secret_updates.append(("current", key))
+            published_keys[key.get('kid')] = json.loads(key.export_public())
+            set_active_key(key_states, key.get('kid'), current_time)
+
+        # Publish a new next key, stored as the AWSPENDING version of the private key secret until it's activated
+        key = generate_key()
+        secret_updates.append(("next", key))
+        published_keys[key.get('kid')] = json.loads(key.export_public())
+        key_states[key.get('kid')] = {"state": "next", "since": current_time}
     else:
-        public_keys_dict = {"keys": [json.loads(public_key)]}
+        # A next key left from the staged mode was never used for signing and can be removed right away
+        for next_kid in next_kids:
+            del key_states[next_kid]
+        key = generate_key()
+        secret_updates.append(("current", key))
+        published_keys[key.get('kid')] = json.loads(key.export_public())
+        set_active_key(key_states, key.get('kid'), current_time)
+    return secret_updates
+
+# Makes the private key secret updates of a rotation, only called after the public keys are published so that no token is signed
+# with a kid verifiers can't find (and cache as unknown)
+def update_private_key_secret(secrets_manager, secret_updates):
+    for operation, value in secret_updates:
+        if operation == "activate":
+            activate_next_key(secrets_manager, value)
+        elif operation == "current":
+            secrets_manager.put_secret_value(SecretId=os.environ['SECRET_KEY_ID'], SecretString=value.export_private())
+        else:
+            secrets_manager.put_secret_value(SecretId=os.environ['SECRET_KEY_ID'], SecretString=value.export_private(), VersionStages=[next_key_version_stage])
+
+# This lambda function is used to rotate the public and private key whenever it is called
+# Make sure to only call this on an automated interval (e.g. once a week/month)
+def lambda_handler(event, context):
+    rotate_and_publish_keys(boto3.client('s3'), boto3.client('secretsmanager'))
+
+# Publishes the rotated public keys and openid-configuration to the issuer bucket, then rotates the private key in Secrets Manager
+def rotate_and_publish_keys(s3, secrets_manager):
+    current_time = int(time.time())
+    published_keys, key_states = get_published_keys(s3, current_time)
+    secret_updates = rotate_keys(published_keys, key_states, current_time)
+    if secret_updates == None:
+        return
+
+    # Keys are kept published until the last tokens signed with them have expired (when changing the algorithm, this also keeps the
+    # previous algorithm's key published during the migration)
+    for kid, key_state in list(key_states.items()):
+        if key_state["state"] == "retired" and current_time - key_state["since"] >= key_retention:
+            print("Retiring key", kid)
+            del key_states[kid]
+
+    # prepare the key(s) as a list for public key endpoint, the active key first, then the next key and the retired keys from the newest
+    state_order = {"active": 0, "next": 1, "retired": 2}
+    published_kids = sorted([kid for kid in key_states if kid in published_keys],
+                            key=lambda kid: (state_order[key_states[kid]["state"]], -key_states[kid]["since"]))
+    public_keys_dict = {"keys": [published_keys[kid] for kid in published_kids]}
+    key_states = {kid: key_states[kid] for kid in published_kids}
 
     # Upload public key to S3 bucket in environment variable "issuer_bucket"
-    #Add content type application/json to the object
-    s3.put_object(Body=json.dumps(public_keys_dict), Bucket=os.environ['ISSUER_BUCKET'], Key='.well-known/jwks.json', ContentType='application/json')
+    publish_jwks(s3, os.environ['ISSUER_BUCKET'], os.environ['ISSUER_ENDPOINT'], public_keys_dict, key_states)
+
+    # Sign with the new key only once it's published. If publishing failed, the secret is unchanged and the current key keeps signing
+    update_private_key_secret(secrets_manager, secret_updates)
 
-    # Add new private key to Secrets Manager
-    secrets_manager = boto3.client('secretsmanager')
-    secrets_manager.put_secret_value(SecretId=os.environ['SECRET_KEY_ID'], SecretString=private_key)
+    # List the algorithms of all published keys (keys without alg are RS256 keys from older versions)
+    signing_algorithms = []
+    for published_key in public_keys_dict["keys"]:
+        published_algorithm = published_key.get("alg", "RS256")
+        if published_algorithm not in signing_algorithms:
+            signing_algorithms.append(published_algorithm)
 
     # Define openid-configuration
     openid_configuration = {
         "issuer": os.environ['ISSUER_ENDPOINT'],
         "jwks_uri": os.environ['ISSUER_ENDPOINT']+"/.well-known/jwks.json",
-        "id_token_signing_alg_values_supported":["RS256"],
+        "id_token_signing_alg_values_supported": signing_algorithms,
         "scopes_supported":["guest", "authenticated"]
     }
 
     # Add open-id configuration to S3 bucket with key .well-known/openid-configuration
-    s3.put_object(Body=json.dumps(openid_configuration), Bucket=os.environ['ISSUER_BUCKET'], Key='.well-known/openid-configuration', ContentType='application/json')
+    s3.put_object(Body=json.dumps(openid_configuration), Bucket=os.environ['ISSUER_BUCKET'], Key='.well-known/openid-configuration', ContentType='application/json',
+                  CacheControl="public, max-age=" + str(jwks_max_age))
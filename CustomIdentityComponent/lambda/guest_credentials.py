@@ -0,0 +1,80 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Guest secrets derived from the user_id with an HMAC under a server key, so returning guests are validated without reading the user table
+# The key secret is a JSON document of key versions and the current version, for example {"current": "2", "1": "...", "2": "..."}
+# A derived secret is "v<key version>.<HMAC-SHA256 of the user_id>", so secrets derived with a previous key version still validate after a
+# rotation (as long as that version is kept in the secret) and are replaced with a secret derived with the current version on login
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import uuid
+from secret_provider import BackgroundRefreshingSecret
+
+# Secret for new guest users: "random" (a random secret stored in the user table) or "hmac" (derived, not stored), set with GUEST_SECRET_MODE
+guest_secret_mode = os.environ.get('GUEST_SECRET_MODE', 'random')
+
+# Guest secret key refresh rate in seconds
+guest_secret_key_refresh_rate = 900
+
+# Guest secret keys from Secrets Manager, created on first use
+guest_secret_key_secret = None
+
+# Parsed keys stored as a single (secret_version, current_version, keys) tuple
+guest_secret_keys_cache = None
+
+# Returns the current key version and the keys by version, or None, {} if the key secret is not configured
+def get_guest_secret_keys():
+    global guest_secret_key_secret, guest_secret_keys_cache
+    if 'GUEST_SECRET_KEY_ID' not in os.environ:
+        return None, {}
+    if guest_secret_key_secret == None:
+        guest_secret_key_secret = BackgroundRefreshingSecret(os.environ['GUEST_SECRET_KEY_ID'], "guest_secret_key", guest_secret_key_refresh_rate)
+
+    key_secret, secret_version = guest_secret_key_secret.get()
+    cached_entry = guest_secret_keys_cache
+    if cached_entry == None or cached_entry[0] != secret_version:
+        keys = json.loads(key_secret)
+        current_version = keys.pop("current")
+        cached_entry = (secret_version, current_version, keys)
+        guest_secret_keys_cache = cached_entry
+    return cached_entry[1], cached_entry[2]
+
+def derive_guest_secret(user_id, key_version, key):
+    digest = hmac.new(key.encode(), user_id.encode(), hashlib.sha256).digest()
+    return "v" + key_version + "." + base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+# Random secrets are two UUIDs, which never start with "v"
+def is_derived_guest_secret(guest_secret):
+    return guest_secret.startswith("v") and "." in guest_secret
+
+# Returns a secret for a new guest user, and if it needs to be stored in the user table
+def create_guest_secret(user_id):
+    if guest_secret_mode == "hmac":
+        current_version, keys = get_guest_secret_keys()
+        return derive_guest_secret(user_id, current_version, keys[current_version]), False
+
+    return str(uuid.uuid4())+"-"+str(uuid.uuid4()), True
+
+# Validates a derived guest secret with the key version it was derived with (CPU only, no table read)
+def verify_derived_guest_secret(user_id, guest_secret):
+    key_version = guest_secret[1:guest_secret.index(".")]
+    _, keys = get_guest_secret_keys()
+    if key_version not in keys:
+        print("Guest secret key version not available: ", key_version)
+        return False
+    return hmac.compare_digest(derive_guest_secret(user_id, key_version, keys[key_version]), guest_secret)
+
+# Returns the secret the guest should use from now on for a validated guest secret. In hmac mode random secrets and secrets derived with a
+# previous key version are replaced with a secret derived with the current key version, so returning guests migrate to table free validation
+def get_current_guest_secret(user_id, guest_secret):
+    if guest_secret_mode != "hmac":
+        return guest_secret
+
+    current_version, keys = get_guest_secret_keys()
+    if guest_secret.startswith("v" + current_version + "."):
+        return guest_secret
+    return derive_guest_secret(user_id, current_version, keys[current_version])
@@ -0,0 +1,136 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Writes a user to the user table and the provider ID to the provider table (for example SteamUserTable) in a single
+# TransactWriteItems call, so creating or linking a user is one round trip and a failure can't leave a user without
+# its provider ID link (or a provider ID linked to a user that doesn't exist)
+
+import os
+import uuid
+import user_mapping_cache
+from aws_lambda_powertools import single_metric
+from aws_lambda_powertools.metrics import MetricUnit
+
+# Amount of tries for creating a user with a unique user_id, and for transactions cancelled by a conflicting write
+max_tries = 10
+
+def record_transaction_conflict_metric(provider_attribute, operation):
+    try:
+        with single_metric(name="transaction_conflict", unit=MetricUnit.Count, value=1) as metric:
+            metric.add_dimension(name="provider", value=provider_attribute)
+            metric.add_dimension(name="operation", value=operation)
+    except Exception as e:
+        print("Error recording transaction conflict metric: ", e)
+
+# Returns the cancellation reason codes of a cancelled transaction, in the order of the transaction items
+def get_cancellation_reasons(exception):
+    return [reason.get('Code', 'None') for reason in exception.response.get('CancellationReasons', [])]
+
+# Identity provider linked to users with a provider table keyed by provider_attribute (for example SteamId),
+# the same attribute is set on the user item in the user table. Uses the DynamoDB resource of the login function
+class ProviderLink:
+
+    def __init__(self, dynamodb, provider_table_name, provider_attribute):
+        self.dynamodb = dynamodb
+        self.provider_table_name = provider_table_name
+        self.provider_attribute = provider_attribute
+
+    # Puts the provider ID item, only if the provider ID isn't already linked to a user
+    def provider_id_put(self, user_id, provider_id):
+        return {
+            'Put': {
+                'TableName': self.provider_table_name,
+                'Item': {
+                    self.provider_attribute: provider_id,
+                    'UserId': user_id
+                },
+                'ConditionExpression': 'attribute_not_exists(#provider_id)',
+                'ExpressionAttributeNames': {'#provider_id': self.provider_attribute}
+            }
+        }
+
+    # Returns the user_id already linked to the provider ID, or None
+    def get_linked_user(self, provider_id):
+        provider_table = self.dynamodb.Table(self.provider_table_name)
+        response = provider_table.get_item(Key={self.provider_attribute: provider_id}, ConsistentRead=True)
+        if 'Item' not in response:
+            return None
+        user_mapping_cache.add_user_id(self.provider_attribute, provider_id, response['Item']['UserId'])
+        return response['Item']['UserId']
+
+    # Creates a new user linked to the provider ID, starting with user_id if one is given (the caller might have signed tokens for it)
+    # Returns the user_id of the user linked to the provider ID (an existing one if another login linked it first), or None on failure
+    def create_user(self, provider_id, user_id=None):
+        tries = 0
+        while tries < max_tries:
+            tries += 1
+            if user_id == None:
+                user_id = str(uuid.uuid4())
+            try:
+                self.dynamodb.meta.client.transact_write_items(TransactItems=[
+                    {
+                        'Put': {
+                            'TableName': os.environ['USER_TABLE'],
+                            'Item': {
+                                'UserId': user_id,
+                                self.provider_attribute: provider_id # NOTE: You might want to add other information from the provider here too
+                            },
+                            'ConditionExpression': 'attribute_not_exists(UserId)'
+                        }
+                    },
+                    self.provider_id_put(user_id, provider_id)
+                ])
+                user_mapping_cache.add_user_id(self.provider_attribute, provider_id, user_id)
+                return user_id
+            except self.dynamodb.meta.client.exceptions.TransactionCanceledException as e:
+                reasons = get_cancellation_reasons(e)
+                print("Create user transaction cancelled: ", reasons)
+                if 'TransactionConflict' in reasons:
+                    record_transaction_conflict_metric(self.provider_attribute, "create_user")
+                elif len(reasons) == 2 and reasons[1] == 'ConditionalCheckFailed':
+                    # Another login created a user for the provider ID first, use that one
+                    return self.get_linked_user(provider_id)
+                elif len(reasons) == 2 and reasons[0] == 'ConditionalCheckFailed':
+                    # The user_id is taken, try with a new one
+                    user_id = None
+                else:
+                    return None
+            except Exception as e:
+                print("Exception creating user: ", e)
+                return None
+
+        return None
+
+    # Links the provider ID to an existing user. Returns True on success, and False if the user doesn't exist,
+    # the provider ID is already linked to a user, or the transaction fails
+    def link_to_existing_user(self, user_id, provider_id):
+        tries = 0
+        while tries < max_tries:
+            tries += 1
+            try:
+                self.dynamodb.meta.client.transact_write_items(TransactItems=[
+                    {
+                        'Update': {
+                            'TableName': os.environ['USER_TABLE'],
+                            'Key': {'UserId': user_id},
+                            'UpdateExpression': 'set #provider_id = :provider_id',
+                            'ExpressionAttributeNames': {'#provider_id': self.provider_attribute},
+                            'ExpressionAttributeValues': {':provider_id': provider_id},
+                            'ConditionExpression': 'attribute_exists(UserId)'
+                        }
+                    },
+                    self.provider_id_put(user_id, provider_id)
+                ])
+                user_mapping_cache.add_user_id(self.provider_attribute, provider_id, user_id)
+                return True
+            except self.dynamodb.meta.client.exceptions.TransactionCanceledException as e:
+                reasons = get_cancellation_reasons(e)
+                print("Link user transaction cancelled: ", reasons)
+                if 'TransactionConflict' not in reasons:
+                    return False
+                record_transaction_conflict_metric(self.provider_attribute, "link_user")
+            except Exception as e:
+                print("Exception linking user to existing user: ", e)
+                return False
+
+        return False
@@ -0,0 +1,88 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Token introspection for backend services that can't verify the access tokens themselves (no JWT library)
+# The service sends a batch of access tokens and gets the claims of each valid token, or the reason it's not valid. The tokens are verified
+# with decrypt_payload's verification (verify_payload), against the issuer keys parsed once per key set in provider_key_cache,
+# and valid tokens are kept in the verified token cache until they expire, so a token introspected again is a cache lookup
+
+from encryption_and_decryption import verify_payload, get_verified_token_cache_stats
+import json
+import os
+
+from aws_lambda_powertools import Tracer
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+tracer = Tracer()
+logger = Logger()
+metrics = Metrics()
+
+# Maximum amount of tokens in one request, set with INTROSPECTION_MAX_TOKENS
+introspection_max_tokens = int(os.environ.get('INTROSPECTION_MAX_TOKENS', '100'))
+
+def generate_error(status_code, message):
+    return {
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Credentials': True
+        },
+        'statusCode': status_code,
+        'body': message
+    }
+
+# Returns the introspection result of each token in the order of the tokens: {"active": True, "claims": {...}} for a valid access token,
+# and {"active": False, "reason": reason} otherwise. Tokens repeated in the batch are verified once
+@tracer.capture_method
+def introspect_tokens(tokens):
+    issuer_url = os.environ['ISSUER_URL']
+    results_by_token = {}
+    results = []
+    for token in tokens:
+        if not isinstance(token, str):
+            results.append({"active": False, "reason": "malformed"})
+            continue
+        if token not in results_by_token:
+            decoded_token, failure_reason = verify_payload(token, issuer_url, "gamebackend")
+            if decoded_token != None:
+                results_by_token[token] = {"active": True, "claims": decoded_token}
+            else:
+                results_by_token[token] = {"active": False, "reason": failure_reason}
+        results.append(results_by_token[token])
+    return results
+
+# Introspects the tokens in the request body ({"tokens": [...]})
+@metrics.log_metrics
+@tracer.capture_lambda_handler
+def lambda_handler(event, context):
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except Exception as e:
+        return generate_error(400, 'Error: Request body is not valid JSON')
+
+    tokens = body.get('tokens') if isinstance(body, dict) else None
+    if not isinstance(tokens, list) or len(tokens) == 0:
+        return generate_error(400, 'Error: No tokens provided')
+    if len(tokens) > introspection_max_tokens:
+        return generate_error(400, 'Error: Too many tokens, the maximum is ' + str(introspection_max_tokens))
+
+    results = introspect_tokens(tokens)
+
+    active_tokens = sum(1 for result in results if result["active"])
+    metrics.add_metric(name="introspected_tokens", unit=MetricUnit.Count, value=len(results))
+    metrics.add_metric(name="introspected_active_tokens", unit=MetricUnit.Count, value=active_tokens)
+    logger.info("Introspected tokens", tokens=len(results), active_tokens=active_tokens,
+                verified_token_cache_hit_rate=get_verified_token_cache_stats()["hit_rate"])
+
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Credentials': True
+        },
+        'body': json.dumps({
+            'results': results
+        }),
+        "isBase64Encoded": False
+    }
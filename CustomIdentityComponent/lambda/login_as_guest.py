@@ -5,7 +5,9 @@ import boto3
 from botocore.config import Config
 import uuid
 import os
-from encryption_and_decryption import encrypt
+from login_pipeline import LoginPipeline
+import admission_control
+import guest_credentials
 import json
 
 from aws_lambda_powertools import Logger
@@ -18,25 +20,25 @@ tracer = Tracer()
 config = Config(connect_timeout=2, read_timeout=2)
 dynamodb = boto3.resource('dynamodb', config=config)
 
-# define create_user function
+# define create_user function, the caller generates the unique id so the tokens can be signed while the user is created
 @tracer.capture_method
-def create_user():
-
-    # generate a unique id
-    user_id = str(uuid.uuid4())
+def create_user(user_id):
     
-    # generate a random secret
-    guest_secret = str(uuid.uuid4())+"-"+str(uuid.uuid4())
+    # generate a random secret, or a secret derived from the user_id in hmac mode
+    guest_secret, store_guest_secret = guest_credentials.create_guest_secret(user_id)
+    item = {
+        'UserId': user_id
+    }
+    # Derived secrets are validated without the table, so only random secrets are stored
+    if store_guest_secret:
+        item['GuestSecret'] = guest_secret
 
     # Check that user_id doesn't exist in DynamoDB table defined in environment variable USER_TABLE
     table = dynamodb.Table(os.environ['USER_TABLE'])
     # Try to write a new item to the table with user_id as partition key
     try:
         table.put_item(
-            Item={
-                'UserId': user_id,
-                'GuestSecret': guest_secret
-            },
+            Item=item,
             ConditionExpression='attribute_not_exists(UserId)'
         )
     except dynamodb.meta.client.exceptions.ConditionalCheckFailedException as e:
@@ -72,6 +74,12 @@ def check_user_exists(existing_user_id, guest_secret):
 @metrics.log_metrics(capture_cold_start_metric=True)
 @tracer.capture_lambda_handler
 def lambda_handler(event, context):
+    # Shed requests over the client's rate limit before doing any of the work
+    shed_response = admission_control.check_admission(event, "guest")
+    if shed_response != None:
+        return shed_response
+
+    pipeline = LoginPipeline("guest")
 
     # Check if the event has an existing user_id
     user_id = None
@@ -82,14 +90,21 @@ def lambda_handler(event, context):
         if 'user_id' in event['queryStringParameters'] and 'guest_secret' in event['queryStringParameters']:
             user_id = event['queryStringParameters']['user_id']
             logger.info("Existing user id: ", user_id=user_id)
-            # Check that the user actually exists and the guest_secret matches
-            if check_user_exists(user_id, event['queryStringParameters']['guest_secret']) == False:
+            guest_secret = event['queryStringParameters']['guest_secret']
+            # Derived secrets are validated with the guest secret key only, random secrets against the user table
+            if guest_credentials.is_derived_guest_secret(guest_secret):
+                user_validated = pipeline.run_timed("verify_guest_secret", guest_credentials.verify_derived_guest_secret, user_id, guest_secret)
+            else:
+                # Check that the user actually exists and the guest_secret matches
+                user_validated = pipeline.run_timed("check_user_exists", check_user_exists, user_id, guest_secret)
+            if user_validated == False:
                 # return error
                 return {
                     'statusCode': 401,
                     'body': 'Error: Could not validate user'
                 }
-            guest_secret = event['queryStringParameters']['guest_secret']
+            # Migrate the guest to a secret derived with the current key in hmac mode (the client stores the returned guest_secret)
+            guest_secret = guest_credentials.get_current_guest_secret(user_id, guest_secret)
         # If user_id in event but no guest_secret, return an error
         elif 'user_id' in event['queryStringParameters'] and 'guest_secret' not in event['queryStringParameters']:
             return {
@@ -103,8 +118,11 @@ def lambda_handler(event, context):
         # We'll try to create a user max 10 times finding a unique user_id  
         tries = 0
         while user_id is None and tries < 10:
+            # Generate a unique id and sign the tokens for it while the user is written to the table
+            new_user_id = str(uuid.uuid4())
+            pipeline.start_signing({'sub': new_user_id}, "guest")
             # Try to create a new user
-            user_id, guest_secret = create_user()
+            user_id, guest_secret = pipeline.run_timed("create_user", create_user, new_user_id)
             tries += 1
             if user_id is None:
                 metrics.add_metric(name="UserAlreadyExists", unit=MetricUnit.Count, value=1)
@@ -124,7 +142,8 @@ def lambda_handler(event, context):
     payload = {
         'sub': user_id
     }
-    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = encrypt(payload, "guest")
+    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = pipeline.get_tokens(payload, "guest")
+    pipeline.record_timings()
 
     # Return jwt
     return {
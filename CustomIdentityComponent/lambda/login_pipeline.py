@@ -0,0 +1,79 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Pipelined login flow shared by the login functions: the access and refresh tokens are signed concurrently in a thread pool
+# while the handler runs the DynamoDB writes that don't depend on them (such as adding the user to the provider table),
+# and the duration of each stage is logged and sent as a metric to show the critical path of the login
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from encryption_and_decryption import get_private_key, get_signing_key, encrypt_access_token, encrypt_refresh_token
+from aws_lambda_powertools import Logger
+from aws_lambda_powertools import single_metric
+from aws_lambda_powertools.metrics import MetricUnit
+
+logger = Logger(child=True)
+
+# One thread per token. Kept between invocations, Lambda runs one invocation at a time per environment
+signing_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="token-signing")
+
+class LoginPipeline:
+
+    # login is used as the metric dimension together with the stage name
+    def __init__(self, login):
+        self.login = login
+        self.started = time.perf_counter()
+        # Stage durations in milliseconds, also written from the signing threads
+        self.stage_durations = {}
+        self.pending_tokens = None
+
+    # Times a stage running on the handler thread
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_durations[name] = (time.perf_counter() - start) * 1000
+
+    def run_timed(self, name, function, *args):
+        with self.stage(name):
+            return function(*args)
+
+    # Starts signing the access and refresh tokens for the payload in the background, collect them with get_tokens
+    def start_signing(self, payload, scope):
+        # The key is read on the handler thread so both tokens are signed with the same key (cached after the first login)
+        with self.stage("get_signing_key"):
+            private_key, secret_version = get_private_key()
+            get_signing_key(private_key, secret_version)
+
+        # Each token gets its own copy of the payload as encrypting adds the token claims to it
+        access_token = signing_executor.submit(self.run_timed, "sign_access_token", encrypt_access_token, dict(payload), private_key, scope)
+        refresh_token = signing_executor.submit(self.run_timed, "sign_refresh_token", encrypt_refresh_token, dict(payload), private_key, scope)
+        self.pending_tokens = (payload, scope, access_token, refresh_token)
+
+    # Returns the same values as encrypt, waiting for the tokens started with start_signing or signing them now
+    def get_tokens(self, payload, scope):
+        if self.pending_tokens == None or self.pending_tokens[0] != payload or self.pending_tokens[1] != scope:
+            self.start_signing(payload, scope)
+
+        _, _, access_token, refresh_token = self.pending_tokens
+        self.pending_tokens = None
+        with self.stage("wait_for_tokens"):
+            auth_token, auth_token_expires_in = access_token.result()
+            refresh_token, refresh_token_expires_in = refresh_token.result()
+
+        return auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in
+
+    # Logs the stage durations and the total duration of the login, and records them as metrics
+    def record_timings(self):
+        self.stage_durations["total"] = (time.perf_counter() - self.started) * 1000
+        logger.info("Login stage timings", login=self.login, stage_durations_ms={name: round(duration, 2) for name, duration in self.stage_durations.items()})
+        try:
+            for name, duration in self.stage_durations.items():
+                with single_metric(name="login_stage_duration", unit=MetricUnit.Milliseconds, value=duration) as metric:
+                    metric.add_dimension(name="login", value=self.login)
+                    metric.add_dimension(name="stage", value=name)
+        except Exception as e:
+            print("Error recording login stage metrics: ", e)
@@ -6,12 +6,15 @@ from botocore.config import Config
 import uuid
 import os
 import jwt
-from encryption_and_decryption import encrypt, decrypt
+from encryption_and_decryption import decrypt
+from login_pipeline import LoginPipeline
+import admission_control
+from identity_linking import ProviderLink
+import user_mapping_cache
 import json
-import requests
+import provider_key_cache
 from aws_lambda_powertools import Tracer
 from aws_lambda_powertools import Logger
-import time
 
 tracer = Tracer()
 logger = Logger()
@@ -19,43 +22,14 @@ config = Config(connect_timeout=2, read_timeout=2)
 dynamodb = boto3.resource('dynamodb', config=config)
 
 apple_public_key_url = "https://appleid.apple.com/auth/keys"
-apple_public_keys = None
 
-# Method for requesting the latest Apple public keys
-@tracer.capture_method
-def refresh_apple_public_keys():
-    global apple_public_keys
-
-    logger.info("Refreshing Apple public key set")
-    key_payload = requests.get(apple_public_key_url).json()
-    #logger.info("Received key set: ", key=key_payload)
-    apple_public_keys = key_payload["keys"]
-
-    return apple_public_keys
+# Apple IDs linked to users, the user and the Apple ID link are written in one transaction (see identity_linking)
+apple_id_link = ProviderLink(dynamodb, os.getenv("APPLE_ID_USER_TABLE"), "AppleId")
 
-# Creates a new user when there's no existing user for the Apple ID
+# Creates a new user when there's no existing user for the Apple ID, trying user_id first if given
 @tracer.capture_method
-def create_user(apple_id):
-
-    # generate a unique id
-    user_id = str(uuid.uuid4())
-
-    # Check that user_id doesn't exist in DynamoDB table defined in environment variable USER_TABLE
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(os.environ['USER_TABLE'])
-    # Try to write a new item to the table with user_id as partition key
-    try:
-        table.put_item(
-            Item={
-                'UserId': user_id,
-                'AppleId': apple_id
-            },
-            ConditionExpression='attribute_not_exists(UserId)'
-        )
-    except:
-        logger.info("User already exists")
-        return None
-    
+def create_user(apple_id, user_id=None):
+    user_id = apple_id_link.create_user(apple_id, user_id)
     return user_id
 
 @tracer.capture_method
@@ -88,38 +62,29 @@ def generate_success(user_id, apple_id, jwt_token, refresh_token, auth_token_exp
         "isBase64Encoded": False
     }
 
+# Gets the Apple public key from the shared key cache, which refreshes the Apple keys if the kid is new
 @tracer.capture_method
 def find_key_with_kid(kid):
-
-    # If no keys, get them first
-    if not apple_public_keys:
-        logger.info("No public keys found, getting them from Apple.")
-        refresh_apple_public_keys()
-
-    # First try to find the key from the list
-    for key in apple_public_keys:
-        if key["kid"] == kid:
-            return jwt.algorithms.RSAAlgorithm.from_jwk(key)
-    
-    # If not found, try to refresh the keys and try again
-    logger.info("Refreshing Apple access keys as given kid not found.")
-    refresh_apple_public_keys()
-    for key in apple_public_keys:
-        if key["kid"] == kid:
-            return jwt.algorithms.RSAAlgorithm.from_jwk(key)
-    
-    # Still couldn't find, return none
-    return None
+    public_key = provider_key_cache.get_key(apple_public_key_url, kid)
+    if public_key == None:
+        return None
+    return public_key.key
 
 # Tries to get an existing user from User Table. Reports error if request fails
 @tracer.capture_method
-def get_existing_user(apple_id):
+def get_existing_user(apple_id, bypass_cache=False):
+    # Repeat logins are served from the user mapping cache, admin flows can bypass it to always read the table
+    if not bypass_cache:
+        user_id = user_mapping_cache.get_user_id("AppleId", apple_id)
+        if user_id != None:
+            return True, user_id
     try:
         apple_id_user_table_name = os.getenv("APPLE_ID_USER_TABLE");
         apple_id_user_table = dynamodb.Table(apple_id_user_table_name)
         apple_id_user_table_response = apple_id_user_table.get_item(Key={'AppleId': apple_id})
         if 'Item' in apple_id_user_table_response:
             logger.info("Found existing user in Apple ID table:", user_id=apple_id_user_table_response['Item']['UserId'])
+            user_mapping_cache.add_user_id("AppleId", apple_id, apple_id_user_table_response['Item']['UserId'])
             return True, apple_id_user_table_response['Item']['UserId']
         else:
             return True, None
@@ -129,45 +94,19 @@ def get_existing_user(apple_id):
     return False, None
 
 @tracer.capture_method
-def add_new_user_to_apple_id_table(user_id, apple_id):
-    try:
-        apple_id_user_table_name = os.getenv("APPLE_ID_USER_TABLE");
-        apple_id_user_table = dynamodb.Table(apple_id_user_table_name)
-        apple_id_user_table.put_item(
-        Item={
-            'UserId': user_id,
-            'AppleId': apple_id,
-        });
-        return True
-    except Exception as e:
-        logger.info("Exception adding user to Apple ID table: ", e)
-    
-    return False
-
 def link_apple_id_to_existing_user(user_id, apple_id):
-    try:
-        user_table_name = os.getenv("USER_TABLE");
-        user_table = dynamodb.Table(user_table_name)
-        # Update existing user
-        user_table.update_item(
-            Key={
-                'UserId': user_id,
-            },
-            UpdateExpression="set AppleId = :val1",
-            ExpressionAttributeValues={
-                ':val1': apple_id
-            },
-            ConditionExpression='attribute_exists(UserId)'
-        )
-        return True
-    except Exception as e:
-        logger.info("Exception linking user to existing user: ", e)
-    
-    return False
+    success = apple_id_link.link_to_existing_user(user_id, apple_id)
+    return success
 
 # define a lambda function that returns a user_id
 @tracer.capture_lambda_handler
 def lambda_handler(event, context):
+    # Shed requests over the client's rate limit before doing any of the work
+    shed_response = admission_control.check_admission(event, "apple_id")
+    if shed_response != None:
+        return shed_response
+
+    pipeline = LoginPipeline("apple_id")
 
     # Get the audience (our app identifier)
     my_audience = os.getenv("APPLE_APP_ID")
@@ -199,7 +138,7 @@ def lambda_handler(event, context):
                 success = False # Indicates the whole process success (existing user or new)
 
                 # OPTION 1: Try to get an existing user. This overrides any requests to link accounts
-                existing_user_request_success, user_id = get_existing_user(decoded_apple_auth_token['sub'])
+                existing_user_request_success, user_id = pipeline.run_timed("get_existing_user", get_existing_user, decoded_apple_auth_token['sub'])
                 # If there was a problem getting existing user, abort as we don't want to create duplicate
                 if existing_user_request_success is False:
                     return generate_error('Error: Failed the try getting existing user')
@@ -218,24 +157,22 @@ def lambda_handler(event, context):
                             return generate_error('Error: Failed to authenticate with existing identity')
                         # Set the user_id
                         user_id = decoded_backend_token['sub']
+                        # Sign the tokens while the provider ID is linked to the user
+                        pipeline.start_signing({'sub': user_id}, "authenticated")
                         # Try to link the new user to an existing user
-                        success = link_apple_id_to_existing_user(user_id, decoded_apple_auth_token['sub'])
+                        success = pipeline.run_timed("link_user", link_apple_id_to_existing_user, user_id, decoded_apple_auth_token['sub'])
                         if success is False:
                             return generate_error('Error: Failed to link new user to existing user')
                     
                     # OPTION 3: Else If no user yet and we didn't request linking to an existing user, create one and add to user table
                     else:
                         logger.info("No user yet, creating a new one")
-                        tries = 0
-                        while user_id is None and tries < 10:
-                            # Try to create a new user
-                            user_id = create_user(decoded_apple_auth_token['sub'])
-                            tries += 1
+                        # Sign the tokens for a new user_id while the user is created with it
+                        new_user_id = str(uuid.uuid4())
+                        pipeline.start_signing({'sub': new_user_id}, "authenticated")
+                        user_id = pipeline.run_timed("create_user", create_user, decoded_apple_auth_token['sub'], new_user_id)
                         if user_id == None:
                             return generate_error('Error: Failed to create user')
-                    
-                    # Add user to Appe Id User table in both cases (linking and new user)
-                    user_creation_success = add_new_user_to_apple_id_table(user_id, decoded_apple_auth_token['sub'])
                 
                 # Create a JWT payload and encrypt with authenticated scope
                 if user_id is not None and success is True:
@@ -243,7 +180,8 @@ def lambda_handler(event, context):
                         'sub': user_id,
                     }
                     # Create for scope "authenticated" so backend can differentiate from guest users if needed
-                    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = encrypt(payload, "authenticated")
+                    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = pipeline.get_tokens(payload, "authenticated")
+                    pipeline.record_timings()
                     # NOTE: We might want to send back all attached identities from user table?
                     return generate_success(user_id, decoded_apple_auth_token['sub'], auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in)
 
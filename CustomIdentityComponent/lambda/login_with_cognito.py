@@ -2,7 +2,6 @@ import json
 import os
 import uuid
 import boto3
-import requests
 import jwt  # Using PyJWT to decode the token
 from botocore.config import Config
 from aws_lambda_powertools import Tracer
@@ -10,8 +9,12 @@ from aws_lambda_powertools import Logger
 from aws_lambda_powertools import Metrics
 from aws_lambda_powertools import single_metric
 from aws_lambda_powertools.metrics import MetricUnit
-from jwt.algorithms import RSAAlgorithm
-from encryption_and_decryption import encrypt, decrypt
+from encryption_and_decryption import decrypt
+from login_pipeline import LoginPipeline
+import admission_control
+from identity_linking import ProviderLink
+import user_mapping_cache
+import provider_key_cache
 
 # Initialize clients and logger
 tracer = Tracer()
@@ -21,7 +24,8 @@ metrics.set_default_dimensions(function=os.environ['AWS_LAMBDA_FUNCTION_NAME'])
 config = Config(connect_timeout=2, read_timeout=2)
 dynamodb = boto3.resource('dynamodb')
 user_table = dynamodb.Table(os.environ['USER_TABLE'])
-client = boto3.client('cognito-idp')
+# Cognito client, created on first use so the Cognito client setup is not part of the cold start init
+cognito_client = None
 
 # Cognito configuration
 CognitoIssuer = f"https://cognito-idp.{os.environ['AWS_REGION']}.amazonaws.com/{os.environ['COGNITO_USER_POOL_ID']}"
@@ -45,30 +49,17 @@ def record_failure_metric(reason: str):
         metric.add_dimension(
             name="reason", value=reason)
 
-# Creates a new user when there's no existing user for the Cognito User ID
-@tracer.capture_method
-def create_user(cognito_user_id):
-
-    # generate a unique id
-    user_id = str(uuid.uuid4())
+# Cognito IDs linked to users, the user and the Cognito ID link are written in one transaction (see identity_linking)
+cognito_link = ProviderLink(dynamodb, os.getenv("COGNITO_USER_TABLE"), "CognitoId")
 
-    # Check that user_id doesn't exist in DynamoDB table defined in environment variable USER_TABLE
-    table = dynamodb.Table(os.environ['USER_TABLE'])
-    # Try to write a new item to the table with user_id as partition key
-    try:
-        table.put_item(
-            Item={
-                'UserId': user_id,
-                'CognitoId': cognito_user_id 
-            },
-            ConditionExpression='attribute_not_exists(UserId)'
-        )
-        return user_id
-    except:
-        logger.info("User already exists")
-        return None
-    
-    metrics.add_metric(name="created_user", unit=MetricUnit.Count, value=1)
+# Creates a new user when there's no existing user for the Cognito ID, trying user_id first if given
+@tracer.capture_method
+def create_user(cognito_id, user_id=None):
+    user_id = cognito_link.create_user(cognito_id, user_id)
+    if user_id != None:
+        metrics.add_metric(name="created_user", unit=MetricUnit.Count, value=1)
+        metrics.add_metric(name="new_cognito_user", unit=MetricUnit.Count, value=1)
+    return user_id
 
 @tracer.capture_method
 def generate_error(message):
@@ -102,13 +93,19 @@ def generate_success(user_id, cognito_id, jwt_token, refresh_token, auth_token_e
 
 # Tries to get an existing user from User Table. Reports error if request fails
 @tracer.capture_method
-def get_existing_user(cognito_id):
+def get_existing_user(cognito_id, bypass_cache=False):
+    # Repeat logins are served from the user mapping cache, admin flows can bypass it to always read the table
+    if not bypass_cache:
+        user_id = user_mapping_cache.get_user_id("CognitoId", cognito_id)
+        if user_id != None:
+            return True, user_id
     try:
         cognito_user_table_name = os.getenv("COGNITO_USER_TABLE")
         cognito_user_table = dynamodb.Table(cognito_user_table_name)
         cognito_user_table_response = cognito_user_table.get_item(Key={'CognitoId': cognito_id})
         if 'Item' in cognito_user_table_response:
             logger.info("Found existing user in Cognito ID table:", user_id=cognito_user_table_response['Item']['UserId'])
+            user_mapping_cache.add_user_id("CognitoId", cognito_id, cognito_user_table_response['Item']['UserId'])
             return True, cognito_user_table_response['Item']['UserId']
         else:
             return True, None
@@ -117,82 +114,30 @@ def get_existing_user(cognito_id):
     
     return False, None
 
-@tracer.capture_method
-def add_new_user_to_cognito_table(user_id, cognito_id):
-    try:
-        cognito_id_user_table_name = os.getenv("COGNITO_USER_TABLE")
-        cognito_id_user_table = dynamodb.Table(cognito_id_user_table_name)
-        cognito_id_user_table.put_item(
-        Item={
-            'UserId': user_id,
-            'CognitoId': cognito_id,
-        })
-        return True
-    except Exception as e:
-        logger.info("Exception adding user to Cognito ID table: ", e)
-
-    metrics.add_metric(name="new_cognito_user", unit=MetricUnit.Count, value=1)
-    
-    return False
-
 @tracer.capture_method
 def link_cognito_id_to_existing_user(user_id, cognito_id):
-    try:
-        user_table_name = os.getenv("USER_TABLE")
-        user_table = dynamodb.Table(user_table_name)
-        # Update existing user
-        user_table.update_item(
-            Key={
-                'UserId': user_id,
-            },
-            UpdateExpression="set CognitoId = :val1",
-            ExpressionAttributeValues={
-                ':val1': cognito_id
-            },
-            ConditionExpression='attribute_exists(UserId)'
-        )
-        return True
-    except Exception as e:
-        logger.info("Exception linking user to existing user: ", e)
-
-    metrics.add_metric(name="linked_user", unit=MetricUnit.Count, value=1)
-    
-    return False
+    success = cognito_link.link_to_existing_user(user_id, cognito_id)
+    if success:
+        metrics.add_metric(name="linked_user", unit=MetricUnit.Count, value=1)
+        metrics.add_metric(name="new_cognito_user", unit=MetricUnit.Count, value=1)
+    return success
 
 @tracer.capture_method
 def verify_jwt(token):
-    # Fetch the JWKS (JSON Web Key Set) from Cognito
-    try:
-        jwks = requests.get(jwks_url).json()
-    except Exception as e:
-        raise Exception(f"Error fetching JWKS: {e}")
-
     # Decode the JWT header to get the kid (Key ID)
     unverified_header = jwt.get_unverified_header(token)
     kid = unverified_header['kid']
     
-    # Find the public key in the JWKS with a matching kid
-    rsa_key = {}
-    for key in jwks['keys']:
-        if key['kid'] == kid:
-            rsa_key = {
-                "kty": key['kty'],
-                "kid": key['kid'],
-                "use": key['use'],
-                "n": key['n'],
-                "e": key['e']
-            }
-            break
-
-    if not rsa_key:
+    # Find the public key with a matching kid from the cached Cognito JWKS (JSON Web Key Set), only fetched when the kid is new
+    public_key = provider_key_cache.get_key(jwks_url, kid)
+    if public_key is None:
         raise Exception("Public key not found in JWKS")
 
     # Use the public key to verify the JWT
     try:
-        public_key = RSAAlgorithm.from_jwk(json.dumps(rsa_key))
         payload = jwt.decode(
             token,
-            public_key,
+            public_key.key,
             algorithms=['RS256'],
             options={"require": ["exp", "iss", "sub"], "verify_aud": True, "verify_signature": True, "verify_issuer": True},
             # audience=app_client_id,
@@ -212,6 +157,12 @@ def verify_jwt(token):
     except Exception as e:
         raise Exception(f"Token verification failed: {e}")
 
+def get_cognito_client():
+    global cognito_client
+    if cognito_client is None:
+        cognito_client = boto3.client('cognito-idp')
+    return cognito_client
+
 def response(status_code, message):
     return {
         "statusCode": status_code,
@@ -222,7 +173,7 @@ def response(status_code, message):
 @tracer.capture_method
 def sign_in_to_cognito(username, password):
     try:
-        response = client.initiate_auth(
+        response = get_cognito_client().initiate_auth(
             ClientId=app_client_id,
             AuthFlow='USER_PASSWORD_AUTH',
             AuthParameters={
@@ -238,7 +189,7 @@ def sign_in_to_cognito(username, password):
 @tracer.capture_method
 def sign_up_to_cognito(username, password, email):
     try:
-        response = client.sign_up(
+        response = get_cognito_client().sign_up(
             ClientId=app_client_id,
             Username=username,
             Password=password,
@@ -254,7 +205,7 @@ def sign_up_to_cognito(username, password, email):
 @tracer.capture_method
 def confirm_sign_up(username, confirmation_code):
     try:
-        response = client.confirm_sign_up(
+        response = get_cognito_client().confirm_sign_up(
             ClientId=app_client_id,
             Username=username,
             ConfirmationCode=confirmation_code
@@ -267,7 +218,7 @@ def confirm_sign_up(username, confirmation_code):
 @tracer.capture_method
 def sign_out_from_cognito(access_token):
     try:
-        response = client.global_sign_out(
+        response = get_cognito_client().global_sign_out(
             AccessToken=access_token
         )
         return response 
@@ -278,7 +229,7 @@ def sign_out_from_cognito(access_token):
 @tracer.capture_method
 def forgot_password_cognito(username):
     try:
-        response = client.forgot_password(
+        response = get_cognito_client().forgot_password(
             ClientId=app_client_id,
             Username=username
         )
@@ -290,7 +241,7 @@ def forgot_password_cognito(username):
 @tracer.capture_method
 def confirm_forgot_password(username, confirmation_code, password):
     try:
-        response = client.confirm_forgot_password(
+        response = get_cognito_client().confirm_forgot_password(
             ClientId=app_client_id,
             Username=username,
             ConfirmationCode=confirmation_code,
@@ -304,6 +255,12 @@ def confirm_forgot_password(username, confirmation_code, password):
 @metrics.log_metrics
 @tracer.capture_lambda_handler
 def lambda_handler(event, context):
+    # Shed requests over the client's rate limit before doing any of the work
+    shed_response = admission_control.check_admission(event, "cognito")
+    if shed_response != None:
+        return shed_response
+
+    pipeline = LoginPipeline("cognito")
     
     full_event = event
     event = json.loads(event['body'])
@@ -404,7 +361,7 @@ def lambda_handler(event, context):
             success = False # Indicates the whole process success (existing user or new)
 
             # OPTION 1: Try to get an existing user. This overrides any requests to link accounts
-            existing_user_request_success, user_id = get_existing_user(cognito_user_id)
+            existing_user_request_success, user_id = pipeline.run_timed("get_existing_user", get_existing_user, cognito_user_id)
             # If there was a problem getting existing user, abort as we don't want to create duplicate
             if existing_user_request_success is False:
                 record_failure_metric(f'Failed the try getting existing user')
@@ -426,8 +383,10 @@ def lambda_handler(event, context):
                             return generate_error('Error: Failed to authenticate with existing identity')
                         # Set the user_id
                         user_id = decoded_backend_token['sub']
+                        # Sign the tokens while the provider ID is linked to the user
+                        pipeline.start_signing({'sub': user_id}, "authenticated")
                         # Try to link the new user to an existing user
-                        success = link_cognito_id_to_existing_user(user_id, cognito_user_id)
+                        success = pipeline.run_timed("link_user", link_cognito_id_to_existing_user, user_id, cognito_user_id)
                         if success is False:
                             record_failure_metric(f'Failed to link new user to existing user')
                             return generate_error('Error: Failed to link new user to existing user')
@@ -435,17 +394,14 @@ def lambda_handler(event, context):
                     # OPTION 3: Else If no user yet and we didn't request linking to an existing user, create one and add to user table
                     else:
                         logger.info("No user yet, creating a new one")
-                        tries = 0
-                        while user_id is None and tries < 10:
-                            # Try to create a new user
-                            user_id = create_user(cognito_user_id)
-                            tries += 1
+                        # Sign the tokens for a new user_id while the user is created with it
+                        new_user_id = str(uuid.uuid4())
+                        pipeline.start_signing({'sub': new_user_id}, "authenticated")
+                        user_id = pipeline.run_timed("create_user", create_user, cognito_user_id, new_user_id)
                         success = True
                         if user_id is None:
                             record_failure_metric(f'Failed to create user')
                             return generate_error('Error: Failed to create user')
-                    # Add user to Cognito Id User table in both cases (linking and new user)
-                    user_creation_success = add_new_user_to_cognito_table(user_id, cognito_user_id)
 
         # Create a JWT payload and encrypt with authenticated scope
         if user_id is not None and success is True:
@@ -453,7 +409,8 @@ def lambda_handler(event, context):
                 'sub': user_id,
             }
             # Create for scope "authenticated" so backend can differentiate from guest users if needed
-            auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = encrypt(payload, "authenticated")
+            auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = pipeline.get_tokens(payload, "authenticated")
+            pipeline.record_timings()
             # NOTE: We might want to send back all attached identities from user table?
             record_success_metric()
             return generate_success(user_id, cognito_user_id, auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in)
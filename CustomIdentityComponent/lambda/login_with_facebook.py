@@ -3,15 +3,21 @@
 
 import boto3
 from botocore.config import Config
+import hashlib
 import uuid
 import os
-import jwt
-from encryption_and_decryption import encrypt, decrypt
+from encryption_and_decryption import decrypt
+from login_pipeline import LoginPipeline
+import admission_control
+from identity_linking import ProviderLink
+import user_mapping_cache
 import json
-import requests
+import partner_http
 from aws_lambda_powertools import Tracer
 from aws_lambda_powertools import Logger
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 tracer = Tracer()
 logger = Logger()
@@ -21,28 +27,23 @@ dynamodb = boto3.resource('dynamodb', config=config)
 # Endpoint to validate the access token received from the user
 facebook_validation_endpoint = "https://graph.facebook.com/"
 
-# Creates a new user when there's no existing user for the Facebook ID
-@tracer.capture_method
-def create_user(facebook_id):
+# Thread for the app validation request, made concurrently with the user validation request
+graph_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="facebook-graph")
 
-    # generate a unique id
-    user_id = str(uuid.uuid4())
+# Tokens already validated to be linked to our app, by token digest, so a repeat login with the same token only validates the user
+# The app of a token doesn't change, but the token can expire or be revoked, so the app validation is only reused for a short time
+# (the user request is still made on every login). Set in seconds with FACEBOOK_APP_VALIDATION_CACHE_TTL, 0 disables the cache
+facebook_app_validation_cache_ttl = int(os.environ.get('FACEBOOK_APP_VALIDATION_CACHE_TTL', '300'))
+facebook_app_validation_cache_max_size = 1000
+facebook_app_validation_cache = OrderedDict()
 
-    # Check that user_id doesn't exist in DynamoDB table defined in environment variable USER_TABLE
-    table = dynamodb.Table(os.environ['USER_TABLE'])
-    # Try to write a new item to the table with user_id as partition key
-    try:
-        table.put_item(
-            Item={
-                'UserId': user_id,
-                'FacebookId': facebook_id
-            },
-            ConditionExpression='attribute_not_exists(UserId)'
-        )
-    except:
-        logger.info("User already exists")
-        return None
-    
+# Facebook IDs linked to users, the user and the Facebook ID link are written in one transaction (see identity_linking)
+facebook_link = ProviderLink(dynamodb, os.getenv("FACEBOOK_USER_TABLE"), "FacebookId")
+
+# Creates a new user when there's no existing user for the Facebook ID, trying user_id first if given
+@tracer.capture_method
+def create_user(facebook_id, user_id=None):
+    user_id = facebook_link.create_user(facebook_id, user_id)
     return user_id
 
 @tracer.capture_method
@@ -75,25 +76,21 @@ def generate_success(user_id, facebook_id, jwt_token, refresh_token, auth_token_
         "isBase64Encoded": False
     }
 
-@tracer.capture_method
-def find_key_with_kid(key_set, kid):
-
-    # Check if the key is already there
-    for key in key_set:
-        if key["kid"] == kid:
-            return jwt.algorithms.RSAAlgorithm.from_jwk(key)
-        
-    return None
-
 # Tries to get an existing user from User Table. Reports error if request fails
 @tracer.capture_method
-def get_existing_user(facebook_id):
+def get_existing_user(facebook_id, bypass_cache=False):
+    # Repeat logins are served from the user mapping cache, admin flows can bypass it to always read the table
+    if not bypass_cache:
+        user_id = user_mapping_cache.get_user_id("FacebookId", facebook_id)
+        if user_id != None:
+            return True, user_id
     try:
         facebook_id_user_table_name = os.getenv("FACEBOOK_USER_TABLE");
         facebook_id_user_table = dynamodb.Table(facebook_id_user_table_name)
         facebook_id_user_table_response = facebook_id_user_table.get_item(Key={'FacebookId': facebook_id})
         if 'Item' in facebook_id_user_table_response:
             logger.info("Found existing user in Facebook ID table:", user_id=facebook_id_user_table_response['Item']['UserId'])
+            user_mapping_cache.add_user_id("FacebookId", facebook_id, facebook_id_user_table_response['Item']['UserId'])
             return True, facebook_id_user_table_response['Item']['UserId']
         else:
             return True, None
@@ -103,45 +100,57 @@ def get_existing_user(facebook_id):
     return False, None
 
 @tracer.capture_method
-def add_new_user_to_facebook_id_table(user_id, facebook_id):
-    try:
-        facebook_id_user_table_name = os.getenv("FACEBOOK_USER_TABLE");
-        facebook_id_user_table = dynamodb.Table(facebook_id_user_table_name)
-        facebook_id_user_table.put_item(
-        Item={
-            'UserId': user_id,
-            'FacebookId': facebook_id,
-        });
-        return True
-    except Exception as e:
-        logger.info("Exception adding user to Facebook ID table: ", e)
-    
-    return False
-
 def link_facebook_id_to_existing_user(user_id, facebook_id):
-    try:
-        user_table_name = os.getenv("USER_TABLE");
-        user_table = dynamodb.Table(user_table_name)
-        # Update existing user
-        user_table.update_item(
-            Key={
-                'UserId': user_id,
-            },
-            UpdateExpression="set FacebookId = :val1",
-            ExpressionAttributeValues={
-                ':val1': facebook_id
-            },
-            ConditionExpression='attribute_exists(UserId)'
-        )
-        return True
-    except Exception as e:
-        logger.info("Exception linking user to existing user: ", e)
-    
-    return False
+    success = facebook_link.link_to_existing_user(user_id, facebook_id)
+    return success
+
+def get_cached_app_validation(token_digest):
+    cached_entry = facebook_app_validation_cache.get(token_digest)
+    if cached_entry != None and cached_entry[1] > time.time():
+        return cached_entry[0]
+    facebook_app_validation_cache.pop(token_digest, None)
+    return None
+
+def add_cached_app_validation(token_digest, app_validation):
+    facebook_app_validation_cache[token_digest] = (app_validation, time.time() + facebook_app_validation_cache_ttl)
+    while len(facebook_app_validation_cache) > facebook_app_validation_cache_max_size:
+        facebook_app_validation_cache.popitem(last=False)
+
+def get_facebook_user(facebook_user_id, facebook_auth_token):
+    response = partner_http.get("Facebook", "user", facebook_validation_endpoint+facebook_user_id, params={'access_token': facebook_auth_token})
+    return response.json()
+
+def get_facebook_app(facebook_auth_token):
+    response = partner_http.get("Facebook", "app", facebook_validation_endpoint+"app", params={'access_token': facebook_auth_token})
+    return response.json()
+
+# Validates the user and the app of the token with the Graph API, and returns both response bodies
+# The two requests are made concurrently, and the app request is skipped for tokens already validated to be linked to our app
+@tracer.capture_method
+def validate_facebook_token(facebook_user_id, facebook_auth_token):
+    token_digest = hashlib.sha256(facebook_auth_token.encode()).hexdigest()
+    app_validation = get_cached_app_validation(token_digest)
+    if app_validation != None:
+        return get_facebook_user(facebook_user_id, facebook_auth_token), app_validation
+
+    app_validation_future = graph_executor.submit(get_facebook_app, facebook_auth_token)
+    user_validation = get_facebook_user(facebook_user_id, facebook_auth_token)
+    app_validation = app_validation_future.result()
+
+    # Only tokens linked to our app are cached
+    if facebook_app_validation_cache_ttl > 0 and 'error' not in app_validation and app_validation.get('id') == os.getenv("FACEBOOK_APP_ID"):
+        add_cached_app_validation(token_digest, app_validation)
+    return user_validation, app_validation
 
 # define a lambda function that returns a user_id
 @tracer.capture_lambda_handler
 def lambda_handler(event, context):
+    # Shed requests over the client's rate limit before doing any of the work
+    shed_response = admission_control.check_admission(event, "facebook")
+    if shed_response != None:
+        return shed_response
+
+    pipeline = LoginPipeline("facebook")
 
     # Check if we have facebook_auth_token in querystrings
     if 'queryStringParameters' in event and event['queryStringParameters'] is not None:         
@@ -154,14 +163,9 @@ def lambda_handler(event, context):
             validated_facebook_user_id = None
             validated_app_id = None
             try:
-                # Validate the user first
-                facebook_token_validation_response = requests.get(facebook_validation_endpoint+received_facebook_user_id,
-                                                                  params={'access_token': facebook_auth_token})
-                facebook_token_validation_response_dict = facebook_token_validation_response.json()
-
-                # Also validate the app ID so we know the token is linked to our app
-                facebook_app_validation_response = requests.get(facebook_validation_endpoint+"app", params={'access_token': facebook_auth_token})
-                facebook_app_validation_response_dict = facebook_app_validation_response.json()
+                # Validate the user, and also the app ID so we know the token is linked to our app
+                facebook_token_validation_response_dict, facebook_app_validation_response_dict = pipeline.run_timed(
+                    "validate_facebook_token", validate_facebook_token, received_facebook_user_id, facebook_auth_token)
 
             except Exception as e:
                 print(e)
@@ -186,7 +190,7 @@ def lambda_handler(event, context):
                 success = False # Indicates the whole process success (existing user or new)
 
                 # OPTION 1: Try to get an existing user. This overrides any requests to link accounts
-                existing_user_request_success, user_id = get_existing_user(validated_facebook_user_id)
+                existing_user_request_success, user_id = pipeline.run_timed("get_existing_user", get_existing_user, validated_facebook_user_id)
                 # If there was a problem getting existing user, abort as we don't want to create duplicate
                 if existing_user_request_success is False:
                     return generate_error('Error: Failed the try getting existing user')
@@ -205,24 +209,22 @@ def lambda_handler(event, context):
                             return generate_error('Error: Failed to authenticate with existing identity')
                         # Set the user_id
                         user_id = decoded_backend_token['sub']
+                        # Sign the tokens while the provider ID is linked to the user
+                        pipeline.start_signing({'sub': user_id}, "authenticated")
                         # Try to link the new user to an existing user
-                        success = link_facebook_id_to_existing_user(user_id, validated_facebook_user_id)
+                        success = pipeline.run_timed("link_user", link_facebook_id_to_existing_user, user_id, validated_facebook_user_id)
                         if success is False:
                             return generate_error('Error: Failed to link new user to existing user')
                     
                     # OPTION 3: Else If no user yet and we didn't request linking to an existing user, create one and add to user table
                     else:
                         logger.info("No user yet, creating a new one")
-                        tries = 0
-                        while user_id is None and tries < 10:
-                            # Try to create a new user
-                            user_id = create_user(validated_facebook_user_id)
-                            tries += 1
+                        # Sign the tokens for a new user_id while the user is created with it
+                        new_user_id = str(uuid.uuid4())
+                        pipeline.start_signing({'sub': new_user_id}, "authenticated")
+                        user_id = pipeline.run_timed("create_user", create_user, validated_facebook_user_id, new_user_id)
                         if user_id == None:
                             return generate_error('Error: Failed to create user')
-                    
-                    # Add user to Appe Id User table in both cases (linking and new user)
-                    user_creation_success = add_new_user_to_facebook_id_table(user_id, validated_facebook_user_id)
                 
                 # Create a JWT payload and encrypt with authenticated scope
                 if user_id is not None and success is True:
@@ -230,7 +232,8 @@ def lambda_handler(event, context):
                         'sub': user_id,
                     }
                     # Create for scope "authenticated" so backend can differentiate from guest users if needed
-                    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = encrypt(payload, "authenticated")
+                    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = pipeline.get_tokens(payload, "authenticated")
+                    pipeline.record_timings()
                     # NOTE: We might want to send back all attached identities from user table?
                     return generate_success(user_id, validated_facebook_user_id, auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in)
 
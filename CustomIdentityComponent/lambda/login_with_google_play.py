@@ -5,13 +5,16 @@ import boto3
 from botocore.config import Config
 import uuid
 import os
-import jwt
-from encryption_and_decryption import encrypt, decrypt
+from encryption_and_decryption import decrypt
+from login_pipeline import LoginPipeline
+import admission_control
+from identity_linking import ProviderLink
+import user_mapping_cache
 import json
-import requests
+import partner_http
+from secret_provider import BackgroundRefreshingSecret
 from aws_lambda_powertools import Tracer
 from aws_lambda_powertools import Logger
-import time
 
 tracer = Tracer()
 logger = Logger()
@@ -21,54 +24,18 @@ dynamodb = boto3.resource('dynamodb', config=config)
 google_play_token_creation_api_endpoint = "https://accounts.google.com/o/oauth2/token"
 google_play_token_validation_api_endpoint = "https://www.googleapis.com/games/v1/applications/"+os.environ['GOOGLE_PLAY_APP_ID']+"/verify/"
 
-# Google Play Client Secret from Secrets manager, cached between requests for 15 minutes
-google_play_client_secret = None
-last_google_play_client_secret_refresh = 0
+# Google Play Client Secret from Secrets manager, cached between requests for 30 minutes (as this changes rarely if ever) and refreshed in the background
+# through the Secrets Manager client shared by the module (see secret_provider)
+google_play_client_secret_max_age = 30 * 60
+google_play_client_secret_provider = BackgroundRefreshingSecret(os.environ['GOOGLE_PLAY_CLIENT_SECRET_ARN'], "google_play_client_secret", google_play_client_secret_max_age)
 
-def refresh_google_play_client_secret_if_needed():
-    global google_play_client_secret, last_google_play_client_secret_refresh
+# Google Play IDs linked to users, the user and the Google Play ID link are written in one transaction (see identity_linking)
+google_play_link = ProviderLink(dynamodb, os.getenv("GOOGLE_PLAY_USER_TABLE"), "GooglePlayId")
 
-    # get time difference between current time and last_private_key_refresh
-    current_time = int(time.time())
-    time_difference = current_time - last_google_play_client_secret_refresh
-    print("Time difference between current time and last_google_play_client_secret_refresh: ", time_difference)
-
-    # check if we need to refresh the private key (every 30 minutes as this changes rarely if ever)
-    if time_difference > 1800 or google_play_client_secret == None:
-        print("Refreshing Google Play Client Secret")
-
-        # get private key from AWS Secrets Manager
-        secret_arn= os.environ['GOOGLE_PLAY_CLIENT_SECRET_ARN']
-        session = boto3.session.Session()
-        client = session.client(service_name='secretsmanager')
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_arn
-        )
-        google_play_client_secret = get_secret_value_response['SecretString']
-        last_google_play_client_secret_refresh = int(time.time())
-
-# Creates a new user when there's no existing user for the Google Play ID
+# Creates a new user when there's no existing user for the Google Play ID, trying user_id first if given
 @tracer.capture_method
-def create_user(google_play_id):
-
-    # generate a unique id
-    user_id = str(uuid.uuid4())
-
-    # Check that user_id doesn't exist in DynamoDB table defined in environment variable USER_TABLE
-    table = dynamodb.Table(os.environ['USER_TABLE'])
-    # Try to write a new iteam to the table with user_id as partition key
-    try:
-        table.put_item(
-            Item={
-                'UserId': user_id,
-                'GooglePlayId': google_play_id # NOTE: You might want to add other information from the Google Play API response too
-            },
-            ConditionExpression='attribute_not_exists(UserId)'
-        )
-    except:
-        logger.info("User already exists")
-        return None
-    
+def create_user(google_play_id, user_id=None):
+    user_id = google_play_link.create_user(google_play_id, user_id)
     return user_id
 
 @tracer.capture_method
@@ -101,22 +68,21 @@ def generate_success(user_id, google_play_id, jwt_token, refresh_token, auth_tok
         "isBase64Encoded": False
     }
 
-@tracer.capture_method
-def find_key_with_kid(key_set, kid):
-    for key in key_set:
-        if key["kid"] == kid:
-            return jwt.algorithms.RSAAlgorithm.from_jwk(key)
-    return None
-
 # Tries to get an existing user from User Table. Reports error if request fails
 @tracer.capture_method
-def get_existing_user(google_play_id):
+def get_existing_user(google_play_id, bypass_cache=False):
+    # Repeat logins are served from the user mapping cache, admin flows can bypass it to always read the table
+    if not bypass_cache:
+        user_id = user_mapping_cache.get_user_id("GooglePlayId", google_play_id)
+        if user_id != None:
+            return True, user_id
     try:
         google_play_user_table_name = os.getenv("GOOGLE_PLAY_USER_TABLE");
         google_play_user_table = dynamodb.Table(google_play_user_table_name)
         google_play_user_table_response = google_play_user_table.get_item(Key={'GooglePlayId':google_play_id})
         if 'Item' in google_play_user_table_response:
             logger.info("Found existing user in Google Play User table:", user_id=google_play_user_table_response['Item']['UserId'])
+            user_mapping_cache.add_user_id("GooglePlayId", google_play_id, google_play_user_table_response['Item']['UserId'])
             return True, google_play_user_table_response['Item']['UserId']
         else:
             return True, None
@@ -126,51 +92,45 @@ def get_existing_user(google_play_id):
     return False, None
 
 @tracer.capture_method
-def add_new_user_to_google_play_table(user_id, google_play_id):
-    try:
-        google_play_user_table_name = os.getenv("GOOGLE_PLAY_USER_TABLE")
-        google_play_user_table = dynamodb.Table(google_play_user_table_name)
-        google_play_user_table.put_item(
-        Item={
-            'UserId': user_id,
-            'GooglePlayId': google_play_id # NOTE: You might want to add other information from the Google Play API response too
-        });
-        return True
-    except Exception as e:
-        logger.info("Exception adding user to Google Play User table: ", e)
-    
-    return False
-
 def link_google_play_to_existing_user(user_id, google_play_id):
-    try:
-        user_table_name = os.getenv("USER_TABLE")
-        user_table = dynamodb.Table(user_table_name)
-        # Update existing user
-        user_table.update_item(
-            Key={
-                'UserId': user_id,
-            },
-            UpdateExpression="set GooglePlayId = :val1",
-            ExpressionAttributeValues={
-                ':val1': google_play_id
-            },
-            ConditionExpression='attribute_exists(UserId)'
-        )
-        return True
-    except Exception as e:
-        logger.info("Exception linking user to existing user: ", e)
-    
-    return False
+    success = google_play_link.link_to_existing_user(user_id, google_play_id)
+    return success
+
+# Exchanges the auth code received from the client for a bearer token, returns the bearer token or None
+# NOTE: An auth code can only be exchanged once, so a retried login fails the exchange and the client has to get a new auth code
+@tracer.capture_method
+def exchange_auth_code(google_play_auth_token):
+    # Get the Google Play Client Secret for the exchange
+    google_play_client_secret, _ = google_play_client_secret_provider.get()
+    token_generation_params = {'grant_type': 'authorization_code', 'code': google_play_auth_token, 'client_id': os.environ['GOOGLE_PLAY_CLIENT_ID'], 'client_secret': google_play_client_secret}
+    token_generation_response = partner_http.post("GooglePlay", "oauth2/token", google_play_token_creation_api_endpoint, data=token_generation_params)
+    #logger.info(token_generation_response.content)
+    token_generation_response_dict = token_generation_response.json()
+    if 'access_token' not in token_generation_response_dict:
+        return None
+    return token_generation_response_dict['access_token']
+
+# Gets the Google Play ID of the bearer token, or None if the token is not valid for our app
+@tracer.capture_method
+def verify_bearer_token(google_play_auth_bearer_token):
+    token_validation_header = {'Authorization': 'Bearer ' + google_play_auth_bearer_token}
+    google_play_token_validation_response = partner_http.get("GooglePlay", "games/verify", google_play_token_validation_api_endpoint, headers=token_validation_header)
+    #logger.info(google_play_token_validation_response.content)
+    google_play_token_validation_response_dict = google_play_token_validation_response.json()
+    return google_play_token_validation_response_dict.get('player_id')
 
 # define a lambda function that returns a user_id
 @tracer.capture_lambda_handler
 def lambda_handler(event, context):
+    # Shed requests over the client's rate limit before doing any of the work
+    shed_response = admission_control.check_admission(event, "google_play")
+    if shed_response != None:
+        return shed_response
+
+    pipeline = LoginPipeline("google_play")
     
     google_play_auth_token = None
 
-    # Make sure we have the Google Play Client Secret for token validation
-    refresh_google_play_client_secret_if_needed()
-
     # Check if we have google_play_auth_token in querystrings
     if 'queryStringParameters' in event and event['queryStringParameters'] is not None:         
         if 'google_play_auth_token' in event['queryStringParameters']:
@@ -181,23 +141,13 @@ def lambda_handler(event, context):
             # Generate and validate the Google Play token and get user ID
             google_play_user_id = None
             try:
-                # Generate the Bearer token
-                token_generation_params = {'grant_type': 'authorization_code', 'code': google_play_auth_token, 'client_id': os.environ['GOOGLE_PLAY_CLIENT_ID'], 'client_secret': google_play_client_secret}
-                token_generation_response = requests.post(google_play_token_creation_api_endpoint, token_generation_params)
-                #logger.info(token_generation_response.content)
-                token_generation_response_dict = token_generation_response.json()
-                if 'access_token' in token_generation_response_dict:
-                    google_play_auth_bearer_token = token_generation_response_dict['access_token']
-                else:
+                # Generate the Bearer token, each hop is timed as a login stage
+                bearer_token = pipeline.run_timed("exchange_auth_code", exchange_auth_code, google_play_auth_token)
+                if bearer_token == None:
                     return generate_error('Error: Failed to generate Google Play bearer token')
                 # Get the user information with the bearer token
-                token_validation_header = {'Authorization': 'Bearer ' + google_play_auth_bearer_token}
-                google_play_token_validation_response = requests.get(google_play_token_validation_api_endpoint, headers=token_validation_header)
-                #logger.info(google_play_token_validation_response.content)
-                google_play_token_validation_response_dict = google_play_token_validation_response.json()
-                if 'player_id' in google_play_token_validation_response_dict:
-                    google_play_user_id = google_play_token_validation_response_dict['player_id']
-                else:
+                google_play_user_id = pipeline.run_timed("verify_bearer_token", verify_bearer_token, bearer_token)
+                if google_play_user_id == None:
                     return generate_error('Error: Failed to validate Google Play bearer token')
             except Exception as e:
                 print(e)
@@ -208,7 +158,7 @@ def lambda_handler(event, context):
                 success = False # Indicates the whole process success (existing user or new)
 
                 # OPTION 1: Try to get an existing user. This overrides any requests to link accounts
-                existing_user_request_success, user_id = get_existing_user(google_play_user_id)
+                existing_user_request_success, user_id = pipeline.run_timed("get_existing_user", get_existing_user, google_play_user_id)
                 # If there was a problem getting existing user, abort as we don't want to create duplicate
                 if existing_user_request_success is False:
                     return generate_error('Error: Failed the try getting existing user')
@@ -227,24 +177,22 @@ def lambda_handler(event, context):
                             return generate_error('Error: Failed to authenticate with existing identity')
                         # Set the user_id
                         user_id = decoded_backend_token['sub']
+                        # Sign the tokens while the provider ID is linked to the user
+                        pipeline.start_signing({'sub': user_id}, "authenticated")
                         # Try to link the new user to an existing user
-                        success = link_google_play_to_existing_user(user_id, google_play_user_id)
+                        success = pipeline.run_timed("link_user", link_google_play_to_existing_user, user_id, google_play_user_id)
                         if success is False:
                             return generate_error('Error: Failed to link new user to existing user')
                     
                     # OPTION 3: Else If no user yet and we didn't request linking to an existing user, create one and add to user table
                     else:
                         logger.info("No user yet, creating a new one")
-                        tries = 0
-                        while user_id is None and tries < 10:
-                            # Try to create a new user
-                            user_id = create_user(google_play_user_id)
-                            tries += 1
+                        # Sign the tokens for a new user_id while the user is created with it
+                        new_user_id = str(uuid.uuid4())
+                        pipeline.start_signing({'sub': new_user_id}, "authenticated")
+                        user_id = pipeline.run_timed("create_user", create_user, google_play_user_id, new_user_id)
                         if user_id == None:
                             return generate_error('Error: Failed to create user')
-                    
-                    # Add user to Appe Id User table in both cases (linking and new user)
-                    user_creation_success = add_new_user_to_google_play_table(user_id, google_play_user_id)
                 
                 # Create a JWT payload and encrypt with authenticated scope
                 if user_id is not None and success is True:
@@ -252,7 +200,8 @@ def lambda_handler(event, context):
                         'sub': user_id,
                     }
                     # Create for scope "authenticated" so backend can differentiate from guest users if needed
-                    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = encrypt(payload, "authenticated")
+                    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = pipeline.get_tokens(payload, "authenticated")
+                    pipeline.record_timings()
                     # NOTE: We might want to send back all attached identities from user table?
                     return generate_success(user_id, google_play_user_id, auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in)
 
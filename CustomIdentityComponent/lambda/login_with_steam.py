@@ -3,19 +3,25 @@
 
 import boto3
 from botocore.config import Config
-import datetime
+import hashlib
+import random
 import uuid
 import os
-from encryption_and_decryption import encrypt, decrypt
+from encryption_and_decryption import decrypt
+from login_pipeline import LoginPipeline
+import admission_control
+from identity_linking import ProviderLink
+import user_mapping_cache
 import json
-import requests
+import partner_http
 from aws_lambda_powertools import Tracer
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools import Metrics
 from aws_lambda_powertools import single_metric
 from aws_lambda_powertools.metrics import MetricUnit
-from aws_lambda_powertools.utilities import parameters
+from secret_provider import BackgroundRefreshingSecret
 import time
+from collections import OrderedDict
 
 tracer = Tracer()
 logger = Logger()
@@ -27,8 +33,25 @@ dynamodb = boto3.resource('dynamodb', config=config)
 # partner.steam-api.com is the server to server endpoint per https://partner.steamgames.com/doc/webapi_overview#3 
 steam_token_validation_api_endpoint = "https://partner.steam-api.com/ISteamUserAuth/AuthenticateUserTicket/v1/"
 
-# Steam Web Api key from Secrets manager, cached between requests for 15 minutes
+# Steam Web Api key from Secrets manager, cached between requests for 15 minutes and refreshed in the background
 steam_web_api_secret_max_age = 15 * 60
+steam_web_api_key_secret = BackgroundRefreshingSecret(os.environ['STEAM_WEB_API_KEY_SECRET_ARN'], "steam_web_api_key", steam_web_api_secret_max_age)
+
+# (connect, read) timeouts for the Steam API request in seconds, requests applies them separately so a request can take their sum
+steam_request_timeout = (2, 3)
+
+# Retries on Steam error 103 with exponential backoff and full jitter (a random delay up to base * 2^retry, capped to the max delay)
+steam_max_retries = 4
+steam_retry_base_delay = 0.25
+steam_retry_max_delay = 2
+
+# Time in milliseconds left for the rest of the login after the Steam validation, a retry is only made if it fits the Lambda timeout with this
+steam_retry_deadline_margin_ms = 2000
+
+# Validated tickets by ticket digest, so a client retrying the same login doesn't call the Steam API again
+steam_ticket_cache_ttl = 60
+steam_ticket_cache_max_size = 1000
+steam_ticket_cache = OrderedDict()
 
 def record_success_metric():
     metrics.add_metric(name="success", unit=MetricUnit.Count, value=1)
@@ -44,30 +67,16 @@ def record_failure_metric(reason: str):
         metric.add_dimension(
             name="reason", value=reason)
 
-# Creates a new user when there's no existing user for the Steam ID
-@tracer.capture_method
-def create_user(steam_id):
-
-    # generate a unique id
-    user_id = str(uuid.uuid4())
+# Steam IDs linked to users, the user and the Steam ID link are written in one transaction (see identity_linking)
+steam_link = ProviderLink(dynamodb, os.getenv("STEAM_USER_TABLE"), "SteamId")
 
-    # Check that user_id doesn't exist in DynamoDB table defined in environment variable USER_TABLE
-    table = dynamodb.Table(os.environ['USER_TABLE'])
-    # Try to write a new iteam to the table with user_id as partition key
-    try:
-        table.put_item(
-            Item={
-                'UserId': user_id,
-                'SteamId': steam_id # NOTE: You might want to add other information from the Steam API response too
-            },
-            ConditionExpression='attribute_not_exists(UserId)'
-        )
-    except:
-        logger.info("User already exists")
-        return None
-    
-    metrics.add_metric(name="created_user", unit=MetricUnit.Count, value=1)
-    
+# Creates a new user when there's no existing user for the Steam ID, trying user_id first if given
+@tracer.capture_method
+def create_user(steam_id, user_id=None):
+    user_id = steam_link.create_user(steam_id, user_id)
+    if user_id != None:
+        metrics.add_metric(name="created_user", unit=MetricUnit.Count, value=1)
+        metrics.add_metric(name="new_steam_user", unit=MetricUnit.Count, value=1)
     return user_id
 
 @tracer.capture_method
@@ -102,13 +111,19 @@ def generate_success(user_id, steam_id, jwt_token, refresh_token, auth_token_exp
 
 # Tries to get an existing user from User Table. Reports error if request fails
 @tracer.capture_method
-def get_existing_user(steam_id):
+def get_existing_user(steam_id, bypass_cache=False):
+    # Repeat logins are served from the user mapping cache, admin flows can bypass it to always read the table
+    if not bypass_cache:
+        user_id = user_mapping_cache.get_user_id("SteamId", steam_id)
+        if user_id != None:
+            return True, user_id
     try:
         steam_user_table_name = os.getenv("STEAM_USER_TABLE");
         steam_user_table = dynamodb.Table(steam_user_table_name)
         steam_user_table_response = steam_user_table.get_item(Key={'SteamId':steam_id})
         if 'Item' in steam_user_table_response:
             logger.info("Found existing user in Steam ID table:", user_id=steam_user_table_response['Item']['UserId'])
+            user_mapping_cache.add_user_id("SteamId", steam_id, steam_user_table_response['Item']['UserId'])
             return True, steam_user_table_response['Item']['UserId']
         else:
             return True, None
@@ -118,68 +133,55 @@ def get_existing_user(steam_id):
     return False, None
 
 @tracer.capture_method
-def add_new_user_to_steam_table(user_id, steam_id):
-    try:
-        steam_id_user_table_name = os.getenv("STEAM_USER_TABLE")
-        steam_id_user_table = dynamodb.Table(steam_id_user_table_name)
-        steam_id_user_table.put_item(
-        Item={
-            'UserId': user_id,
-            'SteamId': steam_id,
-        })
-        return True
-    except Exception as e:
-        logger.info("Exception adding user to Steam ID table: ", e)
-
-    metrics.add_metric(name="new_steam_user", unit=MetricUnit.Count, value=1)
-    
-    return False
-
 def link_steam_id_to_existing_user(user_id, steam_id):
-    try:
-        user_table_name = os.getenv("USER_TABLE")
-        user_table = dynamodb.Table(user_table_name)
-        # Update existing user
-        user_table.update_item(
-            Key={
-                'UserId': user_id,
-            },
-            UpdateExpression="set SteamId = :val1",
-            ExpressionAttributeValues={
-                ':val1': steam_id
-            },
-            ConditionExpression='attribute_exists(UserId)'
-        )
-        return True
-    except Exception as e:
-        logger.info("Exception linking user to existing user: ", e)
+    success = steam_link.link_to_existing_user(user_id, steam_id)
+    if success:
+        metrics.add_metric(name="linked_user", unit=MetricUnit.Count, value=1)
+        metrics.add_metric(name="new_steam_user", unit=MetricUnit.Count, value=1)
+    return success
+
+def get_cached_steam_id(ticket_digest):
+    cached_entry = steam_ticket_cache.get(ticket_digest)
+    if cached_entry != None and cached_entry[1] > time.time():
+        return cached_entry[0]
+    steam_ticket_cache.pop(ticket_digest, None)
+    return None
+
+def add_cached_steam_id(ticket_digest, steam_user_id):
+    steam_ticket_cache[ticket_digest] = (steam_user_id, time.time() + steam_ticket_cache_ttl)
+    while len(steam_ticket_cache) > steam_ticket_cache_max_size:
+        steam_ticket_cache.popitem(last=False)
+
+def record_steam_metric(name, unit, value):
+    with single_metric(
+        name=name,
+        unit=unit,
+        value=value,
+        default_dimensions=metrics.default_dimensions
+    ) as metric:
+        metric.add_dimension(name="partner", value='Steam')
+        metric.add_dimension(name="api", value='ISteamUserAuth/AuthenticateUserTicket/v1')
 
-    metrics.add_metric(name="linked_user", unit=MetricUnit.Count, value=1)
-    
-    return False
+# Returns the Steam ID for a valid ticket, or None. The context is used to stop retrying before the Lambda function times out
+def check_steam_token(token: str, context=None) -> str:
+    ticket_digest = hashlib.sha256(token.encode()).hexdigest()
+    steam_user_id = get_cached_steam_id(ticket_digest)
+    if steam_user_id != None:
+        logger.info("Steam ticket validated from cache", steam_user_id=steam_user_id)
+        return steam_user_id
 
-def check_steam_token(token: str) -> str:
     response = None
     response_body = {}
 
-    # We will try validating the steam token if we get a 103 error (rare)
-    # Note: The Lambda function will time out in the very unlikely case of this error happening 15 times in a row
+    # We will retry validating the steam token if we get a 103 error (rare), as long as there's time left
+    retries = 0
     while True:
-        steam_web_api_key = parameters.get_secret(os.environ['STEAM_WEB_API_KEY_SECRET_ARN'], max_age=steam_web_api_secret_max_age)
-        send_time = datetime.datetime.utcnow()
-        response = requests.get(steam_token_validation_api_endpoint, 
-                                params={'key': steam_web_api_key, 'appid': os.environ['STEAM_APP_ID'], 'ticket': token})
-        elapsed_ms = round(((datetime.datetime.utcnow()-send_time).microseconds)/1000)
-        logger.debug(f'Steam response', elapsed_ms=elapsed_ms, code=response.status_code, headers=response.headers, body=response.text)
-
-        with single_metric(
-            name="duration",
-            unit=MetricUnit.Milliseconds,
-            value=elapsed_ms,
-            default_dimensions=metrics.default_dimensions
-        ) as metric:
-            metric.add_dimension(name="partner", value='Steam')
-            metric.add_dimension(name="api", value='ISteamUserAuth/AuthenticateUserTicket/v1')
+        steam_web_api_key, _ = steam_web_api_key_secret.get()
+        # The request duration is recorded by partner_http
+        response = partner_http.get("Steam", "ISteamUserAuth/AuthenticateUserTicket/v1", steam_token_validation_api_endpoint,
+                                    params={'key': steam_web_api_key, 'appid': os.environ['STEAM_APP_ID'], 'ticket': token},
+                                    timeout=steam_request_timeout)
+        logger.debug(f'Steam response', elapsed_ms=round(response.elapsed.total_seconds() * 1000), code=response.status_code, headers=response.headers, body=response.text)
         
         if response.status_code != 200:
             logger.error("Steam returned an error", response_code=response.status_code)
@@ -188,20 +190,21 @@ def check_steam_token(token: str) -> str:
 
         response_body = response.json()
 
-        # retry on error code 103 after a second
+        # retry on error code 103 after a jittered exponential delay
         if response_body.get('response', {}).get('error', {}).get('errorcode', 0) != 103:
             break
 
-        logger.info("Received 103, retrying after a delay")
-        with single_metric(
-            name="retry",
-            unit=MetricUnit.Count,
-            value=1,
-            default_dimensions=metrics.default_dimensions
-        ) as metric:
-            metric.add_dimension(name="partner", value='Steam')
-            metric.add_dimension(name="api", value='ISteamUserAuth/AuthenticateUserTicket/v1')
-        time.sleep(1)
+        delay = random.uniform(0, min(steam_retry_max_delay, steam_retry_base_delay * 2 ** retries))
+        remaining_ms = context.get_remaining_time_in_millis() if context != None else None
+        if retries >= steam_max_retries or (remaining_ms != None and remaining_ms < (delay + sum(steam_request_timeout)) * 1000 + steam_retry_deadline_margin_ms):
+            logger.error("Received 103, no retries left", retries=retries, remaining_ms=remaining_ms)
+            record_failure_metric(f'Steam returned 103')
+            return None
+
+        logger.info("Received 103, retrying after a delay", delay=delay)
+        record_steam_metric("retry", MetricUnit.Count, 1)
+        retries += 1
+        time.sleep(delay)
 
     response_dict = response_body.get('response', {}).get('params', {})
     if not 'result' in response_dict or response_dict['result'] != 'OK':
@@ -226,6 +229,7 @@ def check_steam_token(token: str) -> str:
         record_failure_metric(f'Publisher Banned')
         return None
     
+    add_cached_steam_id(ticket_digest, steam_user_id)
     return steam_user_id
 
 
@@ -233,6 +237,12 @@ def check_steam_token(token: str) -> str:
 @metrics.log_metrics
 @tracer.capture_lambda_handler
 def lambda_handler(event, context):
+    # Shed requests over the client's rate limit before doing any of the work
+    shed_response = admission_control.check_admission(event, "steam")
+    if shed_response != None:
+        return shed_response
+
+    pipeline = LoginPipeline("steam")
     
     steam_auth_token = None
 
@@ -246,7 +256,7 @@ def lambda_handler(event, context):
             # Validate the Steam auth token, and get Steam user ID
             steam_user_id = None
             try:
-                steam_user_id = check_steam_token(steam_auth_token)
+                steam_user_id = pipeline.run_timed("validate_steam_token", check_steam_token, steam_auth_token, context)
                 
                 # Check if we received a valid success response from Steam
                 if steam_user_id:
@@ -265,7 +275,7 @@ def lambda_handler(event, context):
                 success = False # Indicates the whole process success (existing user or new)
 
                 # OPTION 1: Try to get an existing user. This overrides any requests to link accounts
-                existing_user_request_success, user_id = get_existing_user(steam_user_id)
+                existing_user_request_success, user_id = pipeline.run_timed("get_existing_user", get_existing_user, steam_user_id)
                 # If there was a problem getting existing user, abort as we don't want to create duplicate
                 if existing_user_request_success is False:
                     record_failure_metric(f'Failed the try getting existing user')
@@ -286,8 +296,10 @@ def lambda_handler(event, context):
                             return generate_error('Error: Failed to authenticate with existing identity')
                         # Set the user_id
                         user_id = decoded_backend_token['sub']
+                        # Sign the tokens while the provider ID is linked to the user
+                        pipeline.start_signing({'sub': user_id}, "authenticated")
                         # Try to link the new user to an existing user
-                        success = link_steam_id_to_existing_user(user_id, steam_user_id)
+                        success = pipeline.run_timed("link_user", link_steam_id_to_existing_user, user_id, steam_user_id)
                         if success is False:
                             record_failure_metric(f'Failed to link new user to existing user')
                             return generate_error('Error: Failed to link new user to existing user')
@@ -295,17 +307,13 @@ def lambda_handler(event, context):
                     # OPTION 3: Else If no user yet and we didn't request linking to an existing user, create one and add to user table
                     else:
                         logger.info("No user yet, creating a new one")
-                        tries = 0
-                        while user_id is None and tries < 10:
-                            # Try to create a new user
-                            user_id = create_user(steam_user_id)
-                            tries += 1
+                        # Sign the tokens for a new user_id while the user is created with it
+                        new_user_id = str(uuid.uuid4())
+                        pipeline.start_signing({'sub': new_user_id}, "authenticated")
+                        user_id = pipeline.run_timed("create_user", create_user, steam_user_id, new_user_id)
                         if user_id == None:
                             record_failure_metric(f'Failed to create user')
                             return generate_error('Error: Failed to create user')
-                    
-                    # Add user to Appe Id User table in both cases (linking and new user)
-                    user_creation_success = add_new_user_to_steam_table(user_id, steam_user_id)
                 
                 # Create a JWT payload and encrypt with authenticated scope
                 if user_id is not None and success is True:
@@ -313,7 +321,8 @@ def lambda_handler(event, context):
                         'sub': user_id,
                     }
                     # Create for scope "authenticated" so backend can differentiate from guest users if needed
-                    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = encrypt(payload, "authenticated")
+                    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = pipeline.get_tokens(payload, "authenticated")
+                    pipeline.record_timings()
                     # NOTE: We might want to send back all attached identities from user table?
                     record_success_metric()
                     return generate_success(user_id, steam_user_id, auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in)
@@ -0,0 +1,174 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# HTTP client for the partner identity APIs (Steam, Google Play, Facebook, and the Apple and Cognito key sets)
+# Each partner has a requests Session kept in the Lambda environment, so warm invocations reuse the pooled keep-alive connections
+# instead of doing a new TLS handshake for every login. Requests have default timeouts, their latency is recorded per partner and API,
+# and a partner that keeps failing is short-circuited for a while (circuit breaker) instead of holding logins until they time out
+
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from aws_lambda_powertools import single_metric
+from aws_lambda_powertools.metrics import MetricUnit
+
+# Default (connect, read) timeouts in seconds
+default_timeout = (2, 3)
+
+# Maximum amount of pooled connections per host. Lambda serves one request at a time, so this only needs to cover concurrent partner calls
+connection_pool_size = 10
+
+# Consecutive failures (connection errors, timeouts and 5xx responses) after which the circuit of a partner opens
+circuit_failure_threshold = 5
+
+# How long an open circuit rejects requests in seconds, after which a single trial request is let through
+circuit_open_duration = 30
+
+# Latency histogram bucket upper bounds in milliseconds, the last bucket counts everything slower
+latency_buckets_ms = [25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+# Raised without calling the partner while its circuit is open
+class PartnerUnavailableError(Exception):
+    pass
+
+class PartnerCircuit:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    # Returns True if a request can be made: the circuit is closed, or it has been open long enough and no trial request is running
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at == None:
+                return True
+            if self.trial_in_progress or time.time() - self.opened_at < circuit_open_duration:
+                return False
+            self.trial_in_progress = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    # Returns True if this failure opened the circuit
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            was_open = self.opened_at != None
+            if self.trial_in_progress or self.consecutive_failures >= circuit_failure_threshold:
+                self.opened_at = time.time()
+            self.trial_in_progress = False
+            return not was_open and self.opened_at != None
+
+    def get_state(self):
+        if self.opened_at == None:
+            return "closed"
+        return "half_open" if time.time() - self.opened_at >= circuit_open_duration else "open"
+
+class PartnerClient:
+
+    def __init__(self, partner):
+        self.partner = partner
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=connection_pool_size, pool_maxsize=connection_pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.circuit = PartnerCircuit()
+        # Latency histograms by api, and request and failure counters
+        self.latency_histograms = {}
+        self.request_count = 0
+        self.failure_count = 0
+        self.rejected_count = 0
+
+    def record_latency(self, api, elapsed_ms):
+        histogram = self.latency_histograms.get(api)
+        if histogram == None:
+            histogram = [0] * (len(latency_buckets_ms) + 1)
+            self.latency_histograms[api] = histogram
+        bucket = 0
+        while bucket < len(latency_buckets_ms) and elapsed_ms > latency_buckets_ms[bucket]:
+            bucket += 1
+        histogram[bucket] += 1
+
+    # Makes the request, api names the endpoint in the metrics. Raises PartnerUnavailableError if the circuit is open,
+    # and the requests exception if the request fails. Any response is returned, only 5xx responses count as partner failures
+    def request(self, method, url, api, **kwargs):
+        if not self.circuit.allow_request():
+            self.rejected_count += 1
+            record_partner_metric("partner_circuit_rejected", MetricUnit.Count, 1, self.partner, api)
+            raise PartnerUnavailableError(f"{self.partner} circuit is open")
+
+        kwargs.setdefault("timeout", default_timeout)
+        self.request_count += 1
+        send_time = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            self.record_failure(api)
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - send_time) * 1000
+            self.record_latency(api, elapsed_ms)
+            record_partner_metric("duration", MetricUnit.Milliseconds, round(elapsed_ms), self.partner, api)
+
+        if response.status_code >= 500:
+            self.record_failure(api)
+        else:
+            self.circuit.record_success()
+        return response
+
+    def record_failure(self, api):
+        self.failure_count += 1
+        if self.circuit.record_failure():
+            print("Circuit opened for partner ", self.partner)
+            record_partner_metric("partner_circuit_opened", MetricUnit.Count, 1, self.partner, api)
+
+    def get_stats(self):
+        return {
+            "requests": self.request_count,
+            "failures": self.failure_count,
+            "rejected": self.rejected_count,
+            "circuit": self.circuit.get_state(),
+            "latency_buckets_ms": latency_buckets_ms,
+            "latency_histograms": {api: list(histogram) for api, histogram in self.latency_histograms.items()}
+        }
+
+# Clients by partner name, shared by everything running in the Lambda environment
+partner_clients = {}
+partner_clients_lock = threading.Lock()
+
+def get_partner_client(partner):
+    client = partner_clients.get(partner)
+    if client == None:
+        with partner_clients_lock:
+            client = partner_clients.get(partner)
+            if client == None:
+                client = PartnerClient(partner)
+                partner_clients[partner] = client
+    return client
+
+def get(partner, api, url, **kwargs):
+    return get_partner_client(partner).request("GET", url, api, **kwargs)
+
+def post(partner, api, url, **kwargs):
+    return get_partner_client(partner).request("POST", url, api, **kwargs)
+
+def get_partner_stats():
+    return {partner: client.get_stats() for partner, client in partner_clients.items()}
+
+def record_partner_metric(name, unit, value, partner, api):
+    try:
+        with single_metric(name=name, unit=unit, value=value) as metric:
+            if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+                metric.add_dimension(name="function", value=os.environ['AWS_LAMBDA_FUNCTION_NAME'])
+            metric.add_dimension(name="partner", value=partner)
+            metric.add_dimension(name="api", value=api)
+    except Exception as e:
+        print("Error recording partner metrics: ", e)
@@ -0,0 +1,146 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Cache for the public keys (JWKS) of token issuers: our own issuer endpoint as well as Apple, Cognito and other identity providers
+# The keys are parsed once per fetch, kept between invocations of a warm Lambda environment, and revalidated with the issuer's
+# Cache-Control and ETag headers instead of being fetched for every login
+# NOTE: token_verifier/custom_identity_verifier/jwks_cache.py is a standalone thread-safe version of this cache for game servers, with the
+# same defaults and the same max-age, ETag and unknown kid behaviour. Keep the two in sync, tests/test_jwks_caches.py runs the same cases on both
+
+import jwt
+import time
+from urllib.parse import urlparse
+
+# Minimum time between two fetches of the same jwks url in seconds
+jwks_min_refresh_interval = 30
+
+# How long a kid that was missing from a freshly fetched key set is rejected without refetching, in seconds
+unknown_kid_cache_ttl = 300
+
+# Maximum amount of unknown kids remembered, so a flood of forged kids can't grow the cache without limit
+unknown_kid_cache_max_size = 1000
+
+# Timeout for fetching a jwks url in seconds
+jwks_request_timeout = 3
+
+# Returns the max-age in seconds from a Cache-Control header, or None if the header doesn't define one
+def get_max_age(cache_control):
+    if cache_control == None:
+        return None
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        name = name.lower()
+        if name == "no-cache" or name == "no-store":
+            return 0
+        if name == "max-age":
+            try:
+                return max(int(value.strip('"')), 0)
+            except ValueError:
+                return None
+    return None
+
+# Public keys of an issuer indexed by kid, parsed once when the key set is loaded (as PyJWK objects carrying their algorithm)
+class JwksKeySet:
+
+    def __init__(self, jwks_url):
+        self.jwks_url = jwks_url
+        self.keys = {}
+        self.unknown_kids = {}
+        self.last_refresh = 0
+        self.etag = None
+        # Keys are revalidated after this time, None when the issuer didn't define a max-age (refreshed only for new kids)
+        self.expires_at = None
+        self.fetch_count = 0
+        self.not_modified_count = 0
+
+    def load_key_set(self, key_set):
+        keys = {}
+        for key in key_set.get("keys", []):
+            if "kid" not in key:
+                continue
+            try:
+                keys[key["kid"]] = jwt.PyJWK(key)
+            except Exception as e:
+                print("Skipping unsupported key in key set: ", key["kid"], e)
+        # Replace the whole dictionary so lookups never see a partially loaded key set, and check the kids again against the new keys
+        self.keys = keys
+        self.unknown_kids = {}
+
+    def refresh(self):
+        self.last_refresh = time.time()
+
+        # Revalidate with the ETag of the keys we have, so an unchanged key set is a 304 without a body
+        headers = {}
+        if self.etag != None and self.keys:
+            headers["If-None-Match"] = self.etag
+        # partner_http (and requests) is only imported when keys are fetched, so functions that rarely fetch keys don't pay for it on cold start
+        # The keys are fetched through the pooled connection of the issuer host, which is also the partner name in the metrics
+        import partner_http
+        response = partner_http.get(urlparse(self.jwks_url).hostname, "jwks", self.jwks_url, headers=headers, timeout=jwks_request_timeout)
+        self.fetch_count += 1
+
+        if response.status_code == 304:
+            self.not_modified_count += 1
+        else:
+            response.raise_for_status()
+            self.load_key_set(response.json())
+            self.etag = response.headers.get("ETag")
+
+        max_age = get_max_age(response.headers.get("Cache-Control"))
+        self.expires_at = time.time() + max_age if max_age != None else None
+
+    # Refreshes the keys unless they were refreshed within the last jwks_min_refresh_interval, returns True if refreshed
+    def try_refresh(self, current_time):
+        if current_time - self.last_refresh < jwks_min_refresh_interval:
+            return False
+        try:
+            self.refresh()
+            return True
+        except Exception as e:
+            print("Error refreshing key set from ", self.jwks_url, ": ", e)
+            return False
+
+    def get_key(self, kid):
+        current_time = time.time()
+
+        # Revalidate keys that are past the max-age the issuer defined
+        refreshed = False
+        if self.expires_at != None and current_time >= self.expires_at:
+            refreshed = self.try_refresh(current_time)
+
+        key = self.keys.get(kid)
+        if key != None:
+            return key
+
+        # Reject kids we already know are not published by the issuer
+        if self.unknown_kids.get(kid, 0) > current_time:
+            return None
+
+        # Refresh the keys at most once per jwks_min_refresh_interval, whatever kids we receive
+        if not refreshed:
+            print("kid not in key set, refresh the keys")
+            refreshed = self.try_refresh(current_time)
+            if not refreshed:
+                return None
+
+        key = self.keys.get(kid)
+        if key == None:
+            # Remember the kid as unknown so it won't trigger new fetches
+            if len(self.unknown_kids) >= unknown_kid_cache_max_size:
+                self.unknown_kids.clear()
+            self.unknown_kids[kid] = current_time + unknown_kid_cache_ttl
+        return key
+
+# Key sets by jwks url, shared by everything running in the Lambda environment
+key_sets = {}
+
+def get_key_set(jwks_url):
+    key_set = key_sets.get(jwks_url)
+    if key_set == None:
+        key_set = JwksKeySet(jwks_url)
+        key_sets[jwks_url] = key_set
+    return key_set
+
+# Returns the parsed public key (PyJWK) for the kid from the jwks url, or None if the issuer doesn't publish the kid
+def get_key(jwks_url, kid):
+    return get_key_set(jwks_url).get_key(kid)
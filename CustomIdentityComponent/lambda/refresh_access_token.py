@@ -1,17 +1,29 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3
-import uuid
 import os
-from encryption_and_decryption import encrypt, decrypt_refresh_token
+from encryption_and_decryption import encrypt, encrypt_access, get_signing_kid, decrypt_refresh_token, get_access_token_scope, get_token_kid
+from token_lifetimes import refresh_token_expiration_days
 import json
+import time
 
 from aws_lambda_powertools import Tracer
 from aws_lambda_powertools import Logger
 tracer = Tracer()
 logger = Logger()
 
+# When to sign a new refresh token, set with REFRESH_TOKEN_REISSUE_POLICY:
+# "always" signs a new refresh token (with the same expiration) on every refresh
+# "sliding" returns the received refresh token with a new access token, and signs a new refresh token only when the received one was
+# signed with a previous key (keeping its expiration) or expires within the reissue window (with a new full expiration, up to the session lifetime)
+refresh_token_reissue_policy = os.environ.get('REFRESH_TOKEN_REISSUE_POLICY', 'always')
+
+# Refresh tokens expiring within this many seconds are reissued with the sliding policy, set with REFRESH_TOKEN_REISSUE_WINDOW
+refresh_token_reissue_window = int(os.environ.get('REFRESH_TOKEN_REISSUE_WINDOW', str(24 * 60 * 60)))
+
+# Maximum time in seconds from the login (the auth_time claim) that the sliding policy extends a session to, set with REFRESH_TOKEN_MAX_SESSION_LIFETIME
+refresh_token_max_session_lifetime = int(os.environ.get('REFRESH_TOKEN_MAX_SESSION_LIFETIME', str(30 * 24 * 60 * 60)))
+
 @tracer.capture_method
 def generate_error(message):
     return {
@@ -23,6 +35,15 @@ def generate_error(message):
         'body': message
     }
 
+# Returns the expiration of the refresh token reissued from one expiring at exp. The expiration is kept, except with the sliding policy close
+# to the expiration, where it's extended to a full refresh token lifetime but not past the maximum session lifetime from the login (auth_time)
+def get_new_refresh_token_exp(exp, auth_time):
+    current_time = int(time.time())
+    if refresh_token_reissue_policy != "sliding" or exp - current_time > refresh_token_reissue_window:
+        return exp
+    session_expires_at = auth_time + refresh_token_max_session_lifetime
+    return max(exp, min(current_time + refresh_token_expiration_days * 24 * 60 * 60, session_expires_at))
+
 # define a lambda function that returns a user_id
 @tracer.capture_lambda_handler
 def lambda_handler(event, context):
@@ -30,6 +51,8 @@ def lambda_handler(event, context):
     user_id = None
     scope = None
     existing_exp_value = None
+    existing_kid = None
+    session_claims = None
     # Check if we have a refresh token in the request
     if 'queryStringParameters' in event and event['queryStringParameters'] is not None:         
         if 'refresh_token' in event['queryStringParameters']:
@@ -43,8 +66,12 @@ def lambda_handler(event, context):
                     return generate_error('Error: Failed to validate refresh token')
                 # Set the user_id and access scope
                 user_id = decoded_refresh_token['sub']
-                scope = decoded_refresh_token['access_token_scope']
+                scope = get_access_token_scope(decoded_refresh_token)
                 existing_exp_value = decoded_refresh_token['exp']
+                existing_kid = get_token_kid(refresh_token)
+                # The reissued refresh token keeps the session ID, so revoking any refresh token of the session revokes all of them, and the
+                # login time (refresh tokens created before auth_time was added use the time they were issued)
+                session_claims = {'jti': decoded_refresh_token.get('jti'), 'auth_time': decoded_refresh_token.get('auth_time', decoded_refresh_token['iat'])}
             except:
                 return generate_error('Error: Failed to validate refresh token')
     else:
@@ -57,8 +84,15 @@ def lambda_handler(event, context):
     payload = {
         'sub': user_id
     }
-    # Note, we will generate a new refresh token as well every time
-    auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = encrypt(payload, scope, existing_exp_value)
+    received_refresh_token = event['queryStringParameters']['refresh_token']
+    new_exp_value = get_new_refresh_token_exp(existing_exp_value, session_claims['auth_time'])
+    if refresh_token_reissue_policy == "sliding" and existing_kid == get_signing_kid() and new_exp_value == existing_exp_value:
+        # Only sign a new access token, the client keeps using the refresh token it sent
+        auth_token, auth_token_expires_in = encrypt_access(payload, scope)
+        refresh_token = received_refresh_token
+        refresh_token_expires_in = existing_exp_value - int(time.time())
+    else:
+        auth_token, refresh_token, auth_token_expires_in, refresh_token_expires_in = encrypt(payload, scope, new_exp_value, session_claims)
 
     # Return jwt
     return {
@@ -0,0 +1,58 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+from encryption_and_decryption import decrypt_refresh_token, revoke_refresh_token
+import json
+
+from aws_lambda_powertools import Tracer
+from aws_lambda_powertools import Logger
+tracer = Tracer()
+logger = Logger()
+
+@tracer.capture_method
+def generate_error(message):
+    return {
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Credentials': True
+        },
+        'statusCode': 401,
+        'body': message
+    }
+
+# Revokes the refresh token in the request (for example when the player logs out), so it can't be used for refreshing anymore
+@tracer.capture_lambda_handler
+def lambda_handler(event, context):
+
+    if 'queryStringParameters' not in event or event['queryStringParameters'] is None or 'refresh_token' not in event['queryStringParameters']:
+        return generate_error('Error: No refresh token provided')
+
+    refresh_token = event['queryStringParameters']['refresh_token']
+
+    # Only valid refresh tokens that haven't been revoked yet can be revoked
+    decoded_refresh_token = decrypt_refresh_token(refresh_token)
+    if decoded_refresh_token is None:
+        return generate_error('Error: Failed to validate refresh token')
+    if 'jti' not in decoded_refresh_token:
+        return generate_error('Error: Refresh token can not be revoked')
+
+    try:
+        revoke_refresh_token(refresh_token, decoded_refresh_token)
+    except Exception as e:
+        logger.exception("Error revoking refresh token")
+        return generate_error('Error: Failed to revoke refresh token')
+
+    logger.info("Revoked refresh token", user_id=decoded_refresh_token['sub'], jti=decoded_refresh_token['jti'])
+
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Credentials': True
+        },
+        'body': json.dumps({
+            'user_id' : decoded_refresh_token['sub'],
+            'revoked' : True
+        }),
+        "isBase64Encoded": False
+    }
@@ -0,0 +1,98 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Secrets Manager values cached in the Lambda environment and refreshed in a background thread ahead of their expiry,
+# so that requests keep being served from the cached value instead of waiting for a Secrets Manager round trip
+
+import boto3
+from botocore.config import Config
+import random
+import threading
+import time
+from aws_lambda_powertools import single_metric
+from aws_lambda_powertools.metrics import MetricUnit
+
+# Start the background refresh this many seconds before the max age of the value
+default_refresh_ahead = 120
+
+# Random extra time in seconds added to the refresh ahead, so that concurrent Lambda environments don't all refresh at the same time
+default_refresh_jitter = 60
+
+# Secrets Manager client shared by all secrets, created on first use
+secrets_manager_client = None
+
+def get_secrets_manager_client():
+    global secrets_manager_client
+    if secrets_manager_client == None:
+        secrets_manager_client = boto3.client('secretsmanager', config=Config(connect_timeout=2, read_timeout=2))
+    return secrets_manager_client
+
+class BackgroundRefreshingSecret:
+
+    # name is used as the metric dimension. The value is refreshed in the background after max_age minus the refresh ahead and jitter,
+    # a stale value is served while the background refresh runs, and the value is only fetched synchronously if there's no value yet
+    # or it's older than max_stale_age (for example when the environment was idle past the refresh)
+    def __init__(self, secret_id, name, max_age, refresh_ahead=default_refresh_ahead, refresh_jitter=default_refresh_jitter, max_stale_age=None):
+        self.secret_id = secret_id
+        self.name = name
+        self.max_age = max_age
+        self.refresh_ahead = min(refresh_ahead, max_age)
+        self.refresh_jitter = refresh_jitter
+        self.max_stale_age = max_stale_age if max_stale_age != None else max_age * 2
+        # Value, version ID and fetch time, replaced as a single tuple so readers never see a mix of two versions
+        self.cached_secret = None
+        self.refresh_at = 0
+        self.refresh_lock = threading.Lock()
+        self.refresh_thread = None
+
+    # Returns the secret value and its Secrets Manager version ID
+    def get(self):
+        cached_secret = self.cached_secret
+        current_time = time.time()
+
+        if cached_secret == None or current_time - cached_secret[2] >= self.max_stale_age:
+            self.refresh()
+            cached_secret = self.cached_secret
+        elif current_time >= self.refresh_at:
+            self.start_background_refresh()
+
+        return cached_secret[0], cached_secret[1]
+
+    def start_background_refresh(self):
+        with self.refresh_lock:
+            if self.refresh_thread != None and self.refresh_thread.is_alive():
+                return
+            # NOTE: Lambda freezes the environment between invocations, so the refresh might complete during the next invocation
+            self.refresh_thread = threading.Thread(target=self.refresh_in_background, daemon=True)
+            self.refresh_thread.start()
+
+    def refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            # Keep serving the cached value, and try again after the jitter
+            print("Error refreshing secret in the background: ", self.name, e)
+            self.refresh_at = time.time() + random.uniform(1, max(self.refresh_jitter, 1))
+
+    def refresh(self):
+        start = time.perf_counter()
+        response = get_secrets_manager_client().get_secret_value(SecretId=self.secret_id)
+        refresh_latency_ms = (time.perf_counter() - start) * 1000
+
+        previous_secret = self.cached_secret
+        fetched_at = time.time()
+        self.cached_secret = (response['SecretString'], response.get('VersionId'), fetched_at)
+        self.refresh_at = fetched_at + self.max_age - self.refresh_ahead - random.uniform(0, self.refresh_jitter)
+
+        # Staleness is how old the value being replaced was
+        staleness = fetched_at - previous_secret[2] if previous_secret != None else 0
+        record_refresh_metrics(self.name, refresh_latency_ms, staleness)
+
+def record_refresh_metrics(name, refresh_latency_ms, staleness):
+    try:
+        with single_metric(name="secret_refresh_latency", unit=MetricUnit.Milliseconds, value=refresh_latency_ms) as metric:
+            metric.add_dimension(name="secret", value=name)
+        with single_metric(name="secret_staleness", unit=MetricUnit.Seconds, value=staleness) as metric:
+            metric.add_dimension(name="secret", value=name)
+    except Exception as e:
+        print("Error recording secret refresh metrics: ", e)
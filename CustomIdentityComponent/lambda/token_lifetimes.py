@@ -0,0 +1,15 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Token and signing key lifetimes, shared by the functions signing tokens (encryption_and_decryption) and the key rotation (generate_keys)
+# Kept free of other imports, so generate_keys doesn't load the token signing and verification dependencies
+
+# Access token expiration in seconds
+access_token_expiration = 900
+
+# Refresh token expiration in days
+# (NOTE: make sure if you increase this that you also increase the rotation of the keys in the CDK app to avoid having a refresh token without a matching public key)
+refresh_token_expiration_days = 6
+
+# Private key refresh rate (should be relatively often to pick up new keys after rotation)
+private_key_refresh_rate = 900
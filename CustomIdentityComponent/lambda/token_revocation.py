@@ -0,0 +1,257 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Refresh token revocation list. Revoked token IDs (the jti claim) are stored in a DynamoDB table until the token expires, and each
+# Lambda environment keeps a Bloom filter of them. Checking a token that isn't revoked is only a filter lookup, and a filter hit is
+# confirmed with a read from the table (the filter can return false positives but no false negatives)
+# The filter is kept up to date by querying the revocations since the last update from the RevokedAtIndex (ordered by revocation time),
+# and rebuilt from the whole index only once in a while to drop the expired token IDs, so the table is never scanned
+# NOTE: Tokens revoked by another Lambda environment are rejected after this environment next updates its filter (see revocation_list_refresh_interval)
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+import hashlib
+import math
+import os
+import random
+import threading
+import time
+from aws_lambda_powertools import single_metric
+from aws_lambda_powertools.metrics import MetricUnit
+
+# How often the filter is updated with the new revocations in seconds, set with REVOCATION_LIST_REFRESH_INTERVAL
+revocation_list_refresh_interval = int(os.environ.get('REVOCATION_LIST_REFRESH_INTERVAL', '60'))
+
+# Random extra time in seconds added to the refresh interval, so that Lambda environments don't all query the table at the same time
+revocation_list_refresh_jitter = 10
+
+# How often the filter is rebuilt from the whole index in seconds, to drop the token IDs that have expired since the last rebuild
+revocation_filter_full_rebuild_interval = 3600
+
+# The index of the revocations ordered by revocation time (RevokedAt, in milliseconds), all in the same RevocationList partition
+revoked_at_index_name = "RevokedAtIndex"
+revocation_list_name = "refresh_token"
+
+# Each update queries the revocations from this many milliseconds before the previous update, as index reads are eventually consistent
+revocation_list_query_overlap_ms = 30000
+
+# Minimum amount of token IDs the filter is sized for, and the target false positive rate at that size
+revocation_filter_capacity = int(os.environ.get('REVOCATION_FILTER_CAPACITY', '100000'))
+revocation_filter_false_positive_rate = 0.001
+
+# DynamoDB table of revoked token IDs, created on first use
+revoked_token_table = None
+
+# The current filter, replaced as a whole on rebuild, the time it was rebuilt and last updated, and the time after which it's updated
+revocation_filter = None
+revocation_filter_built_at = 0
+revocation_filter_updated_at = 0
+revocation_filter_refresh_at = 0
+
+# The start time (milliseconds) of the last query of the index, and the token IDs already added that the next query returns again
+revocation_filter_synced_until = 0
+revocation_filter_recent_token_ids = set()
+refresh_lock = threading.Lock()
+refresh_thread = None
+
+# Check counters, filter hits are confirmed with the table and the ones not found there are false positives
+revocation_checks = 0
+revocation_filter_hits = 0
+revocation_false_positives = 0
+
+# Bloom filter of strings with k bit positions per item from double hashing a single BLAKE2b digest
+class BloomFilter:
+
+    def __init__(self, capacity, false_positive_rate):
+        self.size = max(int(math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))), 8)
+        self.hash_count = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.capacity = capacity
+        self.count = 0
+
+    def get_positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for position in self.get_positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def might_contain(self, item):
+        bits = self.bits
+        for position in self.get_positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def get_memory_bytes(self):
+        return len(self.bits)
+
+    # False positive rate expected with the amount of items added
+    def get_expected_false_positive_rate(self):
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+def get_revoked_token_table():
+    global revoked_token_table
+    if revoked_token_table == None:
+        dynamodb = boto3.resource('dynamodb', config=Config(connect_timeout=2, read_timeout=2))
+        revoked_token_table = dynamodb.Table(os.environ['REVOKED_TOKEN_TABLE'])
+    return revoked_token_table
+
+def is_revocation_enabled():
+    return 'REVOKED_TOKEN_TABLE' in os.environ
+
+# Returns the revocations in the index with a revocation time after revoked_after (milliseconds), as (token ID, revoked at, expires at) tuples
+def query_revocations(revoked_after):
+    table = get_revoked_token_table()
+    revocations = []
+    query_arguments = {
+        'IndexName': revoked_at_index_name,
+        'KeyConditionExpression': Key('RevocationList').eq(revocation_list_name) & Key('RevokedAt').gt(revoked_after)
+    }
+    while True:
+        response = table.query(**query_arguments)
+        revocations.extend((item['Jti'], int(item['RevokedAt']), int(item['ExpiresAt'])) for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_arguments['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return revocations
+
+# Returns the token IDs of the revocations that the next query, from the overlap before this query's start, returns again
+def get_recent_token_ids(revocations, query_started_at_ms):
+    return set(token_id for token_id, revoked_at, _ in revocations if revoked_at > query_started_at_ms - revocation_list_query_overlap_ms)
+
+# Builds a new filter from all the revoked token IDs in the index that haven't expired (the table TTL removes expired items with a delay)
+def rebuild_revocation_filter():
+    global revocation_filter, revocation_filter_built_at, revocation_filter_updated_at, revocation_filter_refresh_at
+    global revocation_filter_synced_until, revocation_filter_recent_token_ids
+    start = time.perf_counter()
+    query_started_at_ms = int(time.time() * 1000)
+    revocations = [revocation for revocation in query_revocations(0) if revocation[2] > query_started_at_ms / 1000]
+
+    # Leave room for the revocations until the next rebuild
+    new_filter = BloomFilter(max(revocation_filter_capacity, len(revocations) * 2), revocation_filter_false_positive_rate)
+    for token_id, _, _ in revocations:
+        new_filter.add(token_id)
+
+    revocation_filter = new_filter
+    revocation_filter_synced_until = query_started_at_ms
+    revocation_filter_recent_token_ids = get_recent_token_ids(revocations, query_started_at_ms)
+    revocation_filter_built_at = revocation_filter_updated_at = time.time()
+    revocation_filter_refresh_at = revocation_filter_updated_at + revocation_list_refresh_interval + random.uniform(0, revocation_list_refresh_jitter)
+    record_filter_metrics(new_filter, "revocation_filter_rebuild_latency", (time.perf_counter() - start) * 1000)
+
+# Adds the revocations since the last update to the filter, querying only the end of the index
+def update_revocation_filter():
+    global revocation_filter_updated_at, revocation_filter_refresh_at, revocation_filter_synced_until, revocation_filter_recent_token_ids
+    start = time.perf_counter()
+    query_started_at_ms = int(time.time() * 1000)
+    current_filter = revocation_filter
+    revocations = query_revocations(max(revocation_filter_synced_until - revocation_list_query_overlap_ms, 0))
+    for token_id, _, _ in revocations:
+        if token_id not in revocation_filter_recent_token_ids:
+            current_filter.add(token_id)
+
+    revocation_filter_synced_until = query_started_at_ms
+    revocation_filter_recent_token_ids = get_recent_token_ids(revocations, query_started_at_ms)
+    revocation_filter_updated_at = time.time()
+    revocation_filter_refresh_at = revocation_filter_updated_at + revocation_list_refresh_interval + random.uniform(0, revocation_list_refresh_jitter)
+    record_filter_metrics(current_filter, "revocation_filter_update_latency", (time.perf_counter() - start) * 1000)
+
+# Updates the filter with the new revocations, or rebuilds it when it's due for a rebuild or it's over the capacity it was sized for
+def refresh_revocation_filter():
+    if (time.time() - revocation_filter_built_at > revocation_filter_full_rebuild_interval or
+            revocation_filter.count > revocation_filter.capacity):
+        rebuild_revocation_filter()
+    else:
+        update_revocation_filter()
+
+def refresh_revocation_filter_in_background():
+    global revocation_filter_refresh_at
+    try:
+        refresh_revocation_filter()
+    except Exception as e:
+        # Keep using the current filter, and try again after the jitter
+        print("Error updating the revocation filter: ", e)
+        revocation_filter_refresh_at = time.time() + random.uniform(1, revocation_list_refresh_jitter)
+
+# Returns the filter, updating it in the background when it's due and synchronously when there's none or it's far behind the table
+def get_revocation_filter():
+    global refresh_thread
+    current_time = time.time()
+    if revocation_filter == None:
+        rebuild_revocation_filter()
+    elif current_time - revocation_filter_updated_at > revocation_list_refresh_interval * 5:
+        refresh_revocation_filter()
+    elif current_time >= revocation_filter_refresh_at:
+        with refresh_lock:
+            if refresh_thread == None or not refresh_thread.is_alive():
+                refresh_thread = threading.Thread(target=refresh_revocation_filter_in_background, daemon=True)
+                refresh_thread.start()
+    return revocation_filter
+
+# Returns True if the token ID is revoked
+def is_revoked(token_id):
+    global revocation_checks, revocation_filter_hits, revocation_false_positives
+    revocation_checks += 1
+    if not get_revocation_filter().might_contain(token_id):
+        return False
+
+    # Confirm the hit from the table
+    revocation_filter_hits += 1
+    response = get_revoked_token_table().get_item(Key={'Jti': token_id}, ConsistentRead=True)
+    if 'Item' in response:
+        return True
+
+    revocation_false_positives += 1
+    record_false_positive_metric()
+    return False
+
+# Revokes the token ID until the token expires (exp), and adds it to the filter of this environment right away
+def revoke(token_id, exp):
+    get_revoked_token_table().put_item(Item={
+        'Jti': token_id,
+        'ExpiresAt': int(exp),
+        'RevocationList': revocation_list_name,
+        'RevokedAt': int(time.time() * 1000)
+    })
+    if revocation_filter != None:
+        revocation_filter.add(token_id)
+        revocation_filter_recent_token_ids.add(token_id)
+
+def get_revocation_stats():
+    non_revoked_checks = revocation_checks - (revocation_filter_hits - revocation_false_positives)
+    return {
+        "checks": revocation_checks,
+        "filter_hits": revocation_filter_hits,
+        "false_positives": revocation_false_positives,
+        "false_positive_rate": revocation_false_positives / non_revoked_checks if non_revoked_checks > 0 else 0.0,
+        "expected_false_positive_rate": revocation_filter.get_expected_false_positive_rate() if revocation_filter != None else 0.0,
+        "revoked_tokens": revocation_filter.count if revocation_filter != None else 0,
+        "memory_bytes": revocation_filter.get_memory_bytes() if revocation_filter != None else 0
+    }
+
+def record_filter_metrics(bloom_filter, latency_metric_name, latency_ms):
+    try:
+        with single_metric(name="revocation_filter_memory", unit=MetricUnit.Bytes, value=bloom_filter.get_memory_bytes()) as metric:
+            metric.add_dimension(name="filter", value="refresh_token")
+        with single_metric(name="revocation_filter_revoked_tokens", unit=MetricUnit.Count, value=bloom_filter.count) as metric:
+            metric.add_dimension(name="filter", value="refresh_token")
+        with single_metric(name="revocation_filter_expected_false_positive_rate", unit=MetricUnit.Percent, value=bloom_filter.get_expected_false_positive_rate() * 100) as metric:
+            metric.add_dimension(name="filter", value="refresh_token")
+        with single_metric(name=latency_metric_name, unit=MetricUnit.Milliseconds, value=latency_ms) as metric:
+            metric.add_dimension(name="filter", value="refresh_token")
+    except Exception as e:
+        print("Error recording revocation filter metrics: ", e)
+
+# The false positive rate is the sum of this metric divided by the amount of refreshes
+def record_false_positive_metric():
+    try:
+        with single_metric(name="revocation_filter_false_positive", unit=MetricUnit.Count, value=1) as metric:
+            metric.add_dimension(name="filter", value="refresh_token")
+    except Exception as e:
+        print("Error recording revocation filter metrics: ", e)
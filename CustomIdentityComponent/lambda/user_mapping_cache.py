@@ -0,0 +1,81 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Cache of provider ID to user ID mappings (for example SteamId -> UserId) in the Lambda environment, shared by all identity providers
+# A provider ID is linked to a user once and the link doesn't change, so repeat logins can skip the get_item on the provider table
+
+import os
+import time
+from collections import OrderedDict
+from aws_lambda_powertools import single_metric
+from aws_lambda_powertools.metrics import MetricUnit
+
+# Maximum amount of cached mappings, set with USER_MAPPING_CACHE_SIZE (0 disables the cache)
+user_mapping_cache_size = int(os.environ.get('USER_MAPPING_CACHE_SIZE', '0'))
+
+# How long a mapping is used before it's read from the provider table again, in seconds
+user_mapping_cache_ttl = int(os.environ.get('USER_MAPPING_CACHE_TTL', '3600'))
+
+# (user_id, expires_at) by (provider_attribute, provider_id), in least recently used order
+user_mapping_cache = OrderedDict()
+
+# Cache counters, hits are DynamoDB reads saved
+user_mapping_cache_hits = 0
+user_mapping_cache_misses = 0
+
+def record_lookup_metrics(provider_attribute, hit):
+    try:
+        # The average of the hit metric is the hit ratio
+        with single_metric(name="user_mapping_cache_hit", unit=MetricUnit.Count, value=1 if hit else 0) as metric:
+            metric.add_dimension(name="provider", value=provider_attribute)
+        if hit:
+            with single_metric(name="dynamodb_reads_saved", unit=MetricUnit.Count, value=1) as metric:
+                metric.add_dimension(name="provider", value=provider_attribute)
+    except Exception as e:
+        print("Error recording user mapping cache metrics: ", e)
+
+# Returns the cached user_id for the provider ID, or None if it's not cached or has expired
+def get_user_id(provider_attribute, provider_id):
+    global user_mapping_cache_hits, user_mapping_cache_misses
+    if user_mapping_cache_size <= 0:
+        return None
+
+    key = (provider_attribute, provider_id)
+    cached_entry = user_mapping_cache.get(key)
+    if cached_entry != None:
+        if cached_entry[1] > time.time():
+            user_mapping_cache.move_to_end(key)
+            user_mapping_cache_hits += 1
+            record_lookup_metrics(provider_attribute, True)
+            return cached_entry[0]
+        # Expired, drop the entry
+        user_mapping_cache.pop(key, None)
+
+    user_mapping_cache_misses += 1
+    record_lookup_metrics(provider_attribute, False)
+    return None
+
+# Adds a mapping read from the provider table, or written when creating or linking a user
+def add_user_id(provider_attribute, provider_id, user_id):
+    if user_mapping_cache_size <= 0:
+        return
+
+    key = (provider_attribute, provider_id)
+    user_mapping_cache[key] = (user_id, time.time() + user_mapping_cache_ttl)
+    user_mapping_cache.move_to_end(key)
+    while len(user_mapping_cache) > user_mapping_cache_size:
+        user_mapping_cache.popitem(last=False)
+
+# Removes a mapping, for example after an admin flow removed or moved the provider ID link
+def invalidate_user_id(provider_attribute, provider_id):
+    user_mapping_cache.pop((provider_attribute, provider_id), None)
+
+def get_user_mapping_cache_stats():
+    lookups = user_mapping_cache_hits + user_mapping_cache_misses
+    return {
+        "hits": user_mapping_cache_hits,
+        "misses": user_mapping_cache_misses,
+        "hit_rate": user_mapping_cache_hits / lookups if lookups > 0 else 0.0,
+        "dynamodb_reads_saved": user_mapping_cache_hits,
+        "size": len(user_mapping_cache)
+    }
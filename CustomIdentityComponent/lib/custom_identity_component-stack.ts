@@ -39,15 +39,37 @@ export interface CustomIdentityComponentStackProps extends StackProps {
   facebookAppId: string;
   // This should be set to true if you want to use Cognito as your Identity Provider
   cognito: string;
+  // Algorithm for signing the tokens: RS256 (default), ES256 or EdDSA
+  signingAlgorithm: string;
+  // Secret for new guest users: random (default, stored in the user table) or hmac (derived from the user ID with the guest secret key)
+  guestSecretMode: string;
+  // Keep the guest secret key in random mode, so guests with secrets derived in hmac mode can still log in after switching back
+  keepGuestSecretKey: boolean;
+  // When the refresh endpoint signs a new refresh token: always (default) or sliding (only for rotated keys and tokens close to expiration)
+  refreshTokenReissuePolicy: string;
+  // Where the login endpoints count requests per client IP for admission control: none, local (per Lambda environment) or dynamodb (shared)
+  admissionControlStore: string;
+  // How keys are rotated: immediate (default, a new key signs right away) or staged (a new key is published a rotation before it signs)
+  keyRotationMode: string;
+  // Claims of the signed tokens: standard (default) or compact (short scope codes and no duplicated claims)
+  claimsProfile: string;
 }
 
 const POWERTOOLS_METRICS_NAMESPACE = "AWS for Games";
 const POWERTOOLS_SERVICE_NAME = "CustomIdentityComponent";
 
 export class CustomIdentityComponentStack extends Stack {
+  // Admission control configuration of the login functions, the table is only defined with the dynamodb store
+  admissionControlStore: string;
+  admissionControlTable: dynamodb.Table | undefined;
+  // Claims profile of the functions signing tokens
+  claimsProfile: string;
+
   constructor(scope: Construct, id: string, props: CustomIdentityComponentStackProps) {
     super(scope, id, props);
 
+    this.claimsProfile = props.claimsProfile;
+
     // The shared policy for basic Lambda access needs for logging. This is similar to the managed Lambda Execution Policy
     const lambdaBasicPolicy = new iam.PolicyStatement({
       actions: ['logs:CreateLogGroup','logs:CreateLogStream','logs:PutLogEvents'],
@@ -105,8 +127,13 @@ export class CustomIdentityComponentStack extends Stack {
     });
 
     // Define a CloudFront distribution for the issuer data
+    // The versioned key sets (.well-known/jwks/<content hash>.json) never change, so they are cached with the default CloudFront caching
+    const issuer_origin = new origins.S3Origin(issuer_bucket);
     const distribution = new cloudfront.Distribution(this, 'IssuerEndpoint', {
-      defaultBehavior: { origin: new origins.S3Origin(issuer_bucket), cachePolicy: myCachePolicy},
+      defaultBehavior: { origin: issuer_origin, cachePolicy: myCachePolicy},
+      additionalBehaviors: {
+        '.well-known/jwks/*': { origin: issuer_origin, cachePolicy: cloudfront.CachePolicy.CACHING_OPTIMIZED }
+      },
       enableLogging: true,
       minimumProtocolVersion: cloudfront.SecurityPolicyProtocol.TLS_V1_2_2021,
       logBucket: loggingBucket
@@ -151,10 +178,14 @@ export class CustomIdentityComponentStack extends Stack {
         "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
         "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
         "SECRET_KEY_ID": secret.secretName,
+        "SIGNING_ALGORITHM": props.signingAlgorithm,
+        "KEY_ROTATION_MODE": props.keyRotationMode
       }
     });
     issuer_bucket.grantReadWrite(generate_keys_function);
     secret.grantWrite(generate_keys_function);
+    // The staged rotation reads the next key version of the secret before making it the current version
+    secret.grantRead(generate_keys_function);
     NagSuppressions.addResourceSuppressions(generate_keys_function_role, [
       { id: 'AwsSolutions-IAM5', reason: 'Using the standard Lambda execution role, all custom access resource restricted.' }
     ], true);
@@ -182,6 +213,45 @@ export class CustomIdentityComponentStack extends Stack {
       pointInTimeRecovery: true
     });
 
+    // Define a DynamoDB table for revoked refresh token IDs (jti), removed by TTL when the token expires
+    const revoked_token_table = new dynamodb.Table(this, 'RevokedTokenTable', {
+      partitionKey: {
+        name: 'Jti',
+        type: dynamodb.AttributeType.STRING
+      },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      pointInTimeRecovery: true,
+      timeToLiveAttribute: 'ExpiresAt'
+    });
+    // The revocations ordered by revocation time, queried by each Lambda environment for the revocations since its last update
+    revoked_token_table.addGlobalSecondaryIndex({
+      indexName: 'RevokedAtIndex',
+      partitionKey: {
+        name: 'RevocationList',
+        type: dynamodb.AttributeType.STRING
+      },
+      sortKey: {
+        name: 'RevokedAt',
+        type: dynamodb.AttributeType.NUMBER
+      },
+      projectionType: dynamodb.ProjectionType.INCLUDE,
+      nonKeyAttributes: ['ExpiresAt']
+    });
+
+    // Define a DynamoDB table for the admission control request counters when they are shared by all Lambda environments, removed by TTL
+    this.admissionControlStore = props.admissionControlStore;
+    if(props.admissionControlStore == "dynamodb") {
+      this.admissionControlTable = new dynamodb.Table(this, 'AdmissionControlTable', {
+        partitionKey: {
+          name: 'ClientKey',
+          type: dynamodb.AttributeType.STRING
+        },
+        billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+        pointInTimeRecovery: true,
+        timeToLiveAttribute: 'ExpiresAt'
+      });
+    }
+
     // Define a Web Application Firewall with the standard AWS provided rule set
     const cfnWebACLManaged = new wafv2.CfnWebACL(this,'CustomIdentityWebACLRules',{
             defaultAction: {
@@ -248,6 +318,13 @@ export class CustomIdentityComponentStack extends Stack {
         loggingLevel : MethodLoggingLevel.ERROR,
         tracingEnabled: true,
         stageName: 'prod',
+        // Method level throttle for the token introspection of backend services, each request can carry up to INTROSPECTION_MAX_TOKENS tokens
+        methodOptions: {
+          '/introspect-tokens/POST': {
+            throttlingRateLimit: 50,
+            throttlingBurstLimit: 100
+          }
+        }
       }
     });
     // cdk-nag suppression for the API Gateway default logs access
@@ -271,6 +348,23 @@ export class CustomIdentityComponentStack extends Stack {
       validateRequestParameters: true
     });
 
+    // Versioned keys for deriving guest secrets, rotated by adding a new version and setting it as "current" (keep the previous versions)
+    // Only created when guest secrets are derived (hmac mode), or kept for validating the derived secrets after switching back to random
+    let guestSecretKey: secretsmanager.Secret | undefined = undefined;
+    if(props.guestSecretMode == "hmac" || props.keepGuestSecretKey) {
+      guestSecretKey = new secretsmanager.Secret(this, 'GuestSecretKey', {
+        generateSecretString: {
+          secretStringTemplate: JSON.stringify({ current: "1" }),
+          generateStringKey: "1",
+          passwordLength: 64,
+          excludePunctuation: true
+        }
+      });
+      NagSuppressions.addResourceSuppressions(guestSecretKey, [
+        { id: 'AwsSolutions-SMG4', reason: 'Automatic rotation not configured because key versions are added manually and previous versions must be kept.' }
+      ], true);
+    }
+
     // Lambda function for guest login
     const login_as_guest_function_role = new iam.Role(this, 'LoginAsGuestFunctionRole', {
       assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
@@ -298,11 +392,19 @@ export class CustomIdentityComponentStack extends Stack {
         "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
         "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
         "SECRET_KEY_ID": secret.secretName,
-        "USER_TABLE": user_table.tableName
+        "CLAIMS_PROFILE": this.claimsProfile,
+        "USER_TABLE": user_table.tableName,
+        "GUEST_SECRET_MODE": props.guestSecretMode
       }
     });
     secret.grantRead(login_as_guest_function);
+    // Without the key, derived guest secrets are rejected (guest_credentials)
+    if(guestSecretKey != undefined) {
+      login_as_guest_function.addEnvironment("GUEST_SECRET_KEY_ID", guestSecretKey.secretName);
+      guestSecretKey.grantRead(login_as_guest_function);
+    }
     user_table.grantReadWriteData(login_as_guest_function);
+    this.addAdmissionControl(login_as_guest_function);
 
     NagSuppressions.addResourceSuppressions(login_as_guest_function_role, [
       { id: 'AwsSolutions-IAM5', reason: 'Using the standard Lambda execution role, all custom access resource restricted.' }
@@ -348,11 +450,15 @@ export class CustomIdentityComponentStack extends Stack {
         "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
         "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
         "SECRET_KEY_ID": secret.secretName,
-        "USER_TABLE": user_table.tableName
+        "CLAIMS_PROFILE": this.claimsProfile,
+        "USER_TABLE": user_table.tableName,
+        "REFRESH_TOKEN_REISSUE_POLICY": props.refreshTokenReissuePolicy,
+        "REVOKED_TOKEN_TABLE": revoked_token_table.tableName
       }
     });
     secret.grantRead(refresh_access_token_function);
     user_table.grantReadWriteData(refresh_access_token_function);
+    revoked_token_table.grantReadData(refresh_access_token_function);
 
     NagSuppressions.addResourceSuppressions(refresh_access_token_function_role, [
       { id: 'AwsSolutions-IAM5', reason: 'Using the standard Lambda execution role, all custom access resource restricted.' }
@@ -366,6 +472,92 @@ export class CustomIdentityComponentStack extends Stack {
       requestValidator: requestValidator
     });
 
+    // Lambda function for revoking a refresh token
+    const revoke_refresh_token_function_role = new iam.Role(this, 'RevokeRefreshTokenFunctionRole', {
+      assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
+    });
+    revoke_refresh_token_function_role.addToPolicy(lambdaBasicPolicy);
+    const revoke_refresh_token_function = new lambda.Function(this, 'RevokeRefreshToken', {
+      role: revoke_refresh_token_function_role,
+      code: lambda.Code.fromAsset("lambda", {
+        bundling: {
+          image: lambda.Runtime.PYTHON_3_13.bundlingImage,
+          command: [
+            'bash', '-c',
+            'pip install --platform manylinux2014_x86_64 --only-binary=:all: -r requirements.txt -t /asset-output && cp -ru . /asset-output'
+          ],
+      },}),
+      runtime: lambda.Runtime.PYTHON_3_13,
+      handler: 'revoke_refresh_token.lambda_handler',
+      timeout: Duration.seconds(15),
+      tracing: lambda.Tracing.ACTIVE,
+      memorySize: 2048,
+      logRetention: logs.RetentionDays.ONE_MONTH,
+      logRetentionRole: lambdaLoggingRole,
+      environment: {
+        "ISSUER_URL": "https://"+distribution.domainName,
+        "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
+        "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
+        "REVOKED_TOKEN_TABLE": revoked_token_table.tableName
+      }
+    });
+    revoked_token_table.grantReadWriteData(revoke_refresh_token_function);
+
+    NagSuppressions.addResourceSuppressions(revoke_refresh_token_function_role, [
+      { id: 'AwsSolutions-IAM5', reason: 'Using the standard Lambda execution role, all custom access resource restricted.' }
+    ], true);
+
+    // Map revoke_refresh_token_function to the api_gateway GET request revoke-refresh-token
+    api_gateway.root.addResource('revoke-refresh-token').addMethod('GET', new apigw.LambdaIntegration(revoke_refresh_token_function),{
+      requestParameters: {
+        'method.request.querystring.refresh_token': true
+      },
+      requestValidator: requestValidator
+    });
+
+    // Lambda function for introspecting access tokens, for backend services that can't verify the tokens themselves
+    const introspect_tokens_function_role = new iam.Role(this, 'IntrospectTokensFunctionRole', {
+      assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
+    });
+    introspect_tokens_function_role.addToPolicy(lambdaBasicPolicy);
+    const introspect_tokens_function = new lambda.Function(this, 'IntrospectTokens', {
+      role: introspect_tokens_function_role,
+      code: lambda.Code.fromAsset("lambda", {
+        bundling: {
+          image: lambda.Runtime.PYTHON_3_13.bundlingImage,
+          command: [
+            'bash', '-c',
+            'pip install --platform manylinux2014_x86_64 --only-binary=:all: -r requirements.txt -t /asset-output && cp -ru . /asset-output'
+          ],
+      },}),
+      runtime: lambda.Runtime.PYTHON_3_13,
+      handler: 'introspect_tokens.lambda_handler',
+      timeout: Duration.seconds(15),
+      tracing: lambda.Tracing.ACTIVE,
+      memorySize: 2048,
+      logRetention: logs.RetentionDays.ONE_MONTH,
+      logRetentionRole: lambdaLoggingRole,
+      environment: {
+        "ISSUER_URL": "https://"+distribution.domainName,
+        "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
+        "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
+        "VERIFIED_TOKEN_CACHE_SIZE": "10000",
+        "INTROSPECTION_MAX_TOKENS": "100"
+      }
+    });
+
+    NagSuppressions.addResourceSuppressions(introspect_tokens_function_role, [
+      { id: 'AwsSolutions-IAM5', reason: 'Using the standard Lambda execution role, all custom access resource restricted.' }
+    ], true);
+
+    // Map introspect_tokens_function to the api_gateway POST request introspect-tokens
+    // Only for backend services: callers sign the requests with SigV4 and need execute-api:Invoke on the method (IntrospectTokensMethodArn)
+    const introspect_tokens_method = api_gateway.root.addResource('introspect-tokens').addMethod('POST', new apigw.LambdaIntegration(introspect_tokens_function),{
+      authorizationType: apigw.AuthorizationType.IAM,
+      requestValidator: requestValidator
+    });
+    new CfnOutput(this, 'IntrospectTokensMethodArn', { value: introspect_tokens_method.methodArn });
+
     // Login endpoint to CloudFormation Output
     new CfnOutput(this, 'LoginEndpoint', { value: api_gateway.url });
 
@@ -414,6 +606,15 @@ export class CustomIdentityComponentStack extends Stack {
     }
   }
 
+  // Adds the admission control configuration to a login function, and access to the request counter table when it's used
+  addAdmissionControl(loginFunction: lambda.Function) {
+    loginFunction.addEnvironment("ADMISSION_CONTROL_STORE", this.admissionControlStore);
+    if(this.admissionControlTable != undefined) {
+      loginFunction.addEnvironment("ADMISSION_CONTROL_TABLE", this.admissionControlTable.tableName);
+      this.admissionControlTable.grantReadWriteData(loginFunction);
+    }
+  }
+
   ///// *** IDENTITY PROVIDER SPECIFIC RESOURECE **** //////
 
   // Sets up Lambda endpoint and DynamoDB table for Apple ID Login
@@ -458,7 +659,10 @@ export class CustomIdentityComponentStack extends Stack {
           "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
           "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
           "SECRET_KEY_ID": secret.secretName,
+          "CLAIMS_PROFILE": this.claimsProfile,
           "USER_TABLE": user_table.tableName,
+          "VERIFIED_TOKEN_CACHE_SIZE": "1000",
+          "USER_MAPPING_CACHE_SIZE": "10000",
           "APPLE_APP_ID": appId,
           "APPLE_ID_USER_TABLE": appleIdUserTable.tableName
         }
@@ -466,6 +670,7 @@ export class CustomIdentityComponentStack extends Stack {
       secret.grantRead(loginWithAppleIdFunction);
       user_table.grantReadWriteData(loginWithAppleIdFunction);
       appleIdUserTable.grantReadWriteData(loginWithAppleIdFunction);
+      this.addAdmissionControl(loginWithAppleIdFunction);
 
       NagSuppressions.addResourceSuppressions(loginWithAppleIdFunctionRole, [
         { id: 'AwsSolutions-IAM5', reason: 'Using the standard Lambda execution role, all custom access resource restricted.' }
@@ -524,7 +729,10 @@ export class CustomIdentityComponentStack extends Stack {
         "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
         "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
         "SECRET_KEY_ID": privateKeySecret.secretName,
+        "CLAIMS_PROFILE": this.claimsProfile,
         "USER_TABLE": user_table.tableName,
+        "VERIFIED_TOKEN_CACHE_SIZE": "1000",
+        "USER_MAPPING_CACHE_SIZE": "10000",
         "STEAM_APP_ID": appId,
         "STEAM_WEB_API_KEY_SECRET_ARN": steamWebApiKeySecretArn,
         "STEAM_USER_TABLE": steamIdUserTable.tableName
@@ -534,6 +742,7 @@ export class CustomIdentityComponentStack extends Stack {
     privateKeySecret.grantRead(loginWithSteamIdFunction);
     user_table.grantReadWriteData(loginWithSteamIdFunction);
     steamIdUserTable.grantReadWriteData(loginWithSteamIdFunction);
+    this.addAdmissionControl(loginWithSteamIdFunction);
     // Define IAM policy to access steamWebApiKey secret
     const policy = new iam.PolicyStatement({
       actions: ['secretsmanager:GetSecretValue'],
@@ -599,7 +808,10 @@ export class CustomIdentityComponentStack extends Stack {
         "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
         "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
         "SECRET_KEY_ID": privateKeySecret.secretName,
+        "CLAIMS_PROFILE": this.claimsProfile,
         "USER_TABLE": user_table.tableName,
+        "VERIFIED_TOKEN_CACHE_SIZE": "1000",
+        "USER_MAPPING_CACHE_SIZE": "10000",
         "GOOGLE_PLAY_CLIENT_ID": googlePlayClientId,
         "GOOGLE_PLAY_APP_ID": googlePlayAppId,
         "GOOGLE_PLAY_CLIENT_SECRET_ARN": googlePlayClientSecretArn,
@@ -610,6 +822,7 @@ export class CustomIdentityComponentStack extends Stack {
     privateKeySecret.grantRead(loginWithGooglePlayFunction);
     user_table.grantReadWriteData(loginWithGooglePlayFunction);
     googlePlayUserTable.grantReadWriteData(loginWithGooglePlayFunction);
+    this.addAdmissionControl(loginWithGooglePlayFunction);
     // Define IAM policy to access steamWebApiKey secret
     const policy = new iam.PolicyStatement({
       actions: ['secretsmanager:GetSecretValue'],
@@ -674,7 +887,10 @@ export class CustomIdentityComponentStack extends Stack {
         "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
         "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
         "SECRET_KEY_ID": secret.secretName,
+        "CLAIMS_PROFILE": this.claimsProfile,
         "USER_TABLE": user_table.tableName,
+        "VERIFIED_TOKEN_CACHE_SIZE": "1000",
+        "USER_MAPPING_CACHE_SIZE": "10000",
         "FACEBOOK_APP_ID" : appId,
         "FACEBOOK_USER_TABLE": facebookUserTable.tableName
       }
@@ -682,6 +898,7 @@ export class CustomIdentityComponentStack extends Stack {
     secret.grantRead(loginWithFacebookFunction);
     user_table.grantReadWriteData(loginWithFacebookFunction);
     facebookUserTable.grantReadWriteData(loginWithFacebookFunction);
+    this.addAdmissionControl(loginWithFacebookFunction);
 
     NagSuppressions.addResourceSuppressions(loginWithFacebookFunctionRole, [
       { id: 'AwsSolutions-IAM5', reason: 'Using the standard Lambda execution role, all custom access resource restricted.' }
@@ -776,7 +993,10 @@ export class CustomIdentityComponentStack extends Stack {
         "POWERTOOLS_METRICS_NAMESPACE": POWERTOOLS_METRICS_NAMESPACE,
         "POWERTOOLS_SERVICE_NAME": POWERTOOLS_SERVICE_NAME,
         "SECRET_KEY_ID": secret.secretName,
+        "CLAIMS_PROFILE": this.claimsProfile,
         "USER_TABLE": user_table.tableName, // writing a timestamp as uuid
+        "VERIFIED_TOKEN_CACHE_SIZE": "1000",
+        "USER_MAPPING_CACHE_SIZE": "10000",
         "COGNITO_USER_POOL_ID" : userPoolId,
         "COGNITO_APP_CLIENT_ID": userPoolClientId,
         "COGNITO_USER_TABLE": cognitoUserTable.tableName //need to write to this in the lambda
@@ -785,6 +1005,7 @@ export class CustomIdentityComponentStack extends Stack {
     secret.grantRead(loginWithCognitoFunction);
     user_table.grantReadWriteData(loginWithCognitoFunction);
     cognitoUserTable.grantReadWriteData(loginWithCognitoFunction);
+    this.addAdmissionControl(loginWithCognitoFunction);
     loginWithCognitoFunction.node.addDependency(userPool)
 
     NagSuppressions.addResourceSuppressions(loginWithCognitoFunctionRole, [
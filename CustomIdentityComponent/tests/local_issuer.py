@@ -0,0 +1,91 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Shared setup of the Lambda function tests: a local signing key in place of the Secrets Manager secret, the public keys loaded
+# in place of the issuer's jwks.json, and an in-memory stand-in of the revoked token table (no AWS or network calls)
+
+import json
+import os
+import sys
+import uuid
+
+from jwcrypto import jwk
+
+issuer_url = "https://issuer.example.com"
+os.environ.setdefault("ISSUER_URL", issuer_url)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("POWERTOOLS_TRACE_DISABLED", "1")
+os.environ.setdefault("POWERTOOLS_LOG_LEVEL", "WARNING")
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "test")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+
+import encryption_and_decryption
+import token_revocation
+
+# Serves the private key from memory in place of the Secrets Manager secret
+class LocalPrivateKey:
+
+    def __init__(self, key):
+        self.set_key(key)
+
+    def set_key(self, key):
+        self.value = key.export_private()
+        self.version_id = key.get('kid')
+
+    def get(self):
+        return self.value, self.version_id
+
+def generate_key():
+    return jwk.JWK.generate(kty='RSA', size=2048, alg='RS256', use='sig', kid=str(uuid.uuid4()))
+
+def publish_keys(keys):
+    encryption_and_decryption.get_jwks_key_set(issuer_url).load_key_set({"keys": [json.loads(key.export_public()) for key in keys]})
+
+# Signs with the key and publishes it, like after a key rotation
+def use_signing_key(key, published_keys):
+    publish_keys(published_keys)
+    if isinstance(encryption_and_decryption.private_key_secret, LocalPrivateKey):
+        encryption_and_decryption.private_key_secret.set_key(key)
+    else:
+        encryption_and_decryption.private_key_secret = LocalPrivateKey(key)
+    encryption_and_decryption.verified_token_cache.clear()
+
+# The RevokedTokenTable and its RevokedAtIndex in memory, only supports the calls token_revocation makes
+class InMemoryRevokedTokenTable:
+
+    def __init__(self):
+        self.items = {}
+        self.calls = []
+
+    def put_item(self, Item):
+        self.calls.append("put_item")
+        self.items[Item['Jti']] = dict(Item)
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.calls.append("get_item")
+        if Key['Jti'] in self.items:
+            return {'Item': dict(self.items[Key['Jti']])}
+        return {}
+
+    def query(self, IndexName, KeyConditionExpression, ExclusiveStartKey=None):
+        self.calls.append("query")
+        if IndexName != token_revocation.revoked_at_index_name:
+            raise Exception("Unknown index " + IndexName)
+        partition_condition, sort_condition = KeyConditionExpression.get_expression()['values']
+        revocation_list = partition_condition.get_expression()['values'][1]
+        revoked_after = sort_condition.get_expression()['values'][1]
+        items = [item for item in self.items.values() if item.get('RevocationList') == revocation_list and item['RevokedAt'] > revoked_after]
+        items.sort(key=lambda item: item['RevokedAt'])
+        return {'Items': [{'Jti': item['Jti'], 'RevocationList': item['RevocationList'], 'RevokedAt': item['RevokedAt'], 'ExpiresAt': item['ExpiresAt']}
+                          for item in items]}
+
+# Starts every test with an empty revocation list and no revocation filter, like a new deployment
+def reset_revocation(table):
+    os.environ["REVOKED_TOKEN_TABLE"] = "RevokedTokenTable"
+    token_revocation.revoked_token_table = table
+    token_revocation.revocation_filter = None
+    token_revocation.revocation_filter_built_at = 0
+    token_revocation.revocation_filter_updated_at = 0
+    token_revocation.revocation_filter_refresh_at = 0
+    token_revocation.revocation_filter_synced_until = 0
+    token_revocation.revocation_filter_recent_token_ids = set()
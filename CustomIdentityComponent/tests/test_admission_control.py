@@ -0,0 +1,41 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Tests of admission_control: the default store is the local token bucket documented for the CDK app, so a login function without
+# ADMISSION_CONTROL_STORE still sheds a client's requests over the burst
+# Usage: python -m pytest tests
+
+import importlib
+import os
+import unittest
+import uuid
+
+import local_issuer
+import admission_control
+
+def request_from(client_ip):
+    return {"requestContext": {"identity": {"sourceIp": client_ip}}}
+
+class AdmissionControlDefaultTest(unittest.TestCase):
+
+    def setUp(self):
+        self.original_store = os.environ.pop("ADMISSION_CONTROL_STORE", None)
+        importlib.reload(admission_control)
+
+    def tearDown(self):
+        if self.original_store != None:
+            os.environ["ADMISSION_CONTROL_STORE"] = self.original_store
+        importlib.reload(admission_control)
+
+    def test_default_store_is_local(self):
+        self.assertEqual(admission_control.admission_control_store, "local")
+
+    def test_default_store_sheds_requests_over_the_burst(self):
+        client_ip = "198.51.100." + str(uuid.uuid4().int % 250)
+        responses = [admission_control.check_admission(request_from(client_ip), "guest") for _ in range(admission_control.admission_control_burst + 1)]
+
+        self.assertTrue(all(response == None for response in responses[:-1]))
+        self.assertEqual(responses[-1]['statusCode'], 429)
+
+if __name__ == "__main__":
+    unittest.main()
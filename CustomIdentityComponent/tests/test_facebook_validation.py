@@ -0,0 +1,73 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Tests of the app validation cache of login_with_facebook: a token's app validation is reused only until the cache entry expires,
+# after that the app is validated with the Graph API again
+# Usage: python -m pytest tests
+
+import os
+import unittest
+import uuid
+
+import local_issuer
+os.environ.setdefault("FACEBOOK_APP_ID", "1234567890")
+os.environ.setdefault("FACEBOOK_USER_TABLE", "FacebookUserTable")
+
+import login_with_facebook
+
+class FacebookAppValidationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.app_requests = 0
+        self.original_get_facebook_app = login_with_facebook.get_facebook_app
+        self.original_get_facebook_user = login_with_facebook.get_facebook_user
+        self.original_ttl = login_with_facebook.facebook_app_validation_cache_ttl
+        login_with_facebook.get_facebook_app = self.get_facebook_app
+        login_with_facebook.get_facebook_user = lambda facebook_user_id, facebook_auth_token: {"id": facebook_user_id}
+        login_with_facebook.facebook_app_validation_cache.clear()
+
+    def tearDown(self):
+        login_with_facebook.get_facebook_app = self.original_get_facebook_app
+        login_with_facebook.get_facebook_user = self.original_get_facebook_user
+        login_with_facebook.facebook_app_validation_cache_ttl = self.original_ttl
+        login_with_facebook.facebook_app_validation_cache.clear()
+
+    def get_facebook_app(self, facebook_auth_token):
+        self.app_requests += 1
+        return {"id": os.environ["FACEBOOK_APP_ID"]}
+
+    def validate(self, token):
+        return login_with_facebook.validate_facebook_token("10001", token)
+
+    def test_default_ttl_is_short(self):
+        self.assertLessEqual(self.original_ttl, 300)
+
+    def test_app_validation_is_reused_within_the_ttl(self):
+        token = str(uuid.uuid4())
+        self.validate(token)
+        self.validate(token)
+
+        self.assertEqual(self.app_requests, 1)
+
+    def test_expired_entry_is_not_served(self):
+        token = str(uuid.uuid4())
+        self.validate(token)
+        # Expire the entry
+        token_digest, (app_validation, _) = next(iter(login_with_facebook.facebook_app_validation_cache.items()))
+        login_with_facebook.facebook_app_validation_cache[token_digest] = (app_validation, 0)
+
+        self.assertIsNone(login_with_facebook.get_cached_app_validation(token_digest))
+        self.validate(token)
+        self.assertEqual(self.app_requests, 2)
+
+    def test_zero_ttl_disables_the_cache(self):
+        login_with_facebook.facebook_app_validation_cache_ttl = 0
+        token = str(uuid.uuid4())
+        self.validate(token)
+        self.validate(token)
+
+        self.assertEqual(self.app_requests, 2)
+        self.assertEqual(len(login_with_facebook.facebook_app_validation_cache), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Runs the same cases on the two public key caches, provider_key_cache (Lambda functions) and the JwksCache of the token_verifier package
+# (game servers), against a local stand-in of the issuer endpoint, so their max-age, ETag and unknown kid behaviour can't drift apart
+# Usage: python -m pytest tests
+
+import hashlib
+import http.server
+import json
+import os
+import sys
+import threading
+import unittest
+import uuid
+
+from jwcrypto import jwk
+
+import local_issuer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "token_verifier"))
+
+from custom_identity_verifier import jwks_cache
+import partner_http
+import provider_key_cache
+
+# Metrics are written to stdout as CloudWatch embedded metrics, skip them
+partner_http.record_partner_metric = lambda *args: None
+
+# Serves jwks.json with an ETag and Cache-Control like the issuer bucket behind CloudFront, and a 304 when the ETag matches
+class JwksStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    jwks_body = b'{"keys": []}'
+    cache_control = "public, max-age=300"
+    requests = 0
+
+    def do_GET(self):
+        JwksStubHandler.requests += 1
+        etag = '"' + hashlib.sha256(self.jwks_body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", self.cache_control)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", self.cache_control)
+        self.send_header("Content-Length", str(len(self.jwks_body)))
+        self.end_headers()
+        self.wfile.write(self.jwks_body)
+
+    def log_message(self, format, *args):
+        pass
+
+def generate_public_key():
+    key = jwk.JWK.generate(kty='EC', crv='P-256', alg='ES256', use='sig', kid=str(uuid.uuid4()))
+    return json.loads(key.export_public())
+
+# The same operations on both caches, the cases below only use these
+class ProviderKeyCacheAdapter:
+
+    def __init__(self, issuer_url):
+        self.key_set = provider_key_cache.JwksKeySet(issuer_url + "/.well-known/jwks.json")
+
+    def get_key(self, kid):
+        return self.key_set.get_key(kid)
+
+    def expire(self):
+        self.key_set.expires_at = 0
+
+    def pass_min_refresh_interval(self):
+        self.key_set.last_refresh -= provider_key_cache.jwks_min_refresh_interval
+
+    def get_not_modified_count(self):
+        return self.key_set.not_modified_count
+
+class JwksCacheAdapter:
+
+    def __init__(self, issuer_url):
+        self.cache = jwks_cache.JwksCache(issuer_url)
+
+    def get_key(self, kid):
+        return self.cache.get_key(kid)
+
+    def expire(self):
+        self.cache.expires_at = 0
+
+    def pass_min_refresh_interval(self):
+        self.cache.last_refresh -= self.cache.min_refresh_interval
+
+    def get_not_modified_count(self):
+        return self.cache.not_modified_count
+
+class JwksCacheCases:
+
+    create_cache = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), JwksStubHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.issuer_url = "http://127.0.0.1:" + str(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.published_key = generate_public_key()
+        self.publish([self.published_key])
+        JwksStubHandler.cache_control = "public, max-age=300"
+        self.cache = self.create_cache(self.issuer_url)
+        JwksStubHandler.requests = 0
+
+    def publish(self, keys):
+        JwksStubHandler.jwks_body = json.dumps({"keys": keys}).encode()
+
+    def test_keys_are_fetched_once(self):
+        self.assertIsNotNone(self.cache.get_key(self.published_key["kid"]))
+        self.assertIsNotNone(self.cache.get_key(self.published_key["kid"]))
+        self.assertEqual(JwksStubHandler.requests, 1)
+
+    def test_expired_keys_are_revalidated_with_the_etag(self):
+        self.cache.get_key(self.published_key["kid"])
+        self.cache.expire()
+        self.cache.pass_min_refresh_interval()
+
+        self.assertIsNotNone(self.cache.get_key(self.published_key["kid"]))
+        self.assertEqual(JwksStubHandler.requests, 2)
+        self.assertEqual(self.cache.get_not_modified_count(), 1)
+
+    def test_no_store_revalidates_on_every_use(self):
+        JwksStubHandler.cache_control = "no-store"
+        self.cache.get_key(self.published_key["kid"])
+        self.cache.pass_min_refresh_interval()
+
+        self.cache.get_key(self.published_key["kid"])
+
+        self.assertEqual(JwksStubHandler.requests, 2)
+
+    def test_unknown_kids_refresh_once_per_min_refresh_interval(self):
+        self.cache.get_key(self.published_key["kid"])
+        self.cache.pass_min_refresh_interval()
+
+        for _ in range(10):
+            self.assertIsNone(self.cache.get_key(str(uuid.uuid4())))
+
+        self.assertEqual(JwksStubHandler.requests, 2)
+
+    def test_unknown_kids_are_remembered(self):
+        self.cache.get_key(self.published_key["kid"])
+        self.cache.pass_min_refresh_interval()
+        unknown_kid = str(uuid.uuid4())
+        self.assertIsNone(self.cache.get_key(unknown_kid))
+        self.cache.pass_min_refresh_interval()
+
+        self.assertIsNone(self.cache.get_key(unknown_kid))
+
+        self.assertEqual(JwksStubHandler.requests, 2)
+
+    def test_unknown_kids_are_remembered_after_a_revalidation(self):
+        self.cache.get_key(self.published_key["kid"])
+        self.cache.expire()
+        self.cache.pass_min_refresh_interval()
+        unknown_kid = str(uuid.uuid4())
+        self.assertIsNone(self.cache.get_key(unknown_kid))
+        self.cache.pass_min_refresh_interval()
+
+        self.assertIsNone(self.cache.get_key(unknown_kid))
+
+        self.assertEqual(JwksStubHandler.requests, 2)
+
+    def test_new_kid_is_fetched_after_a_rotation(self):
+        self.cache.get_key(self.published_key["kid"])
+        new_key = generate_public_key()
+        self.publish([self.published_key, new_key])
+        self.cache.pass_min_refresh_interval()
+
+        self.assertIsNotNone(self.cache.get_key(new_key["kid"]))
+        self.assertIsNotNone(self.cache.get_key(self.published_key["kid"]))
+        self.assertEqual(JwksStubHandler.requests, 2)
+
+class ProviderKeyCacheTest(JwksCacheCases, unittest.TestCase):
+    create_cache = ProviderKeyCacheAdapter
+
+class JwksCacheTest(JwksCacheCases, unittest.TestCase):
+    create_cache = JwksCacheAdapter
+
+class CacheSettingsTest(unittest.TestCase):
+
+    def test_defaults_match(self):
+        cache = jwks_cache.JwksCache("https://issuer.example.com")
+        self.assertEqual(cache.min_refresh_interval, provider_key_cache.jwks_min_refresh_interval)
+        self.assertEqual(cache.unknown_kid_ttl, provider_key_cache.unknown_kid_cache_ttl)
+        self.assertEqual(cache.request_timeout, provider_key_cache.jwks_request_timeout)
+        self.assertEqual(jwks_cache.unknown_kid_cache_max_size, provider_key_cache.unknown_kid_cache_max_size)
+
+    def test_max_age_parsing_matches(self):
+        for cache_control in [None, "", "public, max-age=300", "max-age=0", "MAX-AGE=60", 'max-age="120"', "max-age=-5", "max-age=abc",
+                              "no-cache", "public, no-store", "private"]:
+            self.assertEqual(jwks_cache.get_max_age(cache_control), provider_key_cache.get_max_age(cache_control), cache_control)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Tests of the key rotation order of generate_keys: the new public key is published before the private key becomes the signing key
+# (AWSCURRENT), so no token is signed with a kid missing from jwks.json, and a failed publish leaves the signing key unchanged
+# Usage: python -m pytest tests
+
+import io
+import json
+import os
+import sys
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ["SECRET_KEY_ID"] = "private-key"
+os.environ["ISSUER_BUCKET"] = "issuer-bucket"
+os.environ["ISSUER_ENDPOINT"] = "https://issuer.example.com"
+
+import generate_keys
+
+# Issuer bucket in memory, put_object fails for the keys in failing_keys like an S3 error
+class LocalBucket:
+
+    def __init__(self):
+        self.objects = {}
+        self.failing_keys = set()
+
+    def put_object(self, Body, Bucket, Key, ContentType, CacheControl=None, Metadata=None):
+        if Key in self.failing_keys:
+            raise Exception("InternalError: " + Key)
+        self.objects[Key] = Body
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise Exception("NoSuchKey: " + Key)
+        return {'Body': io.BytesIO(self.objects[Key].encode())}
+
+    def get_published_kids(self):
+        if '.well-known/jwks.json' not in self.objects:
+            return []
+        return [key['kid'] for key in json.loads(self.objects['.well-known/jwks.json'])['keys']]
+
+# Private key secret with staging labels, like Secrets Manager. Records whether each new signing key was published in the bucket
+# when it became AWSCURRENT
+class LocalSecret:
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.versions = {}
+        self.signing_kids_published = []
+
+    def move_stage(self, stage, version_id):
+        for stages in self.versions.values():
+            stages[1].discard(stage)
+        if version_id != None:
+            self.versions[version_id][1].add(stage)
+
+    def put_secret_value(self, SecretId, SecretString, VersionStages=["AWSCURRENT"]):
+        version_id = str(uuid.uuid4())
+        self.versions[version_id] = (SecretString, set())
+        for stage in VersionStages:
+            self.update_secret_version_stage(SecretId, stage, MoveToVersionId=version_id)
+
+    def describe_secret(self, SecretId):
+        return {'VersionIdsToStages': {version_id: list(stages) for version_id, (_, stages) in self.versions.items() if stages}}
+
+    def get_secret_value(self, SecretId, VersionId=None):
+        if VersionId == None:
+            VersionId = next(version_id for version_id, (_, stages) in self.versions.items() if "AWSCURRENT" in stages)
+        return {'SecretString': self.versions[VersionId][0]}
+
+    def update_secret_version_stage(self, SecretId, VersionStage, MoveToVersionId=None, RemoveFromVersionId=None):
+        if RemoveFromVersionId != None:
+            self.versions[RemoveFromVersionId][1].discard(VersionStage)
+        if MoveToVersionId != None:
+            self.move_stage(VersionStage, MoveToVersionId)
+            if VersionStage == "AWSCURRENT":
+                kid = json.loads(self.versions[MoveToVersionId][0])['kid']
+                self.signing_kids_published.append(kid in self.bucket.get_published_kids())
+
+    def get_signing_kid(self):
+        if not any("AWSCURRENT" in stages for _, stages in self.versions.values()):
+            return None
+        return json.loads(self.get_secret_value("private-key")['SecretString'])['kid']
+
+class KeyRotationOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = LocalBucket()
+        self.secret = LocalSecret(self.bucket)
+        generate_keys.key_rotation_mode = "immediate"
+
+    def tearDown(self):
+        generate_keys.key_rotation_mode = "immediate"
+
+    def rotate(self):
+        generate_keys.rotate_and_publish_keys(self.bucket, self.secret)
+
+    def test_immediate_rotation_publishes_before_signing(self):
+        self.rotate()
+        self.rotate()
+
+        self.assertEqual(self.secret.signing_kids_published, [True, True])
+        self.assertEqual(self.bucket.get_published_kids()[0], self.secret.get_signing_kid())
+
+    def test_staged_rotation_publishes_before_signing(self):
+        generate_keys.key_rotation_mode = "staged"
+        self.rotate()
+        generate_keys.next_key_min_publish_time = 0
+        try:
+            self.rotate()
+        finally:
+            generate_keys.next_key_min_publish_time = generate_keys.jwks_max_age * 2
+
+        self.assertEqual(self.secret.signing_kids_published, [True, True])
+
+    def test_failed_publish_keeps_the_signing_key(self):
+        self.rotate()
+        signing_kid = self.secret.get_signing_kid()
+        self.bucket.failing_keys.add('.well-known/jwks.json')
+
+        with self.assertRaises(Exception):
+            self.rotate()
+
+        self.assertEqual(self.secret.get_signing_kid(), signing_kid)
+        self.assertIn(signing_kid, self.bucket.get_published_kids())
+
+    def test_failed_first_publish_doesnt_create_a_signing_key(self):
+        self.bucket.failing_keys.add('.well-known/jwks-version.json')
+
+        with self.assertRaises(Exception):
+            self.rotate()
+
+        self.assertIsNone(self.secret.get_signing_kid())
+
+    def test_failed_staged_publish_keeps_the_signing_key(self):
+        generate_keys.key_rotation_mode = "staged"
+        self.rotate()
+        signing_kid = self.secret.get_signing_kid()
+        self.bucket.failing_keys.add('.well-known/jwks.json')
+        generate_keys.next_key_min_publish_time = 0
+        try:
+            with self.assertRaises(Exception):
+                self.rotate()
+        finally:
+            generate_keys.next_key_min_publish_time = generate_keys.jwks_max_age * 2
+
+        self.assertEqual(self.secret.get_signing_kid(), signing_kid)
+
+if __name__ == "__main__":
+    unittest.main()
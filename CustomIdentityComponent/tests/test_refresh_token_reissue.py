@@ -0,0 +1,104 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Tests of the refresh token reissue policies of refresh_access_token: which refreshes return the received refresh token, and the
+# expiration of the reissued ones, which the sliding policy extends close to expiry but not past the maximum session lifetime
+# Usage: python -m pytest tests
+
+import json
+import time
+import unittest
+import uuid
+
+from local_issuer import InMemoryRevokedTokenTable, generate_key, reset_revocation, use_signing_key
+import encryption_and_decryption
+import refresh_access_token
+
+day = 24 * 60 * 60
+refresh_token_lifetime = encryption_and_decryption.refresh_token_expiration_days * day
+
+def refresh(refresh_token):
+    response = refresh_access_token.lambda_handler({"queryStringParameters": {"refresh_token": refresh_token}}, None)
+    if response['statusCode'] != 200:
+        raise Exception("Refresh failed: " + response['body'])
+    return json.loads(response['body'])
+
+class RefreshTokenReissueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key = generate_key()
+        use_signing_key(self.key, [self.key])
+        reset_revocation(InMemoryRevokedTokenTable())
+        refresh_access_token.refresh_token_reissue_policy = "sliding"
+        refresh_access_token.refresh_token_reissue_window = day
+        refresh_access_token.refresh_token_max_session_lifetime = 30 * day
+
+    # Signs a refresh token expiring in expires_in seconds for a session that logged in logged_in_ago seconds ago
+    def sign_refresh_token(self, expires_in, logged_in_ago=0):
+        current_time = int(time.time())
+        _, refresh_token, _, _ = encryption_and_decryption.encrypt({"sub": str(uuid.uuid4())}, "authenticated", current_time + expires_in,
+                                                                    {"auth_time": current_time - logged_in_ago})
+        return refresh_token
+
+    def decode(self, refresh_token):
+        return encryption_and_decryption.decrypt_refresh_token(refresh_token)
+
+    def test_login_sets_auth_time(self):
+        decoded_refresh_token = self.decode(encryption_and_decryption.encrypt({"sub": str(uuid.uuid4())}, "authenticated")[1])
+        self.assertEqual(decoded_refresh_token['auth_time'], decoded_refresh_token['iat'])
+
+    def test_sliding_returns_the_received_token_far_from_expiry(self):
+        refresh_token = self.sign_refresh_token(refresh_token_lifetime)
+
+        response = refresh(refresh_token)
+
+        self.assertEqual(response['refresh_token'], refresh_token)
+        self.assertIsNotNone(encryption_and_decryption.decrypt(response['auth_token']))
+
+    def test_sliding_reissues_a_rotated_kid_with_the_same_expiration(self):
+        refresh_token = self.sign_refresh_token(refresh_token_lifetime)
+        new_key = generate_key()
+        use_signing_key(new_key, [self.key, new_key])
+
+        reissued_token = refresh(refresh_token)['refresh_token']
+
+        self.assertEqual(encryption_and_decryption.get_token_kid(reissued_token), new_key.get('kid'))
+        self.assertEqual(self.decode(reissued_token)['exp'], self.decode(refresh_token)['exp'])
+        self.assertEqual(self.decode(reissued_token)['auth_time'], self.decode(refresh_token)['auth_time'])
+
+    def test_sliding_extends_a_token_near_expiry(self):
+        refresh_token = self.sign_refresh_token(60 * 60, logged_in_ago=5 * day)
+
+        reissued_token = refresh(refresh_token)['refresh_token']
+
+        reissued = self.decode(reissued_token)
+        self.assertAlmostEqual(reissued['exp'], int(time.time()) + refresh_token_lifetime, delta=5)
+        self.assertEqual(reissued['auth_time'], self.decode(refresh_token)['auth_time'])
+        self.assertEqual(reissued['jti'], self.decode(refresh_token)['jti'])
+
+    def test_sliding_caps_the_extension_at_the_session_lifetime(self):
+        refresh_token = self.sign_refresh_token(60 * 60, logged_in_ago=28 * day)
+        auth_time = self.decode(refresh_token)['auth_time']
+
+        reissued_token = refresh(refresh_token)['refresh_token']
+
+        self.assertEqual(self.decode(reissued_token)['exp'], auth_time + 30 * day)
+
+    def test_sliding_doesnt_extend_a_session_at_its_lifetime(self):
+        refresh_token = self.sign_refresh_token(60 * 60, logged_in_ago=31 * day)
+
+        response = refresh(refresh_token)
+
+        self.assertEqual(response['refresh_token'], refresh_token)
+        self.assertLessEqual(response['refresh_token_expires_in'], 60 * 60)
+
+    def test_always_keeps_the_expiration_near_expiry(self):
+        refresh_access_token.refresh_token_reissue_policy = "always"
+        refresh_token = self.sign_refresh_token(60 * 60)
+
+        reissued_token = refresh(refresh_token)['refresh_token']
+
+        self.assertEqual(self.decode(reissued_token)['exp'], self.decode(refresh_token)['exp'])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Tests of refresh token session revocation: the refresh tokens reissued by refresh_access_token keep the session ID (jti) of the
+# received one, so revoking any of them with revoke_refresh_token revokes the session, and the other Lambda environments pick up the
+# revocations by querying the RevokedAtIndex
+# Usage: python -m pytest tests
+
+import json
+import time
+import unittest
+import uuid
+
+from local_issuer import InMemoryRevokedTokenTable, generate_key, reset_revocation, use_signing_key
+import encryption_and_decryption
+import refresh_access_token
+import revoke_refresh_token
+import token_revocation
+
+def refresh(refresh_token):
+    return refresh_access_token.lambda_handler({"queryStringParameters": {"refresh_token": refresh_token}}, None)
+
+def revoke(refresh_token):
+    return revoke_refresh_token.lambda_handler({"queryStringParameters": {"refresh_token": refresh_token}}, None)
+
+class RefreshTokenRevocationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        key = generate_key()
+        use_signing_key(key, [key])
+
+    def setUp(self):
+        self.table = InMemoryRevokedTokenTable()
+        reset_revocation(self.table)
+        refresh_access_token.refresh_token_reissue_policy = "always"
+
+    def login(self):
+        _, refresh_token, _, _ = encryption_and_decryption.encrypt({"sub": str(uuid.uuid4())}, "authenticated")
+        return refresh_token
+
+    def test_reissued_refresh_token_keeps_the_session_id(self):
+        first_refresh_token = self.login()
+        response = refresh(first_refresh_token)
+        self.assertEqual(response['statusCode'], 200)
+        second_refresh_token = json.loads(response['body'])['refresh_token']
+
+        self.assertEqual(encryption_and_decryption.decrypt_refresh_token(first_refresh_token)['jti'],
+                         encryption_and_decryption.decrypt_refresh_token(second_refresh_token)['jti'])
+
+    def test_new_sessions_get_different_session_ids(self):
+        self.assertNotEqual(encryption_and_decryption.decrypt_refresh_token(self.login())['jti'],
+                            encryption_and_decryption.decrypt_refresh_token(self.login())['jti'])
+
+    def test_revoking_the_reissued_token_revokes_the_earlier_one(self):
+        first_refresh_token = self.login()
+        second_refresh_token = json.loads(refresh(first_refresh_token)['body'])['refresh_token']
+
+        self.assertEqual(revoke(second_refresh_token)['statusCode'], 200)
+
+        self.assertEqual(refresh(first_refresh_token)['statusCode'], 401)
+        self.assertEqual(refresh(second_refresh_token)['statusCode'], 401)
+
+    def test_revoking_an_earlier_token_revokes_the_reissued_one(self):
+        first_refresh_token = self.login()
+        second_refresh_token = json.loads(refresh(first_refresh_token)['body'])['refresh_token']
+
+        self.assertEqual(revoke(first_refresh_token)['statusCode'], 200)
+
+        self.assertEqual(refresh(first_refresh_token)['statusCode'], 401)
+        self.assertEqual(refresh(second_refresh_token)['statusCode'], 401)
+
+    def test_revocation_lasts_a_full_refresh_token_lifetime(self):
+        refresh_token = self.login()
+        decoded_refresh_token = encryption_and_decryption.decrypt_refresh_token(refresh_token)
+        revoke(refresh_token)
+
+        expires_at = self.table.items[decoded_refresh_token['jti']]['ExpiresAt']
+        self.assertGreaterEqual(expires_at, decoded_refresh_token['exp'])
+        self.assertGreaterEqual(expires_at, int(time.time()) + encryption_and_decryption.refresh_token_expiration_days * 24 * 60 * 60 - 5)
+
+    def test_other_environment_picks_up_revocations_with_a_query(self):
+        refresh_token = self.login()
+        self.assertEqual(refresh(refresh_token)['statusCode'], 200)
+        revocation_filter = token_revocation.revocation_filter
+
+        # Another Lambda environment revokes the session
+        jti = encryption_and_decryption.decrypt_refresh_token(refresh_token)['jti']
+        self.table.put_item(Item={'Jti': jti, 'ExpiresAt': int(time.time()) + 3600,
+                                  'RevocationList': token_revocation.revocation_list_name, 'RevokedAt': int(time.time() * 1000)})
+        self.assertFalse(token_revocation.is_revoked(jti))
+
+        token_revocation.refresh_revocation_filter()
+
+        self.assertIs(token_revocation.revocation_filter, revocation_filter)
+        self.assertTrue(token_revocation.is_revoked(jti))
+        self.assertEqual(refresh(refresh_token)['statusCode'], 401)
+        self.assertNotIn("scan", self.table.calls)
+
+    def test_update_adds_each_revocation_once(self):
+        token_revocation.get_revocation_filter()
+        for _ in range(3):
+            token_revocation.revoke(str(uuid.uuid4()), int(time.time()) + 3600)
+
+        token_revocation.refresh_revocation_filter()
+        token_revocation.refresh_revocation_filter()
+
+        self.assertEqual(token_revocation.revocation_filter.count, 3)
+
+    def test_rebuild_skips_expired_revocations(self):
+        expired_jti = str(uuid.uuid4())
+        self.table.put_item(Item={'Jti': expired_jti, 'ExpiresAt': int(time.time()) - 60,
+                                  'RevocationList': token_revocation.revocation_list_name, 'RevokedAt': int(time.time() * 1000) - 3600000})
+        token_revocation.revoke(str(uuid.uuid4()), int(time.time()) + 3600)
+
+        token_revocation.rebuild_revocation_filter()
+
+        self.assertEqual(token_revocation.revocation_filter.count, 1)
+
+if __name__ == "__main__":
+    unittest.main()
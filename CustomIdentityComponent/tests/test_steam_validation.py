@@ -0,0 +1,93 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Tests of the Steam ticket validation retries of login_with_steam: a retry on error 103 is only made when the whole request (connect
+# and read timeouts) and the backoff delay still fit in the remaining Lambda execution time
+# Usage: python -m pytest tests
+
+import datetime
+import os
+import unittest
+import uuid
+
+import local_issuer
+os.environ.setdefault("AWS_LAMBDA_FUNCTION_NAME", "LoginWithSteam")
+os.environ.setdefault("STEAM_APP_ID", "480")
+os.environ.setdefault("STEAM_WEB_API_KEY_SECRET_ARN", "arn:aws:secretsmanager:us-east-1:123456789012:secret:steam")
+
+import login_with_steam
+
+class SteamResponse:
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.body = body
+        self.text = str(body)
+        self.headers = {}
+        self.elapsed = datetime.timedelta(milliseconds=10)
+
+    def json(self):
+        return self.body
+
+class LambdaContext:
+
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+class SteamRetryDeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.responses = []
+        self.original_get = login_with_steam.partner_http.get
+        self.original_secret = login_with_steam.steam_web_api_key_secret
+        self.original_base_delay = login_with_steam.steam_retry_base_delay
+        self.original_record_failure_metric = login_with_steam.record_failure_metric
+        self.original_record_steam_metric = login_with_steam.record_steam_metric
+        login_with_steam.partner_http.get = self.get
+        login_with_steam.steam_web_api_key_secret = local_issuer.LocalPrivateKey(local_issuer.generate_key())
+        login_with_steam.record_failure_metric = lambda reason: None
+        login_with_steam.record_steam_metric = lambda name, unit, value: None
+        # No backoff delay, so the deadline check only depends on the request timeouts
+        login_with_steam.steam_retry_base_delay = 0
+
+    def tearDown(self):
+        login_with_steam.partner_http.get = self.original_get
+        login_with_steam.steam_web_api_key_secret = self.original_secret
+        login_with_steam.steam_retry_base_delay = self.original_base_delay
+        login_with_steam.record_failure_metric = self.original_record_failure_metric
+        login_with_steam.record_steam_metric = self.original_record_steam_metric
+
+    def get(self, partner, api, url, params=None, timeout=None):
+        self.requests.append(timeout)
+        return self.responses.pop(0)
+
+    def respond(self, *bodies):
+        self.responses = [SteamResponse(body) for body in bodies]
+
+    def test_request_has_connect_and_read_timeouts(self):
+        self.respond({"response": {"params": {"result": "OK", "steamid": "76561197960287930"}}})
+
+        self.assertEqual(login_with_steam.check_steam_token(str(uuid.uuid4()), LambdaContext(10000)), "76561197960287930")
+        self.assertEqual(self.requests, [login_with_steam.steam_request_timeout])
+        self.assertIsInstance(login_with_steam.steam_request_timeout, tuple)
+
+    def test_no_retry_when_connect_and_read_timeouts_dont_fit(self):
+        self.respond({"response": {"error": {"errorcode": 103}}})
+        remaining_ms = sum(login_with_steam.steam_request_timeout) * 1000 + login_with_steam.steam_retry_deadline_margin_ms - 1
+
+        self.assertIsNone(login_with_steam.check_steam_token(str(uuid.uuid4()), LambdaContext(remaining_ms)))
+        self.assertEqual(len(self.requests), 1)
+
+    def test_retry_when_the_request_fits(self):
+        self.respond({"response": {"error": {"errorcode": 103}}}, {"response": {"params": {"result": "OK", "steamid": "76561197960287930"}}})
+        remaining_ms = sum(login_with_steam.steam_request_timeout) * 1000 + login_with_steam.steam_retry_deadline_margin_ms + 1
+
+        self.assertEqual(login_with_steam.check_steam_token(str(uuid.uuid4()), LambdaContext(remaining_ms)), "76561197960287930")
+        self.assertEqual(len(self.requests), 2)
+
+if __name__ == "__main__":
+    unittest.main()
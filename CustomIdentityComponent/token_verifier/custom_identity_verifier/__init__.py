@@ -0,0 +1,9 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Offline verifier for the tokens of the custom identity component, for game servers and other services outside AWS Lambda
+
+from .jwks_cache import JwksCache
+from .verifier import TokenVerifier, TokenVerificationError, VerificationResult
+
+__all__ = ["JwksCache", "TokenVerifier", "TokenVerificationError", "VerificationResult"]
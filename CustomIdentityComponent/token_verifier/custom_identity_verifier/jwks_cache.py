@@ -0,0 +1,137 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Thread-safe cache of the public keys (JWKS) of the custom identity issuer
+# The keys are parsed once per fetch and shared by all threads. They are revalidated with the issuer's Cache-Control max-age and ETag
+# (a 304 response when the keys haven't changed), and refetched for a new kid at most once per min_refresh_interval, however many
+# threads or tokens ask for it at the same time
+# NOTE: This is the standalone version of lambda/provider_key_cache.py (the package can't depend on the Lambda code), with the same
+# defaults and the same max-age, ETag and unknown kid behaviour. Keep the two in sync, tests/test_jwks_caches.py runs the same cases on both
+
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import jwt
+
+logger = logging.getLogger(__name__)
+
+# Maximum amount of unknown kids remembered, so a flood of forged kids can't grow the cache without limit (unknown_kid_cache_max_size in provider_key_cache)
+unknown_kid_cache_max_size = 1000
+
+# Returns the max-age in seconds from a Cache-Control header, or None if the header doesn't define one
+def get_max_age(cache_control):
+    if cache_control == None:
+        return None
+    for directive in cache_control.split(","):
+        name, _, value = directive.strip().partition("=")
+        name = name.lower()
+        if name == "no-cache" or name == "no-store":
+            return 0
+        if name == "max-age":
+            try:
+                return max(int(value.strip('"')), 0)
+            except ValueError:
+                return None
+    return None
+
+class JwksCache:
+
+    # issuer_url is the issuer endpoint, the keys are fetched from its /.well-known/jwks.json. For servers without access to the issuer,
+    # fetch_keys=False only uses the keys given to load_key_set
+    # The defaults match jwks_min_refresh_interval, jwks_request_timeout and unknown_kid_cache_ttl of provider_key_cache
+    def __init__(self, issuer_url, min_refresh_interval=30, request_timeout=3, unknown_kid_ttl=300, fetch_keys=True):
+        self.jwks_url = issuer_url.rstrip("/") + "/.well-known/jwks.json"
+        self.min_refresh_interval = min_refresh_interval
+        self.request_timeout = request_timeout
+        self.unknown_kid_ttl = unknown_kid_ttl
+        self.fetch_keys = fetch_keys
+        # Parsed keys by kid, replaced as a whole so readers never see a partially loaded key set
+        self.keys = {}
+        self.unknown_kids = {}
+        self.etag = None
+        self.expires_at = None
+        self.last_refresh = 0
+        self.refresh_lock = threading.Lock()
+        self.fetch_count = 0
+        self.not_modified_count = 0
+
+    # Loads a key set document ({"keys": [...]}), for example a jwks.json shipped with the server build
+    def load_key_set(self, key_set):
+        keys = {}
+        for key in key_set.get("keys", []):
+            if "kid" not in key:
+                continue
+            try:
+                keys[key["kid"]] = jwt.PyJWK(key)
+            except Exception as e:
+                logger.warning("Skipping unsupported key %s in key set: %s", key["kid"], e)
+        self.keys = keys
+        self.unknown_kids = {}
+
+    def fetch(self):
+        request = urllib.request.Request(self.jwks_url)
+        if self.etag != None and self.keys:
+            request.add_header("If-None-Match", self.etag)
+        self.fetch_count += 1
+        try:
+            with urllib.request.urlopen(request, timeout=self.request_timeout) as response:
+                self.load_key_set(json.loads(response.read()))
+                self.etag = response.headers.get("ETag")
+                headers = response.headers
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            self.not_modified_count += 1
+            headers = e.headers
+
+        max_age = get_max_age(headers.get("Cache-Control"))
+        self.expires_at = time.time() + max_age if max_age != None else None
+
+    # Refreshes the keys unless they were refreshed within min_refresh_interval (for example by another thread), returns True if refreshed
+    def refresh(self, force=False):
+        with self.refresh_lock:
+            current_time = time.time()
+            if not force and current_time - self.last_refresh < self.min_refresh_interval:
+                return False
+            self.last_refresh = current_time
+            try:
+                self.fetch()
+                return True
+            except Exception as e:
+                logger.warning("Error refreshing keys from %s: %s", self.jwks_url, e)
+                return False
+
+    # Fetches the keys ahead of the first verification, for example when the server starts
+    def prefetch(self):
+        return self.refresh(force=True)
+
+    # Returns the parsed keys (PyJWK) for the kids, with None for the kids the issuer doesn't publish. The keys are refreshed once
+    # for all the kids that are missing, so a batch of tokens makes at most one request
+    def get_keys(self, kids):
+        if not self.fetch_keys:
+            return {kid: self.keys.get(kid) for kid in kids}
+
+        current_time = time.time()
+        refreshed = False
+        if self.expires_at != None and current_time >= self.expires_at:
+            refreshed = self.refresh()
+
+        keys = self.keys
+        missing_kids = [kid for kid in kids if kid not in keys and self.unknown_kids.get(kid, 0) <= current_time]
+        if missing_kids and (refreshed or self.refresh()):
+            # Remember the kids missing from the fresh keys, so forged kids don't trigger new requests
+            keys = self.keys
+            if len(self.unknown_kids) >= unknown_kid_cache_max_size:
+                self.unknown_kids = {}
+            for kid in missing_kids:
+                if kid not in keys:
+                    self.unknown_kids[kid] = current_time + self.unknown_kid_ttl
+        keys = self.keys
+        return {kid: keys.get(kid) for kid in kids}
+
+    def get_key(self, kid):
+        return self.get_keys([kid])[kid]
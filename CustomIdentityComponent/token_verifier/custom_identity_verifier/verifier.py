@@ -0,0 +1,131 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Verifies the access tokens of the custom identity component (signed by encryption_and_decryption.encrypt) on servers outside AWS Lambda,
+# such as Amazon GameLift game servers and containers. Only the issuer's public keys are fetched, once for all tokens, and then every
+# token is verified locally
+
+import jwt
+
+from .jwks_cache import JwksCache
+
+# Signing algorithms of the custom identity component, each key is only used with the algorithm of its key type
+supported_signing_algorithms = ["RS256", "ES256", "EdDSA"]
+
+# Audience of the access tokens, refresh tokens have the audience "refresh" and are rejected
+access_token_audience = "gamebackend"
+
+# Failure reasons of verify_batch results and TokenVerificationError
+MALFORMED = "malformed"
+UNKNOWN_KID = "unknown_kid"
+UNSUPPORTED_ALGORITHM = "unsupported_algorithm"
+INVALID_SIGNATURE = "invalid_signature"
+EXPIRED = "expired"
+NOT_YET_VALID = "not_yet_valid"
+INVALID_AUDIENCE = "invalid_audience"
+INVALID_ISSUER = "invalid_issuer"
+MISSING_CLAIM = "missing_claim"
+INVALID_SCOPE = "invalid_scope"
+INVALID = "invalid"
+
+# Failure reasons of the PyJWT exceptions, the first matching class is used
+decode_error_reasons = [
+    (jwt.ExpiredSignatureError, EXPIRED),
+    (jwt.ImmatureSignatureError, NOT_YET_VALID),
+    (jwt.InvalidAudienceError, INVALID_AUDIENCE),
+    (jwt.InvalidIssuerError, INVALID_ISSUER),
+    (jwt.MissingRequiredClaimError, MISSING_CLAIM),
+    (jwt.InvalidSignatureError, INVALID_SIGNATURE),
+    (jwt.InvalidAlgorithmError, UNSUPPORTED_ALGORITHM),
+    (jwt.DecodeError, MALFORMED)
+]
+
+class TokenVerificationError(Exception):
+
+    def __init__(self, reason, message=None):
+        super().__init__(message if message != None else reason)
+        self.reason = reason
+
+# Result of one token in a batch: the claims if the token is valid, otherwise the failure reason
+class VerificationResult:
+
+    def __init__(self, claims=None, reason=None):
+        self.claims = claims
+        self.reason = reason
+
+    @property
+    def valid(self):
+        return self.claims != None
+
+    def __repr__(self):
+        return "VerificationResult(valid)" if self.valid else "VerificationResult(" + self.reason + ")"
+
+class TokenVerifier:
+
+    # issuer_url is the IssuerEndpointUrl output of the CustomIdentityComponentStack. leeway is the allowed clock skew in seconds
+    # between the issuer and this server for exp, nbf and iat, and scopes limits the accepted scopes (for example ["authenticated"])
+    def __init__(self, issuer_url, audience=access_token_audience, leeway=30, scopes=None, jwks_cache=None):
+        self.issuer_url = issuer_url
+        self.audience = audience
+        self.leeway = leeway
+        self.scopes = scopes
+        self.jwks_cache = jwks_cache if jwks_cache != None else JwksCache(issuer_url)
+
+    def get_kid(self, token):
+        try:
+            return jwt.get_unverified_header(token)["kid"]
+        except Exception as e:
+            raise TokenVerificationError(MALFORMED, "Token header can't be decoded: " + str(e))
+
+    def verify_with_key(self, token, key):
+        if key == None:
+            raise TokenVerificationError(UNKNOWN_KID)
+        # Only accept the algorithm of the published key, so a token can't pick a different algorithm for the key
+        if key.algorithm_name not in supported_signing_algorithms:
+            raise TokenVerificationError(UNSUPPORTED_ALGORITHM)
+
+        try:
+            claims = jwt.decode(token, key.key, algorithms=[key.algorithm_name], audience=self.audience, issuer=self.issuer_url,
+                                leeway=self.leeway, options={"require": ["exp", "iat", "iss", "aud", "sub"]})
+        except jwt.PyJWTError as e:
+            for error_class, reason in decode_error_reasons:
+                if isinstance(e, error_class):
+                    raise TokenVerificationError(reason, str(e))
+            raise TokenVerificationError(INVALID, str(e))
+
+        if self.scopes != None and claims.get("scope") not in self.scopes:
+            raise TokenVerificationError(INVALID_SCOPE)
+        return claims
+
+    # Returns the claims of a valid token, raises TokenVerificationError with the failure reason otherwise
+    def verify(self, token):
+        kid = self.get_kid(token)
+        return self.verify_with_key(token, self.jwks_cache.get_key(kid))
+
+    # Verifies a list of tokens (for example the tokens of all the players of a match) and returns a VerificationResult for each,
+    # in the same order. The keys of all the tokens are looked up at once, so the batch makes at most one request to the issuer
+    def verify_batch(self, tokens):
+        kids = {}
+        for token in tokens:
+            if token not in kids:
+                try:
+                    kids[token] = self.get_kid(token)
+                except TokenVerificationError as e:
+                    kids[token] = e
+
+        keys = self.jwks_cache.get_keys(set(kid for kid in kids.values() if isinstance(kid, str)))
+
+        # Repeated tokens are only verified once
+        verified_tokens = {}
+        results = []
+        for token in tokens:
+            if token not in verified_tokens:
+                kid = kids[token]
+                try:
+                    if isinstance(kid, TokenVerificationError):
+                        raise kid
+                    verified_tokens[token] = VerificationResult(claims=self.verify_with_key(token, keys.get(kid)))
+                except TokenVerificationError as e:
+                    verified_tokens[token] = VerificationResult(reason=e.reason)
+            results.append(verified_tokens[token])
+        return results